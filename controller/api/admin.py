@@ -15,6 +15,7 @@ from .models import Config
 from .models import Container
 from .models import Domain
 from .models import Key
+from .models import Operation
 from .models import Release
 
 
@@ -78,6 +79,16 @@ class KeyAdmin(admin.ModelAdmin):
 admin.site.register(Key, KeyAdmin)
 
 
+class OperationAdmin(admin.ModelAdmin):
+    """Set presentation options for :class:`~api.models.Operation` models
+    in the Django admin.
+    """
+    date_hierarchy = 'created'
+    list_display = ('created', 'app', 'type', 'state', 'owner')
+    list_filter = ('state', 'type', 'app')
+admin.site.register(Operation, OperationAdmin)
+
+
 class ReleaseAdmin(admin.ModelAdmin):
     """Set presentation options for :class:`~api.models.Release` models
     in the Django admin.
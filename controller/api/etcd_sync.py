@@ -0,0 +1,189 @@
+"""
+Helpers to keep the state published in etcd in line with the database.
+"""
+
+from __future__ import unicode_literals
+
+from api import workers
+from api.utils import dict_diff, fingerprint
+
+
+def read_values(client, path):
+    """Return the values stored directly under an etcd directory, keyed by name."""
+    try:
+        result = client.read(path)
+    except KeyError:
+        return {}
+    values = {}
+    for node in result.leaves:
+        if not node.dir:
+            values[node.key.rsplit('/', 1)[-1]] = node.value
+    return values
+
+
+def sync_values(client, path, values, dry_run=False):
+    """
+    Make the etcd directory at path hold exactly the given values.
+
+    Only the keys which were added, changed or deleted are written, all at once, and the
+    directory itself is never removed so readers do not find it empty while it is updated.
+
+    :return: the difference between the given values and what etcd held before, as returned by
+             :func:`~api.utils.dict_diff`
+    """
+    diff = dict_diff(values, read_values(client, path))
+    if dry_run or not diff:
+        return diff
+    funcs = []
+    for k, v in diff.get('added', {}).items() + diff.get('changed', {}).items():
+        funcs.append(lambda k=k, v=v: client.write('{}/{}'.format(path, k), v.encode('utf-8')))
+    for k in diff.get('deleted', {}):
+        funcs.append(lambda k=k: _delete(client, '{}/{}'.format(path, k)))
+    for task in workers.etcd_pool().run_all(path, funcs):
+        if task.exception is not None:
+            raise task.exception
+    return diff
+
+
+def _delete(client, key):
+    try:
+        client.delete(key)
+    except KeyError:
+        pass
+
+
+def config_values(config):
+    """Return the values of a :class:`~api.models.Config` as they are published to etcd."""
+    return {unicode(k).lower(): unicode(v) for k, v in config.values.iteritems()}
+
+
+def read_tree(client, path, recursive=True):
+    """Return every node below an etcd directory keyed by its full path, with None for dirs."""
+    try:
+        result = client.read(path, recursive=recursive)
+    except KeyError:
+        return {}
+    return {node.key: None if node.dir else node.value
+            for node in result.get_subtree() if node.key != path}
+
+
+class Resync(object):
+    """
+    Publish the platform state held in the database to etcd in bulk.
+
+    Each kind of object is streamed from the database and compared with what etcd holds, which
+    is read once per kind, so that only missing or outdated keys are written. If a resync is
+    interrupted, running it again only writes what is still missing.
+    """
+
+    # number of writes queued before waiting for them to finish
+    batch_size = 500
+    # number of objects checked between progress reports
+    report_every = 1000
+
+    def __init__(self, client, dry_run=False, progress=None):
+        self.client = client
+        self.dry_run = dry_run
+        self.progress = progress or (lambda message: None)
+        self.errors = []
+        self._pending = []
+
+    def run(self):
+        """Publish keys, apps, domains, certificates and configs."""
+        # imported here since api.models depends on this module
+        from api.models import App, Certificate, Config, Domain, Key
+        keys = Key.objects.select_related('owner').iterator()
+        self._sync('keys', '/deis/builder/users', (
+            ('/deis/builder/users/{}/{}'.format(key.owner.username, fingerprint(key.public)),
+             key.public) for key in keys))
+        apps = App.objects.only('id').iterator()
+        self._sync('apps', '/deis/services', (
+            ('/deis/services/{}'.format(app), None) for app in apps), recursive=False)
+        domains = Domain.objects.select_related('app').iterator()
+        self._sync('domains', '/deis/domains', (
+            ('/deis/domains/{}'.format(domain), domain.app.id) for domain in domains))
+        self._sync('certificates', '/deis/certs', self._certificates(
+            Certificate.objects.iterator()))
+        configs = Config.objects.select_related('app').order_by('app', '-created').iterator()
+        self._sync('configs', '/deis/config', self._latest_configs(configs), prune=True)
+        return not self.errors
+
+    def _certificates(self, certs):
+        for cert in certs:
+            yield '/deis/certs/{}/cert'.format(cert), cert.certificate
+            yield '/deis/certs/{}/key'.format(cert), cert.key
+
+    def _latest_configs(self, configs):
+        """Yield the values of the newest config of each app, given configs newest first."""
+        app = None
+        for config in configs:
+            if config.app_id == app:
+                continue
+            app = config.app_id
+            path = '/deis/config/{}'.format(config.app)
+            # publish an empty config as an empty directory
+            yield path, None
+            for k, v in config_values(config).iteritems():
+                yield '{}/{}'.format(path, k), v
+
+    def _sync(self, name, root, desired, recursive=True, prune=False):
+        """
+        Write each (key, value) pair in desired which differs from what etcd holds under root.
+        A value of None stands for a directory.
+
+        With prune, keys held in a directory which is published are removed if they were not
+        part of desired.
+        """
+        current = read_tree(self.client, root, recursive)
+        seen = set()
+        checked = changed = 0
+        for key, value in desired:
+            checked += 1
+            seen.add(key)
+            if key not in current or current[key] != value:
+                changed += 1
+                self._write(key, value)
+            if checked % self.report_every == 0:
+                self.progress('{}: {} checked, {} changed'.format(name, checked, changed))
+        if prune:
+            for key in current:
+                if key not in seen and key.rsplit('/', 1)[0] in seen:
+                    changed += 1
+                    self._delete(key)
+        self._flush()
+        self.progress('{}: {} checked, {} {}'.format(
+            name, checked, changed, 'to change' if self.dry_run else 'changed'))
+
+    def _write(self, key, value):
+        if self.dry_run:
+            self.progress('would write {}'.format(key))
+        elif value is None:
+            self._submit(self._mkdir, key)
+        else:
+            self._submit(self.client.write, key, value.encode('utf-8'))
+
+    def _delete(self, key):
+        if self.dry_run:
+            self.progress('would delete {}'.format(key))
+        else:
+            self._submit(_delete, self.client, key)
+
+    def _mkdir(self, key):
+        try:
+            self.client.write(key, None, dir=True)
+        except KeyError:
+            # the directory already exists
+            pass
+
+    def _submit(self, func, *args):
+        self._pending.append(workers.etcd_pool().submit('resync', func, *args))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        for task in self._pending:
+            task.wait()
+            if task.exception is not None:
+                self.errors.append(task.exception)
+                self.progress('error: {}'.format(task.exception))
+        self._pending = []
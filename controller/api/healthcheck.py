@@ -0,0 +1,91 @@
+"""
+Health checks for application containers which are being put into service.
+"""
+
+from __future__ import unicode_literals
+import time
+
+from django.conf import settings
+import etcd
+import requests
+
+from api import workers
+
+
+# one connection pool shared by every health check in this process
+session = requests.Session()
+session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=settings.HEALTHCHECK_WORKERS))
+
+
+class Result(object):
+    """The outcome of probing a single container."""
+
+    def __init__(self, job_id, error=None, latency=None):
+        self.job_id = job_id
+        self.error = error
+        self.latency = latency
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __str__(self):
+        if self.ok:
+            return "{} ({}ms)".format(self.job_id, int(self.latency * 1000))
+        return "{} ({})".format(self.job_id, self.error)
+
+
+def get_services(client, app, job_ids):
+    """Return the address published in etcd for each of the given jobs, keyed by job ID."""
+    try:
+        result = client.read('/deis/services/{}'.format(app), recursive=True)
+    except (KeyError, etcd.EtcdException):
+        return {}
+    job_ids = set(job_ids)
+    services = {}
+    for node in result.leaves:
+        job_id = node.key.rsplit('/', 1)[-1]
+        if job_id in job_ids and node.value:
+            services[job_id] = node.value
+    return services
+
+
+def wait_for_services(client, app, job_ids, timeout):
+    """
+    Wait for the publisher to register each job in etcd.
+
+    Returns as soon as every job is registered, or once `timeout` seconds have passed.
+    """
+    deadline = time.time() + timeout
+    while len(get_services(client, app, job_ids)) < len(job_ids) and time.time() < deadline:
+        time.sleep(settings.HEALTHCHECK_POLL_INTERVAL)
+
+
+def probe(job_id, address, path, timeout):
+    """Request path from a container and check that it responds with a 200 OK."""
+    if address is None:
+        return Result(job_id, 'failed to connect to container (not registered in etcd)')
+    url = "http://{}{}".format(address, path)
+    start = time.time()
+    try:
+        response = session.get(url, timeout=timeout)
+    except (requests.Timeout, requests.ConnectionError) as e:
+        return Result(job_id, 'failed to connect to container ({})'.format(e))
+    if response.status_code != requests.codes.OK:
+        return Result(job_id, "app failed health check (got '{}', expected: '200')".format(
+            response.status_code))
+    return Result(job_id, latency=time.time() - start)
+
+
+def check(client, app, job_ids, path, timeout):
+    """
+    Probe every job at once.
+
+    :return: a list of :class:`Result`, in the same order as job_ids
+    """
+    services = get_services(client, app, job_ids)
+    funcs = [lambda job_id=job_id: probe(job_id, services.get(job_id), path, timeout)
+             for job_id in job_ids]
+    tasks = workers.healthcheck_pool().run_all(app, funcs)
+    return [task.result if task.exception is None else Result(job_id, "{}".format(task.exception))
+            for job_id, task in zip(job_ids, tasks)]
@@ -0,0 +1,141 @@
+"""
+Garbage collection of the images of old releases, in deis-registry and in the controller's
+local Docker storage graph.
+"""
+
+from __future__ import unicode_literals
+import re
+import time
+
+from django.conf import settings
+
+from api.models import App, Container
+from registry.dockerclient import DockerClient, repository_lock
+from registry.registryclient import RegistryClient
+
+
+# the tags given to the image of a release, and to the source image of a deis-builder build
+RELEASE_TAG = re.compile(r'^v(?P<version>\d+)$')
+SOURCE_TAG = re.compile(r'^git-(?P<sha>[0-9a-f]+)$')
+
+
+class ImageGC(object):
+    """
+    Remove the images of the releases of each application which are no longer needed.
+
+    The images of the newest `keep` releases of an application, and of every release which
+    still has containers, are kept. The tags of the other releases are deleted from
+    deis-registry and removed from the local storage graph, along with the local copies of
+    the source images which no kept release was built from. The source images in
+    deis-registry are left alone, so that any release can still be rolled back to.
+
+    A release whose image is collected is no longer reused for later releases published from
+    the same source image and config.
+    """
+
+    def __init__(self, keep, dry_run=False, progress=None, docker_client=None,
+                 registry_client=None):
+        self.keep = keep
+        self.dry_run = dry_run
+        self.progress = progress or (lambda message: None)
+        self.docker = docker_client
+        self.registry = registry_client or RegistryClient()
+        self.errors = []
+        self.stats = {'apps': 0, 'releases': 0, 'registry_tags': 0, 'local_tags': 0,
+                      'errors': 0, 'seconds': 0.0}
+
+    def run(self):
+        """Collect the images of every application, and return whether it went without error."""
+        start = time.time()
+        try:
+            if self.docker is None:
+                self.docker = DockerClient()
+            local = self.docker.local_tags()
+        except Exception as e:
+            self._error('listing local images', e)
+            local = {}
+        for app in App.objects.only('id').iterator():
+            self.collect(app, local)
+        self.stats['seconds'] = round(time.time() - start, 3)
+        return not self.errors
+
+    def collect(self, app, local):
+        """Collect the images of an application, given the local tags of each repository."""
+        releases, kept, shas = self._kept(app)
+        self.stats['apps'] += 1
+        self.stats['releases'] += len(releases) - len(kept)
+        if not self.dry_run:
+            # stop offering the images about to be collected for reuse
+            app.release_set.exclude(version__in=kept).exclude(image_key='').update(image_key='')
+        try:
+            tags = self.registry.get_tags(app.id)
+        except Exception as e:
+            self._error('listing the tags of {}'.format(app.id), e)
+            tags = {}
+        for tag in sorted(tags):
+            match = RELEASE_TAG.match(tag)
+            if match and int(match.group('version')) not in kept:
+                self._remove('registry_tags', self.registry.delete_tag, app.id, tag)
+        registry_repo = '{}:{}/{}'.format(settings.REGISTRY_HOST, settings.REGISTRY_PORT, app.id)
+        for repo in (app.id, registry_repo):
+            collected = [tag for tag in sorted(local.get(repo, ()))
+                         if not self._keeps(tag, kept, shas)]
+            if self.dry_run:
+                for tag in collected:
+                    self._remove('local_tags', self.docker.remove, repo, tag)
+            elif collected:
+                self._remove_local(app, repo, collected, registry_repo)
+
+    def _remove_local(self, app, repo, tags, registry_repo):
+        """Untag local images of an application which are still not needed once it is locked."""
+        try:
+            # publishing a release pulls and builds from the app's repository in deis-registry
+            # under this lock, so no image is untagged while a release is being built from it
+            with repository_lock(registry_repo):
+                # a rollback may have reused an old source image since the releases were read
+                _, kept, shas = self._kept(app)
+                for tag in tags:
+                    if not self._keeps(tag, kept, shas):
+                        self._remove('local_tags', self.docker.remove, repo, tag)
+        except Exception as e:
+            self._error('locking {}'.format(registry_repo), e)
+
+    def _kept(self, app):
+        """
+        Return an application's (version, build sha) of each release, newest first, along with
+        the versions of the releases to keep and the shas of the builds they were made from.
+        """
+        releases = list(app.release_set.order_by('-version').values_list('version', 'build__sha'))
+        kept = {version for version, _ in releases[:self.keep]}
+        kept.update(Container.objects.filter(app=app).values_list('release__version', flat=True))
+        shas = {sha for version, sha in releases if version in kept and sha}
+        return releases, kept, shas
+
+    @staticmethod
+    def _keeps(tag, kept, shas):
+        """Whether a local tag is the image of a kept release or the source image of one."""
+        release, source = RELEASE_TAG.match(tag), SOURCE_TAG.match(tag)
+        return not (release and int(release.group('version')) not in kept or
+                    source and source.group('sha') not in shas)
+
+    def _remove(self, counter, func, repo, tag):
+        if self.dry_run:
+            self.progress('would remove {}:{}'.format(repo, tag))
+            self.stats[counter] += 1
+            return
+        try:
+            func(repo, tag)
+            self.stats[counter] += 1
+        except Exception as e:
+            self._error('removing {}:{}'.format(repo, tag), e)
+
+    def _error(self, action, e):
+        self.errors.append(e)
+        self.stats['errors'] += 1
+        self.progress('error {}: {}'.format(action, e))
+
+    def summary(self):
+        """Describe what the last run collected, and how long it took."""
+        return ('{apps} apps, {releases} old releases: {registry_tags} registry tags and '
+                '{local_tags} local tags {action}, {errors} errors in {seconds}s').format(
+            action='to remove' if self.dry_run else 'removed', **self.stats)
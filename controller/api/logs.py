@@ -0,0 +1,135 @@
+"""
+Application logs, read from deis-logger.
+"""
+
+from __future__ import unicode_literals
+import logging
+import re
+import time
+
+from django.conf import settings
+import requests
+
+
+logger = logging.getLogger(__name__)
+
+# one connection pool shared by every request to deis-logger in this process
+session = requests.Session()
+session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=settings.LOGGER_CONNECTIONS))
+
+# lines are logged as "<time> <app>[<process type>.<number>]: <message>"
+LINE = re.compile(r'^\S+ [-_a-z0-9]+\[(?P<type>[-_a-z0-9]+)[^\]]*\]: ')
+# bytes read from deis-logger at a time while streaming
+CHUNK_SIZE = 8192
+
+
+def fetch(app_id, log_lines, stream=False):
+    """
+    Request the last log_lines lines of an application's logs from deis-logger.
+
+    :return: the response, with its content left unread when streaming
+    """
+    url = "http://{}:{}/{}?log_lines={}".format(settings.LOGGER_HOST, settings.LOGGER_PORT,
+                                                app_id, log_lines)
+    try:
+        r = session.get(url, stream=stream)
+    # Handle HTTP request errors
+    except requests.exceptions.RequestException as e:
+        logger.error("Error accessing deis-logger using url '{}': {}".format(url, e))
+        raise e
+    # Handle logs empty or not found
+    if r.status_code == 204 or r.status_code == 404:
+        r.close()
+        logger.info("GET {} returned a {} status code".format(url, r.status_code))
+        raise EnvironmentError('Could not locate logs')
+    # Handle unanticipated status codes
+    if r.status_code != 200:
+        r.close()
+        logger.error("Error accessing deis-logger: GET {} returned a {} status code"
+                     .format(url, r.status_code))
+        raise EnvironmentError('Error accessing deis-logger')
+    return r
+
+
+def matches(line, process_type):
+    """Check whether a log line was written by a process of the given type, if any."""
+    if process_type is None:
+        return True
+    match = LINE.match(line)
+    return match is not None and match.group('type') == process_type
+
+
+def stream(app_id, log_lines, process_type=None, follow=False):
+    """
+    Read an application's logs line by line as they arrive from deis-logger.
+
+    deis-logger is asked for the logs straight away, so that errors are raised here rather
+    than once the lines are being read. With follow, deis-logger is asked for the latest
+    lines every LOG_FOLLOW_INTERVAL seconds once the first lines have been read, and the
+    lines logged after the last one read are passed on, for up to LOG_FOLLOW_TIMEOUT seconds.
+    Each follower holds a worker for that long, so it is kept short and clients reconnect.
+
+    :return: an iterator over the lines, each ending with a newline
+    """
+    return _stream(fetch(app_id, log_lines, stream=True), app_id, process_type, follow)
+
+
+def _stream(r, app_id, process_type, follow):
+    cursor = None
+    try:
+        for line in r.iter_lines(chunk_size=CHUNK_SIZE):
+            cursor = _advance(cursor, line)
+            if matches(line, process_type):
+                yield line + b'\n'
+    finally:
+        r.close()
+    if not follow:
+        return
+    deadline = time.time() + settings.LOG_FOLLOW_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(settings.LOG_FOLLOW_INTERVAL)
+        try:
+            lines = fetch(app_id, settings.LOG_LINES).content.splitlines()
+        except EnvironmentError:
+            # nothing has been logged yet
+            continue
+        except requests.exceptions.RequestException:
+            return
+        for line in _after(lines, cursor):
+            cursor = _advance(cursor, line)
+            if matches(line, process_type):
+                yield line + b'\n'
+
+
+def _timestamp(line):
+    return line.split(b' ', 1)[0]
+
+
+def _advance(cursor, line):
+    """
+    Move the cursor past a line. The cursor is the time of the last line read, and the number
+    of lines read which were logged at that time.
+    """
+    timestamp = _timestamp(line)
+    if cursor is not None and cursor[0] == timestamp:
+        return timestamp, cursor[1] + 1
+    return timestamp, 1
+
+
+def _after(lines, cursor):
+    """Return the lines which were logged after the cursor."""
+    if cursor is None:
+        return lines
+    timestamp, seen = cursor
+    after = []
+    for line in lines:
+        t = _timestamp(line)
+        if t > timestamp:
+            after.append(line)
+        elif t == timestamp:
+            # the lines logged at the same time as the last line read were read up to it
+            if seen > 0:
+                seen -= 1
+            else:
+                after.append(line)
+    return after
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Operation
+
+
+class Command(BaseCommand):
+    """Management command for failing the background operations which a stopped controller
+    left pending or running, and for pruning old finished operations.
+    """
+
+    def handle(self, *args, **options):
+        """Marks the operations left pending or running as failed and prunes old ones."""
+        print "Failed {} orphaned operations.".format(Operation.fail_orphaned())
+        print "Pruned {} finished operations.".format(Operation.prune())
@@ -0,0 +1,51 @@
+import logging
+from optparse import make_option
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from api.image_gc import ImageGC
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """Management command for removing the Docker images of old releases from deis-registry
+    and the controller's local storage graph.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--keep', type='int', dest='keep', default=None,
+                    help='Number of releases of each app whose images are kept.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only list the images which would be removed.'),
+        make_option('--periodic', action='store_true', dest='periodic', default=False,
+                    help='Run every IMAGE_GC_INTERVAL seconds, if it is set.'),
+    )
+
+    def handle(self, *args, **options):
+        """Removes the Docker images of old releases."""
+        keep = options['keep'] if options['keep'] is not None else settings.IMAGE_GC_RELEASES
+        if keep < 1:
+            raise CommandError('At least the latest release of each app must be kept')
+        if not options['periodic']:
+            gc = ImageGC(keep, dry_run=options['dry_run'], progress=self._progress)
+            ok = gc.run()
+            print gc.summary()
+            if not ok:
+                raise CommandError('Failed to remove {} images'.format(len(gc.errors)))
+            return
+        while settings.IMAGE_GC_INTERVAL:
+            time.sleep(settings.IMAGE_GC_INTERVAL)
+            close_old_connections()
+            try:
+                gc = ImageGC(keep, dry_run=options['dry_run'], progress=self._progress)
+                gc.run()
+                logger.info('image GC: {}'.format(gc.summary()))
+            except Exception as e:
+                logger.error('image GC failed: {}'.format(e))
+
+    def _progress(self, message):
+        print message
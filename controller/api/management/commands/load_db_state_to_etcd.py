@@ -1,16 +1,30 @@
-from django.core.management.base import BaseCommand
+from optparse import make_option
 
-from api.models import Key, App, Domain, Certificate, Config
+from django.core.management.base import BaseCommand, CommandError
+
+from api.etcd_sync import Resync
+from api.models import get_etcd_client
 
 
 class Command(BaseCommand):
     """Management command for publishing Deis platform state from the database
     to etcd.
     """
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only list the keys which would be written to etcd.'),
+    )
+
     def handle(self, *args, **options):
         """Publishes Deis platform state from the database to etcd."""
+        client = get_etcd_client()
+        if client is None:
+            raise CommandError('Cannot connect to etcd')
         print "Publishing DB state to etcd..."
-        for model in (Key, App, Domain, Certificate, Config):
-            for obj in model.objects.all():
-                obj.save()
+        resync = Resync(client, dry_run=options['dry_run'], progress=self._progress)
+        if not resync.run():
+            raise CommandError('Failed to publish {} keys'.format(len(resync.errors)))
         print "Done Publishing DB state to etcd."
+
+    def _progress(self, message):
+        print message
@@ -6,22 +6,23 @@ Data models for the Deis API.
 
 from __future__ import unicode_literals
 import base64
-from datetime import datetime
+from datetime import datetime, timedelta
 import etcd
-import importlib
+import functools
 import logging
 import re
+import threading
 import time
-from threading import Thread
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError, SuspiciousOperation
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Count
 from django.db.models import Max
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from docker.utils import utils as dockerutils
 from json_field.fields import JSONField
@@ -29,8 +30,9 @@ from OpenSSL import crypto
 import requests
 from rest_framework.authtoken.models import Token
 
-from api import fields, utils, exceptions
+from api import etcd_sync, fields, healthcheck, logs, state_cache, utils, exceptions, workers
 from registry import publish_release
+import scheduler
 from utils import dict_diff, fingerprint
 
 
@@ -60,6 +62,10 @@ def log_event(app, msg, level=logging.INFO):
     # controller needs to know which app this log comes from
     logger.log(level, "{}: {}".format(app.id, msg))
     app.log(msg, level)
+    # report progress to the client if this happened as part of a background operation
+    operation = current_operation()
+    if operation is not None and operation.app_id == app.pk:
+        operation.log(msg)
 
 
 def validate_base64(value):
@@ -178,11 +184,19 @@ class App(UuidAuditedModel):
 
     @property
     def _scheduler(self):
-        mod = importlib.import_module(settings.SCHEDULER_MODULE)
-        return mod.SchedulerClient(settings.SCHEDULER_TARGET,
-                                   settings.SCHEDULER_AUTH,
-                                   settings.SCHEDULER_OPTIONS,
-                                   settings.SSH_PRIVATE_KEY)
+        return scheduler.get_client(settings.SCHEDULER_MODULE,
+                                    settings.SCHEDULER_TARGET,
+                                    settings.SCHEDULER_AUTH,
+                                    settings.SCHEDULER_OPTIONS,
+                                    settings.SSH_PRIVATE_KEY)
+
+    @property
+    def _state_cache(self):
+        return state_cache.get_cache(settings.SCHEDULER_MODULE,
+                                     settings.SCHEDULER_TARGET,
+                                     settings.SCHEDULER_AUTH,
+                                     settings.SCHEDULER_OPTIONS,
+                                     settings.SSH_PRIVATE_KEY)
 
     def __str__(self):
         return self.id
@@ -191,19 +205,35 @@ class App(UuidAuditedModel):
     def url(self):
         return self.id + '.' + settings.DEIS_DOMAIN
 
-    def _get_job_id(self, container_type):
+    def _get_release(self):
+        """
+        Return the latest release along with its build and config, loaded in a single query.
+
+        Load it once per scale or deploy and pass it along, rather than looking it up again
+        for each process type or container.
+        """
+        return self.release_set.select_related('app', 'build', 'config').latest()
+
+    def _containers(self, *related):
+        """
+        Return the app's containers along with the release, build and config each of them
+        runs, so that they can be created or started without a query per container.
+        """
+        # select_related() replaces the relations selected before rather than adding to them
+        return self.container_set.select_related(
+            'app', 'release__app', 'release__build', 'release__config', *related)
+
+    def _get_job_id(self, container_type, release):
         app = self.id
-        release = self.release_set.latest()
         version = "v{}".format(release.version)
         job_id = "{app}_{version}.{container_type}".format(**locals())
         return job_id
 
-    def _get_command(self, container_type):
+    def _get_command(self, container_type, release):
         try:
             # if this is not procfile-based app, ensure they cannot break out
             # and run arbitrary commands on the host
             # FIXME: remove slugrunner's hardcoded entrypoint
-            release = self.release_set.latest()
             if release.build.dockerfile or not release.build.sha:
                 return "bash -c '{}'".format(release.build.procfile[container_type])
             else:
@@ -232,14 +262,14 @@ class App(UuidAuditedModel):
         """Delete this application including all containers"""
         try:
             # attempt to remove containers from the scheduler
-            self._destroy_containers([c for c in self.container_set.exclude(type='run')])
+            self._destroy_containers(list(self._containers().exclude(type='run')))
         except RuntimeError:
             pass
         self._clean_app_logs()
         return super(App, self).delete(*args, **kwargs)
 
     def restart(self, **kwargs):
-        to_restart = self.container_set.all()
+        to_restart = self._containers()
         if kwargs.get('type'):
             to_restart = to_restart.filter(type=kwargs.get('type'))
         if kwargs.get('num'):
@@ -260,10 +290,10 @@ class App(UuidAuditedModel):
 
     def scale(self, user, structure):  # noqa
         """Scale containers up or down to match requested structure."""
-        if self.release_set.latest().build is None:
+        release = self._get_release()
+        if release.build is None:
             raise EnvironmentError('No build associated with this release')
         requested_structure = structure.copy()
-        release = self.release_set.latest()
         # test for available process types
         available_process_types = release.build.procfile or {}
         for container_type in requested_structure:
@@ -282,7 +312,7 @@ class App(UuidAuditedModel):
 
         # iterate on a copy of the container_type keys
         for container_type in requested_structure.keys():
-            containers = list(self.container_set.filter(type=container_type).order_by('created'))
+            containers = list(self._containers().filter(type=container_type).order_by('created'))
             # increment new container nums off the most recent container
             results = self.container_set.filter(type=container_type).aggregate(Max('num'))
             container_num = (results.get('num__max') or 0) + 1
@@ -309,7 +339,7 @@ class App(UuidAuditedModel):
 
         if changed:
             if "scale" in dir(self._scheduler):
-                self._scale_containers(scale_types, to_remove)
+                self._scale_containers(scale_types, to_remove, release)
             else:
                 if to_add:
                     self._start_containers(to_add)
@@ -324,19 +354,19 @@ class App(UuidAuditedModel):
         self.save()
         return changed
 
-    def _scale_containers(self, scale_types, to_remove):
-        release = self.release_set.latest()
+    def _scale_containers(self, scale_types, to_remove, release):
         for scale_type in scale_types:
             image = release.image
             version = "v{}".format(release.version)
             kwargs = {'memory': release.config.memory,
                       'cpu': release.config.cpu,
                       'tags': release.config.tags,
+                      'env': release.env,
                       'version': version,
                       'aname': self.id,
                       'num': scale_types[scale_type]}
-            job_id = self._get_job_id(scale_type)
-            command = self._get_command(scale_type)
+            job_id = self._get_job_id(scale_type, release)
+            command = self._get_command(scale_type, release)
             try:
                 self._scheduler.scale(
                     name=job_id,
@@ -347,24 +377,38 @@ class App(UuidAuditedModel):
                 err = '{} (scale): {}'.format(job_id, e)
                 log_event(self, err, logging.ERROR)
                 raise
+            finally:
+                self._state_cache.invalidate_app(self.id)
         [c.delete() for c in to_remove]
 
+    def _get_container_states(self, containers):
+        """Return the state of each container, fetched from the scheduler in one batch."""
+        states = self._scheduler.states([c.job_id for c in containers])
+        self._state_cache.update(states)
+        return [states[c.job_id].name for c in containers]
+
+    def _run_containers(self, action, containers):
+        """
+        Call the given lifecycle method on each container using the shared worker pool.
+
+        Returns the finished tasks, which hold any exception raised for each container.
+        """
+        operation = current_operation()
+        funcs = [functools.partial(run_as, operation, getattr(c, action)) for c in containers]
+        return workers.lifecycle_pool().run_all(self.id, funcs)
+
     def _start_containers(self, to_add):
         """Creates and starts containers via the scheduler"""
         if not to_add:
             return
-        create_threads = [Thread(target=c.create) for c in to_add]
-        start_threads = [Thread(target=c.start) for c in to_add]
-        [t.start() for t in create_threads]
-        [t.join() for t in create_threads]
-        if any(c.state != 'created' for c in to_add):
+        self._run_containers('create', to_add)
+        if any(s != 'created' for s in self._get_container_states(to_add)):
             err = 'aborting, failed to create some containers'
             log_event(self, err, logging.ERROR)
             self._destroy_containers(to_add)
             raise RuntimeError(err)
-        [t.start() for t in start_threads]
-        [t.join() for t in start_threads]
-        if set([c.state for c in to_add]) != set(['up']):
+        self._run_containers('start', to_add)
+        if set(self._get_container_states(to_add)) != set(['up']):
             err = 'warning, some containers failed to start'
             log_event(self, err, logging.WARNING)
         # if the user specified a health check, try checking to see if it's running
@@ -378,16 +422,18 @@ class App(UuidAuditedModel):
     def _healthcheck(self, containers, config):
         # if at first it fails, back off and try again at 10%, 50% and 100% of INITIAL_DELAY
         intervals = [1.0, 0.1, 0.5, 1.0]
-        # HACK (bacongobbler): we need to wait until publisher has a chance to publish each
-        # service to etcd, which can take up to 20 seconds.
-        time.sleep(20)
+        to_healthcheck = [c for c in containers if c.type in ['web', 'cmd']]
+        # wait until publisher has a chance to publish each service to etcd
+        if _etcd_client:
+            healthcheck.wait_for_services(_etcd_client, self.id,
+                                          [c.job_id for c in to_healthcheck],
+                                          settings.HEALTHCHECK_REGISTRATION_TIMEOUT)
         for i in xrange(len(intervals)):
             delay = int(config.get('HEALTHCHECK_INITIAL_DELAY', 0))
             try:
                 # sleep until the initial timeout is over
                 if delay > 0:
                     time.sleep(delay * intervals[i])
-                to_healthcheck = [c for c in containers if c.type in ['web', 'cmd']]
                 self._do_healthcheck(to_healthcheck, config)
                 break
             except exceptions.HealthcheckException as e:
@@ -408,33 +454,26 @@ class App(UuidAuditedModel):
         timeout = int(config.get('HEALTHCHECK_TIMEOUT', 1))
         if not _etcd_client:
             raise exceptions.HealthcheckException('no etcd client available')
-        for container in containers:
-            try:
-                key = "/deis/services/{self}/{container.job_id}".format(**locals())
-                url = "http://{}{}".format(_etcd_client.get(key).value, path)
-                response = requests.get(url, timeout=timeout)
-                if response.status_code != requests.codes.OK:
-                    raise exceptions.HealthcheckException(
-                        "app failed health check (got '{}', expected: '200')".format(
-                            response.status_code))
-            except (requests.Timeout, requests.ConnectionError, KeyError) as e:
-                raise exceptions.HealthcheckException(
-                    'failed to connect to container ({})'.format(e))
+        results = healthcheck.check(_etcd_client, self.id, [c.job_id for c in containers],
+                                    path, timeout)
+        log_event(self, 'health check: {}'.format(', '.join(str(r) for r in results)))
+        failed = [r for r in results if not r.ok]
+        if len(failed) == 1:
+            raise exceptions.HealthcheckException(failed[0].error)
+        elif failed:
+            raise exceptions.HealthcheckException('{} ({} containers failed)'.format(
+                failed[0].error, len(failed)))
 
     def _restart_containers(self, to_restart):
         """Restarts containers via the scheduler"""
         if not to_restart:
             return
-        stop_threads = [Thread(target=c.stop) for c in to_restart]
-        start_threads = [Thread(target=c.start) for c in to_restart]
-        [t.start() for t in stop_threads]
-        [t.join() for t in stop_threads]
-        if any(c.state != 'created' for c in to_restart):
+        self._run_containers('stop', to_restart)
+        if any(s != 'created' for s in self._get_container_states(to_restart)):
             err = 'warning, some containers failed to stop'
             log_event(self, err, logging.WARNING)
-        [t.start() for t in start_threads]
-        [t.join() for t in start_threads]
-        if any(c.state != 'up' for c in to_restart):
+        self._run_containers('start', to_restart)
+        if any(s != 'up' for s in self._get_container_states(to_restart)):
             err = 'warning, some containers failed to start'
             log_event(self, err, logging.WARNING)
 
@@ -442,39 +481,68 @@ class App(UuidAuditedModel):
         """Destroys containers via the scheduler"""
         if not to_destroy:
             return
-        destroy_threads = [Thread(target=c.destroy) for c in to_destroy]
-        [t.start() for t in destroy_threads]
-        [t.join() for t in destroy_threads]
-        [c.delete() for c in to_destroy if c.state == 'destroyed']
-        if any(c.state != 'destroyed' for c in to_destroy):
+        self._run_containers('destroy', to_destroy)
+        states = self._get_container_states(to_destroy)
+        [c.delete() for c, s in zip(to_destroy, states) if s == 'destroyed']
+        if any(s != 'destroyed' for s in states):
             err = 'aborting, failed to destroy some containers'
             log_event(self, err, logging.ERROR)
             raise RuntimeError(err)
 
     def deploy(self, user, release):
         """Deploy a new release to this application"""
-        existing = self.container_set.exclude(type='run')
+        existing = self._containers('owner').exclude(type='run')
         new = []
         scale_types = set()
         for e in existing:
             n = e.clone(release)
-            n.save()
             new.append(n)
             scale_types.add(e.type)
 
         if new and "deploy" in dir(self._scheduler):
             self._deploy_app(scale_types, release, existing)
         else:
-            self._start_containers(new)
-
-            # destroy old containers
-            if existing:
-                self._destroy_containers(existing)
+            self._deploy_containers(new, list(existing), release)
 
         # perform default scaling if necessary
         if self.structure == {} and release.build is not None:
             self._default_scale(user, release)
 
+    def _deploy_containers(self, new, existing, release):
+        """
+        Replace the existing containers with their new clones in batches.
+
+        Each batch starts some new containers, which must pass the health check, then destroys
+        some of the old ones, as planned from the release's DEPLOY_MAX_SURGE and
+        DEPLOY_MAX_UNAVAILABLE. By default every new container is started before the old ones
+        are destroyed. If a batch fails, the new containers are destroyed and the old ones
+        destroyed so far are started again.
+        """
+        values = release.config.values
+        batches = scheduler.deploy_batches(
+            len(existing), values.get('DEPLOY_MAX_SURGE'), values.get('DEPLOY_MAX_UNAVAILABLE'),
+            default_surge='100%')
+        started = destroyed = 0
+        try:
+            for new_target, old_target in batches:
+                # a batch may only start new containers or only destroy old ones
+                if new_target > started:
+                    self._start_containers(new[started:new_target])
+                    started = new_target
+                if len(existing) - old_target > destroyed:
+                    self._destroy_containers(existing[destroyed:len(existing) - old_target])
+                    destroyed = len(existing) - old_target
+                if len(batches) > 1:
+                    log_event(self, 'deployed {} of {} containers'.format(started, len(new)))
+        except Exception:
+            log_event(self, 'rolling back deploy of v{}'.format(release.version), logging.ERROR)
+            try:
+                self._destroy_containers(new[:started])
+                self._start_containers([c.clone(c.release) for c in existing[:destroyed]])
+            except Exception as e:
+                log_event(self, 'failed to roll back deploy: {}'.format(e), logging.ERROR)
+            raise
+
     def _deploy_app(self, scale_types, release, existing):
         for scale_type in scale_types:
             image = release.image
@@ -482,11 +550,14 @@ class App(UuidAuditedModel):
             kwargs = {'memory': release.config.memory,
                       'cpu': release.config.cpu,
                       'tags': release.config.tags,
+                      'env': release.env,
                       'aname': self.id,
                       'num': 0,
-                      'version': version}
-            job_id = self._get_job_id(scale_type)
-            command = self._get_command(scale_type)
+                      'version': version,
+                      'max_surge': release.config.values.get('DEPLOY_MAX_SURGE'),
+                      'max_unavailable': release.config.values.get('DEPLOY_MAX_UNAVAILABLE')}
+            job_id = self._get_job_id(scale_type, release)
+            command = self._get_command(scale_type, release)
             try:
                 self._scheduler.deploy(
                     name=job_id,
@@ -497,6 +568,8 @@ class App(UuidAuditedModel):
                 err = '{} (deploy): {}'.format(job_id, e)
                 log_event(self, err, logging.ERROR)
                 raise
+            finally:
+                self._state_cache.invalidate_app(self.id)
         [c.delete() for c in existing]
 
     def _default_scale(self, user, release):
@@ -519,34 +592,39 @@ class App(UuidAuditedModel):
 
         self.scale(user, structure)
 
-    def logs(self, log_lines=str(settings.LOG_LINES)):
+    def logs(self, log_lines=str(settings.LOG_LINES), process_type=None):
         """Return aggregated log data for this application."""
-        try:
-            url = "http://{}:{}/{}?log_lines={}".format(settings.LOGGER_HOST, settings.LOGGER_PORT,
-                                                        self.id, log_lines)
-            r = requests.get(url)
-        # Handle HTTP request errors
-        except requests.exceptions.RequestException as e:
-            logger.error("Error accessing deis-logger using url '{}': {}".format(url, e))
-            raise e
-        # Handle logs empty or not found
-        if r.status_code == 204 or r.status_code == 404:
-            logger.info("GET {} returned a {} status code".format(url, r.status_code))
-            raise EnvironmentError('Could not locate logs')
-        # Handle unanticipated status codes
-        if r.status_code != 200:
-            logger.error("Error accessing deis-logger: GET {} returned a {} status code"
-                         .format(url, r.status_code))
-            raise EnvironmentError('Error accessing deis-logger')
-        return r.content
+        content = logs.fetch(self.id, log_lines).content
+        if process_type is None:
+            return content
+        return b''.join(line for line in content.splitlines(True)
+                        if logs.matches(line, process_type))
+
+    def stream_logs(self, log_lines=str(settings.LOG_LINES), process_type=None, follow=False):
+        """Return an iterator over the log lines of this application as they are read."""
+        return logs.stream(self.id, log_lines, process_type, follow)
 
     def run(self, user, command):
         """Run a one-off command in an ephemeral app container."""
+        c, escaped_command = self._run_container(user, command)
+        return c.run(escaped_command)
+
+    def run_stream(self, user, command):
+        """
+        Run a one-off command in an ephemeral app container, yielding its output as it is
+        written and then its exit code.
+        """
+        c, escaped_command = self._run_container(user, command)
+        return c.run_stream(escaped_command)
+
+    def _run_container(self, user, command):
+        """Create the container for a one-off command, and return it with the escaped command."""
         # FIXME: remove the need for SSH private keys by using
         # a scheduler that supports one-off admin tasks natively
         if not settings.SSH_PRIVATE_KEY:
             raise EnvironmentError('Support for admin commands is not configured')
-        if self.release_set.latest().build is None:
+        release = self._get_release()
+        if release.build is None:
             raise EnvironmentError('No build associated with this release to run this command')
         # TODO: add support for interactive shell
         msg = "{} runs '{}'".format(user.username, command)
@@ -556,7 +634,7 @@ class App(UuidAuditedModel):
         # create database record for run process
         c = Container.objects.create(owner=self.owner,
                                      app=self,
-                                     release=self.release_set.latest(),
+                                     release=release,
                                      type='run',
                                      num=c_num)
         image = c.release.image
@@ -572,7 +650,7 @@ class App(UuidAuditedModel):
                                       image)
         # SECURITY: shell-escape user input
         escaped_command = command.replace("'", "'\\''")
-        return c.run(escaped_command)
+        return c, escaped_command
 
 
 @python_2_unicode_compatible
@@ -593,7 +671,8 @@ class Container(UuidAuditedModel):
 
     @property
     def state(self):
-        return self._scheduler.state(self.job_id).name
+        state, updated = self.app._state_cache.get(self.job_id)
+        return state.name
 
     def short_name(self):
         return "{}.{}.{}".format(self.app.id, self.type, self.num)
@@ -640,7 +719,8 @@ class Container(UuidAuditedModel):
         image = self.release.image
         kwargs = {'memory': self.release.config.memory,
                   'cpu': self.release.config.cpu,
-                  'tags': self.release.config.tags}
+                  'tags': self.release.config.tags,
+                  'env': self.release.env}
         try:
             self._scheduler.create(
                 name=self.job_id,
@@ -651,6 +731,8 @@ class Container(UuidAuditedModel):
             err = '{} (create): {}'.format(self.job_id, e)
             log_event(self.app, err, logging.ERROR)
             raise
+        finally:
+            self.app._state_cache.invalidate([self.job_id])
 
     @close_db_connections
     def start(self):
@@ -660,6 +742,8 @@ class Container(UuidAuditedModel):
             err = '{} (start): {}'.format(self.job_id, e)
             log_event(self.app, err, logging.WARNING)
             raise
+        finally:
+            self.app._state_cache.invalidate([self.job_id])
 
     @close_db_connections
     def stop(self):
@@ -669,6 +753,8 @@ class Container(UuidAuditedModel):
             err = '{} (stop): {}'.format(self.job_id, e)
             log_event(self.app, err, logging.ERROR)
             raise
+        finally:
+            self.app._state_cache.invalidate([self.job_id])
 
     @close_db_connections
     def destroy(self):
@@ -678,9 +764,37 @@ class Container(UuidAuditedModel):
             err = '{} (destroy): {}'.format(self.job_id, e)
             log_event(self.app, err, logging.ERROR)
             raise
+        finally:
+            self.app._state_cache.invalidate([self.job_id])
 
     def run(self, command):
         """Run a one-off command"""
+        try:
+            rc, output = self._scheduler.run(self.job_id, *self._run_args(command),
+                                             env=self.release.env)
+            return rc, output
+        except Exception as e:
+            err = '{} (run): {}'.format(self.job_id, e)
+            log_event(self.app, err, logging.ERROR)
+            raise
+
+    def run_stream(self, command):
+        """Run a one-off command, yielding its output as it is written and then its exit code"""
+        return self._stream_run(self._scheduler.run_stream(self.job_id,
+                                                           *self._run_args(command),
+                                                           env=self.release.env))
+
+    def _stream_run(self, stream):
+        try:
+            for chunk in stream:
+                yield chunk
+        except Exception as e:
+            err = '{} (run): {}'.format(self.job_id, e)
+            log_event(self.app, err, logging.ERROR)
+            raise
+
+    def _run_args(self, command):
+        """Return the image, entrypoint and command which run a one-off command."""
         if self.release.build is None:
             raise EnvironmentError('No build associated with this release '
                                    'to run this command')
@@ -695,13 +809,7 @@ class Container(UuidAuditedModel):
             command = "'{}'".format(command)
         else:
             command = "-c '{}'".format(command)
-        try:
-            rc, output = self._scheduler.run(self.job_id, image, entrypoint, command)
-            return rc, output
-        except Exception as e:
-            err = '{} (run): {}'.format(self.job_id, e)
-            log_event(self.app, err, logging.ERROR)
-            raise
+        return image, entrypoint, command
 
 
 @python_2_unicode_compatible
@@ -750,7 +858,7 @@ class Build(UuidAuditedModel):
         unique_together = (('app', 'uuid'),)
 
     def create(self, user, *args, **kwargs):
-        latest_release = self.app.release_set.latest()
+        latest_release = self.app._get_release()
         source_version = 'latest'
         if self.sha:
             source_version = 'git-{}'.format(self.sha)
@@ -771,7 +879,7 @@ class Build(UuidAuditedModel):
             to_destroy = []
             for proctype in previous_build.procfile:
                 if proctype not in self.procfile:
-                    for c in self.app.container_set.filter(type=proctype):
+                    for c in self.app._containers().filter(type=proctype):
                         to_destroy.append(c)
             self.app._destroy_containers(to_destroy)
         except Build.DoesNotExist:
@@ -843,6 +951,11 @@ class Release(UuidAuditedModel):
 
     config = models.ForeignKey('Config')
     build = models.ForeignKey('Build', null=True)
+    # identifies the source image and config the release's image was published from
+    image_key = models.CharField(max_length=64, blank=True, db_index=True)
+    # whether the config is passed to containers when they are created rather than built into
+    # the release's image
+    runtime_config = models.BooleanField(default=False)
 
     class Meta:
         get_latest_by = 'created'
@@ -856,6 +969,15 @@ class Release(UuidAuditedModel):
     def image(self):
         return '{}:v{}'.format(self.app.id, str(self.version))
 
+    @property
+    def env(self):
+        """The environment variables passed to the release's containers when they are created."""
+        # the image of an earlier release with the same build and config may be reused, so the
+        # release a container runs is always passed on rather than read from its image
+        env = dict(self.config.values) if self.runtime_config else {}
+        env.update({'DEIS_APP': self.app.id, 'DEIS_RELEASE': 'v{}'.format(self.version)})
+        return env
+
     def new(self, user, config, build, summary=None, source_version='latest'):
         """
         Create a new application release using the provided Build and Config
@@ -868,7 +990,8 @@ class Release(UuidAuditedModel):
         # create new release and auto-increment version
         release = Release.objects.create(
             owner=user, app=self.app, config=config,
-            build=build, version=new_version, summary=summary)
+            build=build, version=new_version, summary=summary,
+            runtime_config=settings.RUNTIME_CONFIG)
         try:
             release.publish()
         except EnvironmentError as e:
@@ -886,7 +1009,19 @@ class Release(UuidAuditedModel):
             source_image = "{}:{}".format(source_image, source_tag)
         # If the build has a SHA, assume it's from deis-builder and in the deis-registry already
         deis_registry = bool(self.build.sha)
-        publish_release(source_image, self.config.values, self.image, deis_registry)
+        # report progress to the client if this happens as part of a background operation
+        operation = current_operation()
+        key = publish_release(source_image, self.config.values, self.image, deis_registry,
+                              self._published_image, not self.runtime_config,
+                              operation.report_publish if operation else None)
+        if key:
+            self.image_key = key
+            self.save(update_fields=['image_key'])
+
+    def _published_image(self, key):
+        """Return the image of an earlier release with the same source image and config."""
+        release = self.app.release_set.filter(image_key=key).exclude(pk=self.pk).first()
+        return release.image if release else None
 
     def previous(self):
         """
@@ -1054,6 +1189,249 @@ class Key(UuidAuditedModel):
         return super(Key, self).save(*args, **kwargs)
 
 
+# the operation each thread is working on, if any
+_current = threading.local()
+
+
+def current_operation():
+    """Return the operation the calling thread is working on, or None."""
+    return getattr(_current, 'operation', None)
+
+
+def run_as(operation, func, *args):
+    """Call func(*args) as part of an operation, so that it reports progress to it."""
+    previous, _current.operation = current_operation(), operation
+    try:
+        return func(*args)
+    finally:
+        _current.operation = previous
+
+
+# operations this process has queued or is running, whose leases it renews
+_held = set()
+_held_lock = threading.Lock()
+_heartbeat_thread = None
+
+
+def _hold(operation):
+    """Renew the lease of an operation until it is released."""
+    global _heartbeat_thread
+    with _held_lock:
+        _held.add(operation.pk)
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(target=_heartbeat)
+            _heartbeat_thread.daemon = True
+            _heartbeat_thread.start()
+
+
+def _release(operation):
+    with _held_lock:
+        _held.discard(operation.pk)
+
+
+@close_db_connections
+def _heartbeat():
+    """Renew the leases of the operations held by this process, and exit once there are none."""
+    global _heartbeat_thread
+    while True:
+        time.sleep(settings.OPERATION_HEARTBEAT_INTERVAL)
+        with _held_lock:
+            held = list(_held)
+            if not held:
+                _heartbeat_thread = None
+                return
+        try:
+            Operation.objects.filter(
+                pk__in=held, state__in=(Operation.PENDING, Operation.RUNNING)).update(
+                updated=timezone.now())
+        except Exception as e:
+            logger.warning('could not renew the leases of operations: {}'.format(e))
+
+
+@python_2_unicode_compatible
+class Operation(UuidAuditedModel):
+    """
+    A long-running change to an application, such as a scale or a deploy, performed in the
+    background so that the client can poll for its progress, or while the client waits.
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL)
+    app = models.ForeignKey('App')
+    type = models.CharField(max_length=32)
+    state = models.CharField(max_length=32, default=PENDING)
+    progress = JSONField(default=[], blank=True)
+    # how far publishing a release's image has got, as reported by Docker
+    publish_progress = JSONField(default={}, blank=True)
+    result = JSONField(default={}, blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        get_latest_by = 'created'
+        ordering = ['-created']
+        unique_together = (('app', 'uuid'),)
+
+    def __str__(self):
+        return "{}-{}".format(self.app.id, self.uuid[:7])
+
+    def submit(self, func, *args):
+        """
+        Queue func(*args) to run as this operation on the operations worker pool.
+
+        Operations on the same application run one at a time, in the order they were submitted.
+        If too many operations are already queued, the operation is deleted and
+        :class:`~api.workers.PoolFull` is raised.
+        """
+        self._lock = threading.Lock()
+        _hold(self)
+        try:
+            workers.operations_pool().try_submit(self.app.id, self._run, func, args)
+        except workers.PoolFull:
+            _release(self)
+            self.delete()
+            raise
+
+    def log(self, message):
+        """Append a progress message to this operation."""
+        with self._lock:
+            self.progress.append("{}".format(message))
+            self.save(update_fields=['progress', 'updated'])
+
+    def report_publish(self, progress):
+        """Record how far publishing a release's image has got."""
+        with self._lock:
+            self.publish_progress = progress
+            self.save(update_fields=['publish_progress', 'updated'])
+
+    @classmethod
+    def fail_orphaned(cls):
+        """
+        Mark the operations left pending or running by a controller which stopped as failed,
+        so that they no longer hold up the other operations on their app.
+
+        Operations whose lease was renewed within OPERATION_LEASE seconds are held by a
+        controller process which is still running, and are left alone.
+
+        :return: the number of operations marked as failed
+        """
+        expired = timezone.now() - timedelta(seconds=settings.OPERATION_LEASE)
+        return cls.objects.filter(
+            state__in=(cls.PENDING, cls.RUNNING), updated__lt=expired).update(
+            state=cls.FAILED, error='The controller stopped before the operation finished',
+            updated=timezone.now())
+
+    @classmethod
+    def prune(cls):
+        """
+        Delete the operations which finished more than OPERATION_RETENTION_DAYS days ago.
+
+        :return: the number of operations deleted
+        """
+        finished = cls.objects.filter(
+            state__in=(cls.SUCCEEDED, cls.FAILED),
+            updated__lt=timezone.now() - timedelta(days=settings.OPERATION_RETENTION_DAYS))
+        count = finished.count()
+        finished.delete()
+        return count
+
+    def perform(self, func, *args):
+        """
+        Run func(*args) as this operation in the calling thread, once no other operation on its
+        app is running, and return what it returns.
+
+        How the operation ended is recorded on it, and any error raised by func is re-raised.
+
+        :raises RuntimeError: if the operation could not start
+        """
+        if not hasattr(self, '_lock'):
+            self._lock = threading.Lock()
+        _hold(self)
+        try:
+            return self._perform(func, args)
+        finally:
+            _release(self)
+
+    def _perform(self, func, args):
+        if not self._claim():
+            raise RuntimeError(self.error or 'The operation was cancelled before it started')
+        self.state = self.RUNNING
+        try:
+            ret = run_as(self, func, *args)
+            self.state = self.SUCCEEDED
+            return ret
+        except Exception as e:
+            if not isinstance(e, (EnvironmentError, RuntimeError)):
+                logger.exception('{}: operation {} failed'.format(self.app.id, self.uuid))
+            self.state = self.FAILED
+            self.error = "{}".format(e)
+            raise
+        finally:
+            with self._lock:
+                self.result = self._get_result()
+                self.save(update_fields=['state', 'error', 'result', 'updated'])
+
+    @close_db_connections
+    def _run(self, func, args):
+        try:
+            self.perform(func, *args)
+        except Exception:
+            # perform() recorded the error on the operation for the client to poll
+            pass
+
+    def _claim(self):
+        """
+        Mark this operation as running once no other operation on its app is, whichever
+        controller process runs them.
+
+        A running operation whose lease was not renewed within OPERATION_LEASE seconds was left
+        behind by a controller process which stopped, and is marked as failed. If the app is
+        still busy after OPERATION_WAIT_TIMEOUT seconds this operation is marked as failed.
+
+        :return: False if the operation is no longer pending
+        """
+        deadline = time.time() + settings.OPERATION_WAIT_TIMEOUT
+        while True:
+            with transaction.atomic():
+                # operations on the same app are claimed one at a time while its row is locked
+                App.objects.select_for_update().get(pk=self.app_id)
+                running = Operation.objects.filter(app=self.app_id, state=self.RUNNING)
+                expired = timezone.now() - timedelta(seconds=settings.OPERATION_LEASE)
+                running.filter(updated__lt=expired).update(
+                    state=self.FAILED, updated=timezone.now(),
+                    error='The controller stopped before the operation finished')
+                if not running.exists():
+                    return Operation.objects.filter(pk=self.pk, state=self.PENDING).update(
+                        state=self.RUNNING, updated=timezone.now()) == 1
+            if time.time() >= deadline:
+                self.state = self.FAILED
+                self.error = 'Timed out waiting for another operation on {} to finish'.format(
+                    self.app_id)
+                Operation.objects.filter(pk=self.pk, state=self.PENDING).update(
+                    state=self.state, error=self.error, updated=timezone.now())
+                return False
+            time.sleep(settings.OPERATION_WAIT_INTERVAL)
+
+    def _get_result(self):
+        """Report the application's release and the state of each of its containers."""
+        result = {}
+        try:
+            result['release'] = "v{}".format(self.app.release_set.latest().version)
+        except Release.DoesNotExist:
+            pass
+        containers = list(self.app.container_set.exclude(type='run').select_related('release'))
+        try:
+            states = self.app._get_container_states(containers)
+        except Exception as e:
+            logger.warning('{}: could not fetch container states: {}'.format(self.app.id, e))
+        else:
+            result['containers'] = {c.short_name(): state for c, state in zip(containers, states)}
+        return result
+
+
 # define update/delete callbacks for synchronizing
 # models with the configuration management backend
 
@@ -1162,20 +1540,10 @@ def _etcd_purge_cert(**kwargs):
 
 def _etcd_publish_config(**kwargs):
     config = kwargs['instance']
-    # we purge all existing config when adding the newest instance. This is because
-    # deis config:unset would remove an existing value, but not delete the
-    # old config object
-    try:
-        _etcd_client.delete('/deis/config/{}'.format(config.app),
-                            prevExist=True, dir=True, recursive=True)
-    except KeyError:
-        pass
-    for k, v in config.values.iteritems():
-        _etcd_client.write(
-            '/deis/config/{}/{}'.format(
-                config.app,
-                unicode(k).encode('utf-8').lower()),
-            unicode(v).encode('utf-8'))
+    # only write the keys that changed; keys which are not part of the newest config are
+    # removed, since deis config:unset removes a value but does not delete the old config object
+    etcd_sync.sync_values(_etcd_client, '/deis/config/{}'.format(config.app),
+                          etcd_sync.config_values(config))
 
 
 def _etcd_purge_config(**kwargs):
@@ -241,6 +241,7 @@ class ReleaseSerializer(ModelSerializer):
     class Meta:
         """Metadata options for a :class:`ReleaseSerializer`."""
         model = models.Release
+        exclude = ('image_key', 'runtime_config')
 
 
 class ContainerSerializer(ModelSerializer):
@@ -251,6 +252,7 @@ class ContainerSerializer(ModelSerializer):
     created = serializers.DateTimeField(format=settings.DEIS_DATETIME_FORMAT, read_only=True)
     updated = serializers.DateTimeField(format=settings.DEIS_DATETIME_FORMAT, read_only=True)
     release = serializers.SerializerMethodField()
+    state = serializers.SerializerMethodField()
 
     class Meta:
         """Metadata options for a :class:`ContainerSerializer`."""
@@ -260,6 +262,35 @@ class ContainerSerializer(ModelSerializer):
     def get_release(self, obj):
         return "v{}".format(obj.release.version)
 
+    def get_state(self, obj):
+        # use the states the view looked up for every container at once, if any
+        states = self.context.get('states')
+        if states is None:
+            return obj.state
+        if obj.job_id in states:
+            state, updated = states[obj.job_id]
+            return state.name
+        return 'unknown'
+
+
+class OperationSerializer(ModelSerializer):
+    """Serialize a :class:`~api.models.Operation` model."""
+
+    app = serializers.SlugRelatedField(slug_field='id', read_only=True)
+    owner = serializers.ReadOnlyField(source='owner.username')
+    progress = JSONFieldSerializer(read_only=True)
+    publish_progress = JSONFieldSerializer(read_only=True)
+    result = JSONFieldSerializer(read_only=True)
+    created = serializers.DateTimeField(format=settings.DEIS_DATETIME_FORMAT, read_only=True)
+    updated = serializers.DateTimeField(format=settings.DEIS_DATETIME_FORMAT, read_only=True)
+
+    class Meta:
+        """Metadata options for a :class:`OperationSerializer`."""
+        model = models.Operation
+        fields = ['owner', 'app', 'type', 'state', 'progress', 'publish_progress', 'result',
+                  'error', 'created', 'updated', 'uuid']
+        read_only_fields = ['type', 'state', 'error']
+
 
 class KeySerializer(ModelSerializer):
     """Serialize a :class:`~api.models.Key` model."""
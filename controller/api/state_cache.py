@@ -0,0 +1,146 @@
+"""
+A cache of the state of each container's job, kept fresh in the background.
+"""
+
+from __future__ import unicode_literals
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+import scheduler
+
+
+logger = logging.getLogger(__name__)
+
+
+class Entry(object):
+    """The last known state of a job."""
+
+    def __init__(self, state, updated):
+        self.state = state
+        # when the scheduler reported the state
+        self.updated = updated
+        # when the state was last asked for
+        self.read = updated
+
+
+class StateCache(object):
+    """
+    The state of the jobs of a single scheduler configuration.
+
+    A state is served from the cache while it is younger than STATE_CACHE_MAX_AGE seconds, and
+    every stale one is fetched from the scheduler in a single states() call otherwise. Once a
+    job is cached, a background thread asks the scheduler for the state of every cached job
+    each STATE_CACHE_INTERVAL seconds, until nobody has asked for it in STATE_CACHE_IDLE
+    seconds. A job's state is forgotten whenever the controller changes it.
+    """
+
+    def __init__(self, get_client):
+        # returns the calling thread's scheduler client
+        self.get_client = get_client
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def get(self, name):
+        """Return the state of a job and the time it was reported."""
+        return self.get_many([name])[name]
+
+    def get_many(self, names):
+        """Return the (state, updated) of each job, keyed by name."""
+        now = time.time()
+        result = {}
+        with self._lock:
+            for name in names:
+                entry = self._entries.get(name)
+                if entry is not None and now - entry.updated < settings.STATE_CACHE_MAX_AGE:
+                    entry.read = now
+                    result[name] = (entry.state, entry.updated)
+        stale = [name for name in names if name not in result]
+        if stale:
+            states = self.get_client().states(stale)
+            updated = self.update(states)
+            result.update({name: (states[name], updated) for name in stale})
+        return result
+
+    def peek_many(self, names):
+        """
+        Return the (state, updated) of each job which is cached, however old, keyed by name,
+        without asking the scheduler.
+        """
+        with self._lock:
+            return {name: (self._entries[name].state, self._entries[name].updated)
+                    for name in names if name in self._entries}
+
+    def update(self, states, since=None):
+        """
+        Record the states the scheduler just reported, keyed by job name.
+
+        With since, only the jobs which are still cached and have not been updated after that
+        time are recorded, so that a slow poll does not bring back what was forgotten.
+        """
+        now = time.time()
+        with self._lock:
+            for name, state in states.items():
+                entry = self._entries.get(name)
+                if since is not None and (entry is None or entry.updated > since):
+                    continue
+                if entry is None:
+                    self._entries[name] = Entry(state, now)
+                else:
+                    entry.state, entry.updated = state, now
+            if self._entries and self._thread is None and settings.STATE_CACHE_INTERVAL:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        return now
+
+    def invalidate(self, names):
+        """Forget the state of the given jobs."""
+        with self._lock:
+            for name in names:
+                self._entries.pop(name, None)
+
+    def invalidate_app(self, app_id):
+        """Forget the state of every job of an application."""
+        prefix = '{}_'.format(app_id)
+        with self._lock:
+            for name in [name for name in self._entries if name.startswith(prefix)]:
+                del self._entries[name]
+
+    def _run(self):
+        while True:
+            time.sleep(settings.STATE_CACHE_INTERVAL)
+            started = time.time()
+            with self._lock:
+                for name, entry in self._entries.items():
+                    if started - entry.read > settings.STATE_CACHE_IDLE:
+                        del self._entries[name]
+                names = list(self._entries)
+                if not names:
+                    self._thread = None
+                    return
+            try:
+                self.update(self.get_client().states(names), since=started)
+            except Exception as e:
+                logger.warning('failed to refresh container states: {}'.format(e))
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(module, target, auth, options, pkey):
+    """Return the state cache for the given scheduler module and connection settings."""
+    args = (module, target, auth, options, pkey)
+    key = (module, target, auth, json.dumps(options, sort_keys=True, default=str), pkey)
+    cache = _caches.get(key)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(key)
+            if cache is None:
+                cache = _caches[key] = StateCache(lambda: scheduler.get_client(*args))
+    return cache
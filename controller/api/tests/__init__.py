@@ -57,10 +57,19 @@ from .test_certificate import *  # noqa
 from .test_config import *  # noqa
 from .test_container import *  # noqa
 from .test_domain import *  # noqa
+from .test_etcd_sync import *  # noqa
+from .test_fleet import *  # noqa
 from .test_hooks import *  # noqa
+from .test_image_gc import *  # noqa
+from .test_k8s import *  # noqa
 from .test_key import *  # noqa
 from .test_limits import *  # noqa
+from .test_operation import *  # noqa
 from .test_perm import *  # noqa
+from .test_queries import *  # noqa
 from .test_release import *  # noqa
 from .test_scheduler import *  # noqa
+from .test_state_cache import *  # noqa
+from .test_swarm import *  # noqa
 from .test_users import *  # noqa
+from .test_workers import *  # noqa
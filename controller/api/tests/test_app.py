@@ -16,7 +16,8 @@ from django.contrib.auth.models import User
 from django.test import TestCase
 from rest_framework.authtoken.models import Token
 
-from api.models import App
+from api import logs
+from api.models import App, Build, Release
 from . import mock_status_ok
 
 
@@ -89,7 +90,7 @@ class AppTest(TestCase):
         self.assertContains(response, 'This field must be unique.', status_code=400)
         return response
 
-    @mock.patch('requests.get')
+    @mock.patch('api.logs.session.get')
     def test_app_actions(self, mock_get):
         url = '/v1/apps'
         body = {'id': 'autotest'}
@@ -134,6 +135,72 @@ class AppTest(TestCase):
 
         # TODO: test run needs an initial build
 
+    @mock.patch('api.logs.session.get')
+    def test_app_logs_stream(self, mock_get):
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        lines = [b'2015-06-10T18:08:08UTC autotest[web.1]: GET /',
+                 b'2015-06-10T18:08:09UTC autotest[worker.1]: working',
+                 b'2015-06-10T18:08:10UTC autotest[web.2]: GET /about']
+        mock_response = mock.Mock()
+        mock_response.status_code = 200
+        mock_response.content = b'\n'.join(lines) + b'\n'
+        mock_response.iter_lines.side_effect = lambda chunk_size: iter(lines)
+        mock_get.return_value = mock_response
+        url = "/v1/apps/{app_id}/logs".format(**locals())
+        response = self.client.get(url, {'stream': 'true', 'log_lines': 3},
+                                   HTTP_AUTHORIZATION="token {}".format(self.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content), b'\n'.join(lines) + b'\n')
+        self.assertTrue(mock_get.call_args[1]['stream'])
+        self.assertTrue(mock_response.close.called)
+        # only the lines of a process type
+        response = self.client.get(url, {'stream': 'true', 'process_type': 'web'},
+                                   HTTP_AUTHORIZATION="token {}".format(self.token))
+        self.assertEqual(b''.join(response.streaming_content),
+                         lines[0] + b'\n' + lines[2] + b'\n')
+        response = self.client.get(url, {'process_type': 'worker'},
+                                   HTTP_AUTHORIZATION="token {}".format(self.token))
+        self.assertEqual(response.data, lines[1] + b'\n')
+        # errors are reported before anything is streamed
+        mock_response.status_code = 204
+        response = self.client.get(url, {'stream': 'true'},
+                                   HTTP_AUTHORIZATION="token {}".format(self.token))
+        self.assertEqual(response.status_code, 204)
+
+    def test_app_logs_follow(self):
+        lines = [b'2015-06-10T18:08:0{}UTC autotest[web.1]: {}'.format(i, i) for i in range(5)]
+        first, later = mock.Mock(status_code=200), mock.Mock(status_code=200)
+        first.iter_lines.return_value = iter(lines[:3])
+        later.content = b'\n'.join(lines[1:]) + b'\n'
+        responses = [first]
+
+        def get(*args, **kwargs):
+            return responses.pop() if responses else later
+
+        with mock.patch('api.logs.session.get', side_effect=get), \
+                self.settings(LOG_FOLLOW_INTERVAL=0.01, LOG_FOLLOW_TIMEOUT=0.1):
+            streamed = list(logs.stream('autotest', 3, follow=True))
+        # lines logged since the first read are passed on once
+        self.assertEqual(streamed, [line + b'\n' for line in lines])
+
+    def test_app_logs_follow_cursor(self):
+        same = b'2015-06-10T18:08:01UTC autotest[web.1]: GET /'
+        read = [b'2015-06-10T18:08:00UTC autotest[web.1]: start', same, same]
+        cursor = None
+        for line in read:
+            cursor = logs._advance(cursor, line)
+        self.assertEqual(cursor, (b'2015-06-10T18:08:01UTC', 2))
+        # a repeated line is only passed on as often as it was logged after the cursor
+        self.assertEqual(logs._after(read + [same, same], cursor), [same, same])
+        # lines which scrolled out of the window are not needed to find the new ones
+        later = [b'2015-06-10T18:08:0{}UTC autotest[web.1]: {}'.format(i, i) for i in (5, 6)]
+        self.assertEqual(logs._after(later, cursor), later)
+        self.assertEqual(logs._after(read, None), read)
+
     @mock.patch('api.models.logger')
     def test_app_release_notes_in_logs(self, mock_logger):
         """Verifies that an app's release summary is dumped into the logs."""
@@ -282,6 +349,46 @@ class AppTest(TestCase):
         self.assertEqual(response.data, {'detail': 'No build associated with this '
                                                    'release to run this command'})
 
+    def test_run_stream(self):
+        """Test that the output of a one-off command can be streamed as it is written"""
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app = App.objects.get(id=response.data['id'])
+        build = Build.objects.create(owner=self.user, app=app, image='autotest/example')
+        Release.objects.create(version=2, owner=self.user, app=app,
+                               config=app.config_set.latest(), build=build)
+        url = '/v1/apps/{}/run?stream=true'.format(app.id)
+        body = {'command': 'ls -al'}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-json-stream')
+        events = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(events), 2)
+        self.assertEqual(json.loads(events[0]['output'])['command'], "-c 'ls -al'")
+        self.assertEqual(events[1], {'rc': 0})
+        # errors raised by the scheduler before the command starts get an error status
+        with mock.patch('scheduler.mock.MockSchedulerClient.run') as run:
+            run.side_effect = RuntimeError('container failed to start')
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.data, {'detail': 'container failed to start'})
+
+        # errors raised once streaming has begun end the stream
+        def run_stream(*args, **kwargs):
+            yield b'hi\n'
+            raise RuntimeError('lost the connection to the host')
+        with mock.patch('scheduler.mock.MockSchedulerClient.run_stream', run_stream):
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 200)
+            events = [json.loads(line)
+                      for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(events, [{'output': 'hi\n'},
+                                  {'detail': 'lost the connection to the host'}])
+
     def test_unauthorized_user_cannot_see_app(self):
         """
         An unauthorized user should not be able to access an app's resources.
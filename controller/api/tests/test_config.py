@@ -11,6 +11,7 @@ import json
 import logging
 import requests
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.test import TransactionTestCase
 import etcd
@@ -45,6 +46,35 @@ class MockEtcdClient:
         }
         return etcd.EtcdResult(None, node)
 
+    def read(self, key, *args, **kwargs):
+        # every container of the app is registered as soon as it has been created
+        nodes = [{'key': '{}/{}'.format(key, c.job_id), 'value': '127.0.0.1:1234'}
+                 for c in self.app.container_set.all()]
+        return etcd.EtcdResult(None, {'key': key, 'dir': True, 'nodes': nodes})
+
+
+class MockEtcdDirectory:
+    """An etcd client which keeps the keys of a single directory in memory."""
+
+    def __init__(self):
+        self.values = {}
+        self.writes = []
+        self.deletes = []
+
+    def read(self, key, *args, **kwargs):
+        nodes = [{'key': k, 'value': v} for k, v in self.values.items()]
+        return etcd.EtcdResult(None, {'key': key, 'dir': True, 'nodes': nodes})
+
+    def write(self, key, value, *args, **kwargs):
+        self.writes.append(key)
+        self.values[key] = value.decode('utf-8')
+
+    def delete(self, key, *args, **kwargs):
+        if kwargs.get('dir'):
+            raise AssertionError('the config directory should never be deleted')
+        self.deletes.append(key)
+        del self.values[key]
+
 
 @mock.patch('api.models.publish_release', lambda *args: None)
 class ConfigTest(TransactionTestCase):
@@ -571,6 +601,31 @@ class ConfigTest(TransactionTestCase):
                                     HTTP_AUTHORIZATION='token {}'.format(unauthorized_token))
         self.assertEqual(response.status_code, 403)
 
+    @mock.patch('requests.post', mock_status_ok)
+    def test_config_publish(self):
+        """
+        Only the config keys which were added, changed or removed are written to etcd.
+        """
+        client = MockEtcdDirectory()
+        path = '/deis/config/{}'.format(self.app)
+        url = '/v1/apps/{}/config'.format(self.app)
+        with mock.patch('api.models._etcd_client', client):
+            body = {'values': json.dumps({'NEW_URL1': 'http://localhost:8080/', 'TEST': 'a'})}
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 201)
+            api.models._etcd_publish_config(instance=self.app.config_set.latest())
+            self.assertEqual(sorted(client.writes), [path + '/new_url1', path + '/test'])
+            client.writes = []
+            body = {'values': json.dumps({'NEW_URL1': None, 'TEST': 'b', 'OTHER': 'c'})}
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 201)
+            api.models._etcd_publish_config(instance=self.app.config_set.latest())
+        self.assertEqual(sorted(client.writes), [path + '/other', path + '/test'])
+        self.assertEqual(client.deletes, [path + '/new_url1'])
+        self.assertEqual(client.values, {path + '/test': 'b', path + '/other': 'c'})
+
     def _test_app_healthcheck(self):
         # post a new build, expecting it to pass as usual
         url = "/v1/apps/{self.app}/builds".format(**locals())
@@ -586,7 +641,7 @@ class ConfigTest(TransactionTestCase):
         return self.client.post(url, json.dumps(body), content_type='application/json',
                                 HTTP_AUTHORIZATION='token {}'.format(self.token))
 
-    @mock.patch('requests.get', mock_status_ok)
+    @mock.patch('api.healthcheck.session.get', mock_status_ok)
     @mock.patch('time.sleep', lambda func: func)
     def test_app_healthcheck_good(self):
         """
@@ -597,7 +652,29 @@ class ConfigTest(TransactionTestCase):
         self.assertEqual(response.status_code, 201)
         self.assertEqual(self.app.release_set.latest().version, 3)
 
-    @mock.patch('requests.get', mock_status_not_found)
+    @mock.patch('api.healthcheck.session.get', mock_status_ok)
+    @mock.patch('time.sleep')
+    def test_app_healthcheck_registration(self, mock_sleep):
+        """
+        The health check should start as soon as the publisher has registered the app's
+        containers in etcd, instead of after a fixed delay.
+        """
+        reads = []
+        read = MockEtcdClient.read
+
+        def read_when_registered(client, key, *args, **kwargs):
+            reads.append(key)
+            if len(reads) < 3:
+                raise KeyError(key)
+            return read(client, key, *args, **kwargs)
+
+        with mock.patch.object(MockEtcdClient, 'read', read_when_registered):
+            response = self._test_app_healthcheck()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(mock_sleep.call_args_list,
+                         [mock.call(settings.HEALTHCHECK_POLL_INTERVAL)] * 2)
+
+    @mock.patch('api.healthcheck.session.get', mock_status_not_found)
     @mock.patch('api.models.get_etcd_client', lambda func: func)
     @mock.patch('time.sleep', lambda func: func)
     @mock.patch('api.models.logger')
@@ -626,7 +703,7 @@ seconds".format(self.app.id)
         exp_log_call = mock.call(logging.WARNING, exp_msg)
         self.assertEqual(log_calls.count(exp_log_call), 1)
 
-    @mock.patch('requests.get', mock_status_not_found)
+    @mock.patch('api.healthcheck.session.get', mock_status_not_found)
     @mock.patch('api.models.get_etcd_client', lambda func: func)
     @mock.patch('time.sleep')
     def test_app_backoff_interval(self, mock_time):
@@ -648,7 +725,7 @@ seconds".format(self.app.id)
                                 HTTP_AUTHORIZATION='token {}'.format(self.token))
         self.assertEqual(mock_time.call_count, 5)
 
-    @mock.patch('requests.get', mock_status_ok)
+    @mock.patch('api.healthcheck.session.get', mock_status_ok)
     @mock.patch('time.sleep')
     def test_app_healthcheck_initial_delay(self, mock_time):
         """
@@ -678,7 +755,7 @@ seconds".format(self.app.id)
                          HTTP_AUTHORIZATION='token {}'.format(self.token))
         mock_time.assert_called_with(10)
 
-    @mock.patch('requests.get')
+    @mock.patch('api.healthcheck.session.get')
     @mock.patch('time.sleep', lambda func: func)
     def test_app_healthcheck_timeout(self, mock_request):
         """
@@ -693,7 +770,7 @@ seconds".format(self.app.id)
                          HTTP_AUTHORIZATION='token {}'.format(self.token))
         mock_request.assert_called_with('http://127.0.0.1:1234/', timeout=10)
 
-    @mock.patch('requests.get', mock_request_connection_error)
+    @mock.patch('api.healthcheck.session.get', mock_request_connection_error)
     @mock.patch('time.sleep', lambda func: func)
     def test_app_healthcheck_connection_error(self):
         """
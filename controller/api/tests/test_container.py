@@ -13,8 +13,9 @@ from django.test import TransactionTestCase
 import mock
 from rest_framework.authtoken.models import Token
 
-from api.models import App, Build, Container, Release
-from scheduler.states import TransitionError
+from api.models import App, Build, Config, Container, Release
+from scheduler import mock as mock_scheduler
+from scheduler.states import JobState, TransitionError
 from . import mock_status_ok
 
 
@@ -539,6 +540,31 @@ class ContainerTest(TransactionTestCase):
         rc, output = c.run('echo hi')
         self.assertEqual(json.loads(output)['entrypoint'], '/runner/init')
 
+    def test_runtime_config(self):
+        """Test that the config of a release can be passed to its containers on creation"""
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app = App.objects.get(id=response.data['id'])
+        config = Config.objects.create(owner=self.user, app=app, values={'PORT': '5000'})
+        build = Build.objects.create(owner=self.user, app=app, image='qwerty')
+        release = app.release_set.latest()
+        release = release.new(self.user, config=config, build=build)
+        self.assertFalse(release.runtime_config)
+        # the release is passed on even though its config is built into its image
+        self.assertEqual(release.env, {'DEIS_APP': app.id, 'DEIS_RELEASE': 'v2'})
+        with self.settings(RUNTIME_CONFIG=True):
+            release = release.new(self.user, config=config, build=build)
+        self.assertTrue(release.runtime_config)
+        env = {'PORT': '5000', 'DEIS_APP': app.id, 'DEIS_RELEASE': 'v3'}
+        self.assertEqual(release.env, env)
+        c = Container.objects.create(owner=self.user, app=app, release=release, type='web',
+                                     num=1)
+        c.create()
+        self.assertEqual(mock_scheduler.jobs[c.job_id]['env'], env)
+        rc, output = c.run('echo hi')
+        self.assertEqual(json.loads(output)['env'], env)
+
     def test_scaling_does_not_add_run_proctypes_to_structure(self):
         """Test that app info doesn't show transient "run" proctypes."""
         url = '/v1/apps'
@@ -667,3 +693,99 @@ class ContainerTest(TransactionTestCase):
                                     HTTP_AUTHORIZATION='token {}'.format(self.token))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.data), container_set.filter(type='web', num=1).count())
+
+    def test_rolling_deploy(self):
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        url = "/v1/apps/{app_id}/scale".format(**locals())
+        body = {'web': 4}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 204)
+        # replace one container at a time
+        start_containers = App._start_containers
+        url = "/v1/apps/{app_id}/config".format(**locals())
+        body = {'values': json.dumps({'DEPLOY_MAX_SURGE': '1'})}
+        with mock.patch.object(App, '_start_containers', autospec=True,
+                               side_effect=start_containers) as mock_start:
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([len(c[0][1]) for c in mock_start.call_args_list], [1, 1, 1, 1])
+        app = App.objects.get(id=app_id)
+        self.assertEqual([c.release.version for c in app.container_set.all()], [3, 3, 3, 3])
+
+        def fail_third_batch(app, to_add):
+            if mock_start.call_count == 3:
+                raise RuntimeError('aborting, failed to create some containers')
+            start_containers(app, to_add)
+
+        # a failed batch puts back the containers replaced so far
+        body = {'values': json.dumps({'KEY': 'value'})}
+        with mock.patch.object(App, '_start_containers', autospec=True,
+                               side_effect=fail_third_batch) as mock_start:
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(sorted((c.release.version, c.num) for c in app.container_set.all()),
+                         [(3, 1), (3, 2), (3, 3), (3, 4)])
+
+    def test_container_states(self):
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js', 'worker': 'node worker.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        url = "/v1/apps/{app_id}/scale".format(**locals())
+        body = {'web': 3, 'worker': 2}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 204)
+        app = App.objects.get(id=app_id)
+        app._state_cache.invalidate_app(app_id)
+        # every state on the page is looked up with a single scheduler query
+        url = "/v1/apps/{app_id}/containers".format(**locals())
+        with mock.patch('scheduler.mock.MockSchedulerClient.states',
+                        side_effect=lambda names: {n: JobState.up for n in names}) as states:
+            response = self.client.get(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.data['results']), 5)
+            self.assertEqual(states.call_count, 1)
+            self.assertEqual(len(states.call_args[0][0]), 5)
+            self.assertEqual(set(c['state'] for c in response.data['results']), set(['up']))
+            # and served from the cache while it is fresh
+            response = self.client.get(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(states.call_count, 1)
+        # the last states reported are listed if the scheduler cannot be reached
+        job_ids = [c.job_id for c in app.container_set.all()]
+        app._state_cache.invalidate(job_ids[:1])
+        with self.settings(STATE_CACHE_MAX_AGE=0), \
+                mock.patch('scheduler.mock.MockSchedulerClient.states',
+                           side_effect=RuntimeError('scheduler is down')):
+            response = self.client.get(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(c['state'] for c in response.data['results']),
+                         ['unknown', 'up', 'up', 'up', 'up'])
+        # a single container is served the same way
+        container = app.container_set.all()[1]
+        url = "/v1/apps/{}/containers/{}/{}".format(app_id, container.type, container.num)
+        with self.settings(STATE_CACHE_MAX_AGE=0), \
+                mock.patch('scheduler.mock.MockSchedulerClient.states',
+                           side_effect=RuntimeError('scheduler is down')):
+            response = self.client.get(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['state'], 'up')
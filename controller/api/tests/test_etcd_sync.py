@@ -0,0 +1,137 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+import datetime
+import threading
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TransactionTestCase
+import etcd
+import mock
+
+from api.etcd_sync import Resync
+from api.models import App, Config, Domain, Key
+from api.utils import fingerprint
+from .test_key import RSA_PUBKEY
+
+
+class MockEtcdTree(object):
+    """An etcd client which keeps a whole tree of keys in memory."""
+
+    def __init__(self, values=None):
+        # the value of each key, with None for directories
+        self.values = dict(values or {})
+        self.writes = []
+        self.deletes = []
+        self._lock = threading.Lock()
+
+    def read(self, key, recursive=False, **kwargs):
+        prefix = key.rstrip('/') + '/'
+        nodes = [{'key': k, 'value': v, 'dir': v is None} for k, v in self.values.items()
+                 if k.startswith(prefix) and (recursive or '/' not in k[len(prefix):])]
+        if key not in self.values and not nodes:
+            raise KeyError('Key not found : {}'.format(key))
+        return etcd.EtcdResult(None, {'key': key, 'dir': True, 'nodes': nodes})
+
+    def write(self, key, value, dir=False, **kwargs):
+        with self._lock:
+            if dir and key in self.values:
+                raise KeyError('Not a file : {}'.format(key))
+            self.writes.append(key)
+            self.values[key] = None if dir else value.decode('utf-8')
+
+    def delete(self, key, **kwargs):
+        with self._lock:
+            self.deletes.append(key)
+            del self.values[key]
+
+
+class ResyncTest(TransactionTestCase):
+    """Tests publishing the platform state held in the database to etcd"""
+
+    fixtures = ['tests.json']
+
+    def setUp(self):
+        self.user = User.objects.get(username='autotest')
+        self.app = App.objects.create(owner=self.user, id='autotest')
+        old = Config.objects.create(owner=self.user, app=self.app, values={'OLD': '1'})
+        Config.objects.filter(pk=old.pk).update(
+            created=old.created - datetime.timedelta(minutes=1))
+        Config.objects.create(owner=self.user, app=self.app,
+                              values={'FOO': 'bar', 'A': 'b', 'OLD': None})
+        Domain.objects.create(owner=self.user, app=self.app, domain='autotest.example.com')
+        Key.objects.create(owner=self.user, id='autotest@deis.io', public=RSA_PUBKEY)
+        self.key = '/deis/builder/users/autotest/{}'.format(fingerprint(RSA_PUBKEY))
+
+    def test_resync(self):
+        client = MockEtcdTree({
+            '/deis/services/autotest': None,
+            '/deis/domains/autotest.example.com': 'autotest',
+            '/deis/config/autotest': None,
+            '/deis/config/autotest/foo': 'bar',
+            '/deis/config/autotest/old': '1',
+            '/deis/config/gone': None,
+            '/deis/config/gone/foo': 'bar',
+        })
+        resync = Resync(client)
+        self.assertTrue(resync.run())
+        # only what etcd was missing is written, from the latest config of the app
+        self.assertEqual(sorted(client.writes), [self.key, '/deis/config/autotest/a'])
+        self.assertEqual(client.values['/deis/config/autotest/a'], 'b')
+        # stale keys of a published config are pruned, other apps' configs are left alone
+        self.assertEqual(client.deletes, ['/deis/config/autotest/old'])
+        self.assertIn('/deis/config/gone/foo', client.values)
+        # running it again has nothing left to write
+        client.writes = []
+        self.assertTrue(Resync(client).run())
+        self.assertEqual(client.writes, [])
+
+    def test_resync_batches(self):
+        Config.objects.create(owner=self.user, app=self.app,
+                              values={'KEY{}'.format(i): 'value' for i in range(6)})
+        client = MockEtcdTree()
+        resync = Resync(client)
+        resync.batch_size = 2
+        with mock.patch.object(Resync, '_flush', autospec=True,
+                               side_effect=Resync._flush) as mock_flush:
+            self.assertTrue(resync.run())
+        # once at the end of each kind of object, and once for each full batch of the 9 config
+        # keys
+        self.assertEqual(len(client.writes), 12)
+        self.assertEqual(mock_flush.call_count, 5 + 4)
+        self.assertEqual(client.values['/deis/config/autotest/key5'], 'value')
+
+    def test_resync_dry_run(self):
+        client = MockEtcdTree({'/deis/config/autotest/old': '1'})
+        messages = []
+        resync = Resync(client, dry_run=True, progress=messages.append)
+        self.assertTrue(resync.run())
+        self.assertEqual(client.writes, [])
+        self.assertEqual(client.deletes, [])
+        self.assertIn('would write /deis/config/autotest/foo', messages)
+        self.assertIn('would delete /deis/config/autotest/old', messages)
+        self.assertIn('configs: 3 checked, 4 to change', messages)
+
+    def test_resync_errors(self):
+        client = MockEtcdTree()
+        client.write = mock.Mock(side_effect=etcd.EtcdException('etcd is down'))
+        messages = []
+        resync = Resync(client, progress=messages.append)
+        self.assertFalse(resync.run())
+        self.assertTrue(resync.errors)
+        self.assertIn('error: etcd is down', messages)
+
+    def test_load_db_state_to_etcd_dry_run(self):
+        client = MockEtcdTree()
+        with mock.patch('api.management.commands.load_db_state_to_etcd.get_etcd_client',
+                        return_value=client), \
+                mock.patch('sys.stdout'):
+            call_command('load_db_state_to_etcd', dry_run=True)
+        self.assertEqual(client.writes, [])
+        self.assertEqual(client.values, {})
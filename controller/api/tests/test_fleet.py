@@ -0,0 +1,212 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from django.test import SimpleTestCase
+import mock
+import paramiko
+
+from scheduler import fleet
+from scheduler.states import JobState
+
+
+def unit_state(name, active='active', load='loaded'):
+    return {'name': '{}.service'.format(name), 'systemdActiveState': active,
+            'systemdLoadState': load}
+
+
+@mock.patch('scheduler.fleet.paramiko.RSAKey', mock.Mock())
+@mock.patch('scheduler.fleet.paramiko.SSHClient')
+class SSHPoolTest(SimpleTestCase):
+    """Tests the SSH connections shared by one-off commands"""
+
+    def test_reuse(self, mock_client):
+        pool = fleet.SSHPool('')
+        for _ in range(3):
+            with pool.session('10.0.0.1') as chan:
+                self.assertIs(chan, mock_client.return_value.get_transport().open_session())
+        with pool.session('10.0.0.2'):
+            pass
+        # one connection for each host, which sends keepalives
+        self.assertEqual(mock_client.return_value.connect.call_count, 2)
+        mock_client.return_value.get_transport().set_keepalive.assert_called_with(30)
+        self.assertEqual(chan.close.call_count, 4)
+
+    def test_reconnect(self, mock_client):
+        stale, fresh = mock.Mock(), mock.Mock()
+        stale.get_transport().open_session.side_effect = paramiko.SSHException('closed')
+        mock_client.side_effect = [stale, fresh]
+        pool = fleet.SSHPool('')
+        with pool.session('10.0.0.1') as chan:
+            self.assertIs(chan, fresh.get_transport().open_session())
+        self.assertTrue(stale.close.called)
+        # a connection which is no longer active is replaced before it is used
+        fresh.get_transport().is_active.return_value = False
+        mock_client.side_effect = [stale]
+        stale.get_transport().open_session.side_effect = None
+        with pool.session('10.0.0.1') as chan:
+            self.assertIs(chan, stale.get_transport().open_session())
+        self.assertTrue(fresh.close.called)
+
+    def test_session_timeout(self, mock_client):
+        pool = fleet.SSHPool('')
+        with self.settings(SSH_MAX_SESSIONS=1, SSH_SESSION_TIMEOUT=0.2):
+            with pool.session('10.0.0.1'):
+                # the only session is held by a command streaming to a slow client
+                with self.assertRaises(RuntimeError) as cm:
+                    with pool.session('10.0.0.1'):
+                        pass
+            self.assertEqual(str(cm.exception), 'too many commands running on host')
+            # the session is free again once the first command is done
+            with pool.session('10.0.0.1'):
+                pass
+        self.assertEqual(pool._connections['10.0.0.1'].active, 0)
+
+    def test_idle_timeout(self, mock_client):
+        pool = fleet.SSHPool('')
+        with self.settings(SSH_IDLE_TIMEOUT=0.01):
+            with pool.session('10.0.0.1'):
+                thread = pool._thread
+            thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(pool._connections, {})
+        self.assertTrue(mock_client.return_value.close.called)
+
+
+class FleetStatesTest(SimpleTestCase):
+    """Tests looking up the state of several units with a single query to fleet"""
+
+    def test_states(self):
+        client = fleet.FleetHTTPClient('/var/run/fleet.sock', None, None, None)
+        units = [unit_state('autotest_v2.web.1'),
+                 # fleet sometimes reports a unit it just loaded as failed
+                 unit_state('autotest_v2.web.2', 'failed'),
+                 unit_state('autotest_v2.web.3', 'failed', 'not-found'),
+                 unit_state('autotest_v2.web.4', 'unexpected')]
+        names = ['autotest_v2.web.{}'.format(i) for i in range(1, 6)]
+        with mock.patch.object(client, '_get_states',
+                               return_value={u['name']: u for u in units}) as get_states, \
+                mock.patch.object(client, 'state') as state:
+            states = client.states(names)
+        self.assertEqual(get_states.call_count, 1)
+        self.assertEqual([states[name] for name in names], [
+            JobState.up, JobState.created, JobState.crashed, JobState.error,
+            JobState.destroyed])
+        # a unit fleet does not report on is not asked about one by one
+        self.assertFalse(state.called)
+
+
+class StateWatcherTest(SimpleTestCase):
+    """Tests waiting on fleet's unit states through a single shared poll"""
+
+    def setUp(self):
+        self.watcher = fleet.StateWatcher('/var/run/fleet.sock', interval=0.01)
+        self.states = {}
+        self.watcher.client._get_states = mock.Mock(side_effect=lambda: dict(self.states))
+        self.watcher.client.reconnect = mock.Mock()
+
+    def _wait_for_poller(self):
+        for _ in range(100):
+            with self.watcher.cond:
+                if not self.watcher.polling:
+                    return
+            time.sleep(0.01)
+        self.fail('the poll loop did not stop')
+
+    def test_wait(self):
+        timer = threading.Timer(0.05, self.states.update,
+                                [{'a.service': unit_state('a')}])
+        timer.start()
+        states = self.watcher.wait(lambda states: 'a.service' in states, 5)
+        timer.join()
+        self.assertIn('a.service', states)
+        # fleet is only polled while someone is waiting
+        self._wait_for_poller()
+        calls = self.watcher.client._get_states.call_count
+        time.sleep(0.05)
+        self.assertEqual(self.watcher.client._get_states.call_count, calls)
+
+    def test_wait_timeout(self):
+        self.assertIsNone(self.watcher.wait(lambda states: 'a.service' in states, 0.05))
+        self._wait_for_poller()
+
+    def test_shared_poll(self):
+        release, done = threading.Event(), threading.Event()
+        results = []
+        snapshots = [{'a.service': unit_state('a')}, {}]
+
+        def get_states():
+            if len(snapshots) == 2:
+                # the first poll is in flight while the other waiters arrive
+                release.wait(5)
+            if snapshots:
+                return snapshots.pop()
+            # hold later polls back until every waiter has returned
+            done.wait(5)
+            return {}
+        self.watcher.client._get_states.side_effect = get_states
+        threads = [threading.Thread(target=lambda: results.append(
+            self.watcher.wait(lambda states: 'a.service' in states, 5))) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for _ in range(100):
+            if self.watcher.waiters == 3:
+                break
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        done.set()
+        # every waiter was woken up by the same poll
+        self.assertEqual(len(results), 3)
+        self.assertTrue(results[0] is results[1] is results[2])
+        self._wait_for_poller()
+
+    def test_poll_in_flight(self):
+        polling, release = threading.Event(), threading.Event()
+        snapshots = [{}, {'a.service': unit_state('a')}]
+
+        def get_states():
+            if len(snapshots) == 2:
+                polling.set()
+                release.wait(5)
+            return snapshots.pop() if snapshots else {}
+        self.watcher.client._get_states.side_effect = get_states
+        first = []
+        thread = threading.Thread(target=lambda: first.append(
+            self.watcher.wait(lambda states: 'a.service' in states, 5)))
+        thread.start()
+        self.assertTrue(polling.wait(5))
+        # a snapshot read by a poll begun before the call does not count for it
+        timer = threading.Timer(0.05, release.set)
+        timer.start()
+        self.assertIsNone(self.watcher.wait(lambda states: 'a.service' in states, 0.2))
+        timer.join()
+        thread.join(5)
+        self.assertIn('a.service', first[0])
+        self._wait_for_poller()
+
+    def test_poll_error(self):
+        errors = [RuntimeError('fleet is down')]
+
+        def get_states():
+            if errors:
+                raise errors.pop()
+            return {'a.service': unit_state('a')}
+        self.watcher.client._get_states.side_effect = get_states
+        states = self.watcher.wait(lambda states: 'a.service' in states, 5)
+        self.assertIn('a.service', states)
+        self.assertEqual(self.watcher.client.reconnect.call_count, 1)
+
+    def test_get_state_watcher(self):
+        with mock.patch.dict(fleet._watchers, clear=True):
+            watcher = fleet.get_state_watcher('/var/run/fleet.sock')
+            self.assertIs(fleet.get_state_watcher('/var/run/fleet.sock'), watcher)
+            self.assertIsNot(fleet.get_state_watcher('/tmp/fleet.sock'), watcher)
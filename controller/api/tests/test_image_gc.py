@@ -0,0 +1,94 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+import contextlib
+
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase
+import mock
+
+from api.image_gc import ImageGC
+from api.models import App, Build, Config, Container, Release
+
+
+class ImageGCTest(TransactionTestCase):
+    """Tests that the images of old releases are removed"""
+
+    fixtures = ['tests.json']
+
+    def setUp(self):
+        self.user = User.objects.get(username='autotest')
+        self.app = App.objects.create(owner=self.user, id='test')
+        config = Config.objects.create(owner=self.user, app=self.app)
+        for version in range(1, 7):
+            build = Build.objects.create(owner=self.user, app=self.app, image='test',
+                                         sha='{:040x}'.format(version))
+            Release.objects.create(version=version, owner=self.user, app=self.app, config=config,
+                                   build=build, image_key='key{}'.format(version))
+        self.docker = mock.Mock()
+        self.docker.local_tags.return_value = {
+            'test': {'git-{:040x}'.format(1), 'git-{:040x}'.format(6)},
+            'localhost:5000/test': {'v1', 'v2', 'v5', 'v6', 'latest'},
+            'other': {'v1'},
+        }
+        self.registry = mock.Mock()
+        self.registry.get_tags.return_value = {
+            'v{}'.format(version): 'abc' for version in range(1, 7)}
+        self.registry.get_tags.return_value['git-{:040x}'.format(1)] = 'abc'
+
+    def test_image_gc(self):
+        # the second release still has a container
+        Container.objects.create(owner=self.user, app=self.app, type='web', num=1,
+                                 release=self.app.release_set.get(version=2))
+        gc = ImageGC(2, docker_client=self.docker, registry_client=self.registry)
+        self.assertTrue(gc.run())
+        self.assertEqual(sorted(call[0] for call in self.registry.delete_tag.call_args_list),
+                         [('test', 'v1'), ('test', 'v3'), ('test', 'v4')])
+        self.assertEqual(sorted(call[0] for call in self.docker.remove.call_args_list),
+                         [('localhost:5000/test', 'v1'), ('test', 'git-{:040x}'.format(1))])
+        self.assertEqual(gc.stats['registry_tags'], 3)
+        self.assertEqual(gc.stats['local_tags'], 2)
+        # collected releases are no longer reused
+        self.assertEqual(
+            sorted(self.app.release_set.exclude(image_key='').values_list('version', flat=True)),
+            [2, 5, 6])
+
+    def test_image_gc_locks(self):
+        locked = []
+
+        @contextlib.contextmanager
+        def repository_lock(repo):
+            locked.append(repo)
+            # a rollback to the first build is published before the lock is given up
+            if len(locked) == 1:
+                Release.objects.create(version=7, owner=self.user, app=self.app,
+                                       config=self.app.release_set.get(version=6).config,
+                                       build=self.app.build_set.get(sha='{:040x}'.format(1)))
+            yield
+        gc = ImageGC(2, docker_client=self.docker, registry_client=self.registry)
+        with mock.patch('api.image_gc.repository_lock', repository_lock):
+            self.assertTrue(gc.run())
+        self.assertEqual(locked, ['localhost:5000/test', 'localhost:5000/test'])
+        # the source image of the first build is kept now that the rollback needs it
+        self.assertEqual(sorted(call[0] for call in self.docker.remove.call_args_list),
+                         [('localhost:5000/test', 'v1'), ('localhost:5000/test', 'v2')])
+
+    def test_image_gc_dry_run(self):
+        gc = ImageGC(2, dry_run=True, docker_client=self.docker, registry_client=self.registry)
+        self.assertTrue(gc.run())
+        self.assertEqual(gc.stats['registry_tags'], 4)
+        self.assertFalse(self.registry.delete_tag.called)
+        self.assertFalse(self.docker.remove.called)
+        self.assertEqual(self.app.release_set.filter(image_key='').count(), 0)
+
+    def test_image_gc_errors(self):
+        self.registry.get_tags.side_effect = EnvironmentError('registry is down')
+        gc = ImageGC(2, docker_client=self.docker, registry_client=self.registry)
+        self.assertFalse(gc.run())
+        self.assertEqual(gc.stats['errors'], 1)
+        # the local graph is collected all the same
+        self.assertEqual(gc.stats['local_tags'], 3)
@@ -0,0 +1,198 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+import httplib
+import json
+import socket
+import StringIO
+
+from django.test import SimpleTestCase
+import mock
+
+from scheduler import k8s
+from scheduler.states import JobState
+
+
+def mock_response(status=200, data='{}', will_close=False):
+    resp = mock.Mock(status=status, reason='OK', will_close=will_close)
+    resp.read.return_value = data
+    return resp
+
+
+class KubeConnectionPoolTest(SimpleTestCase):
+    """Tests the keep-alive connections to the kubernetes API server"""
+
+    @mock.patch('scheduler.k8s.httplib.HTTPConnection')
+    def test_reuse(self, mock_conn):
+        mock_conn.return_value.getresponse.side_effect = lambda: mock_response()
+        pool = k8s.ConnectionPool('k8s:8080', 2)
+        for _ in range(5):
+            self.assertEqual(pool.request('GET', '/api/v1/namespaces'), (200, '{}', 'OK'))
+        self.assertEqual(mock_conn.call_count, 1)
+        # a connection which the server asked to close is not handed out again
+        mock_conn.return_value.getresponse.side_effect = lambda: mock_response(will_close=True)
+        pool.request('GET', '/api/v1/namespaces')
+        pool.request('GET', '/api/v1/namespaces')
+        self.assertEqual(mock_conn.call_count, 2)
+
+    @mock.patch('scheduler.k8s.httplib.HTTPConnection')
+    def test_retry_on_reset(self, mock_conn):
+        stale, fresh = mock.Mock(), mock.Mock()
+        stale.request.side_effect = socket.error(104, 'Connection reset by peer')
+        fresh.getresponse.return_value = mock_response(data='[]')
+        mock_conn.side_effect = [fresh]
+        pool = k8s.ConnectionPool('k8s:8080', 2)
+        pool._idle.append(stale)
+        self.assertEqual(pool.request('GET', '/api/v1/namespaces'), (200, '[]', 'OK'))
+        self.assertTrue(stale.close.called)
+        # a new connection which fails is not retried
+        broken = mock.Mock()
+        broken.getresponse.side_effect = httplib.BadStatusLine('')
+        mock_conn.side_effect = [broken]
+        pool = k8s.ConnectionPool('k8s:8080', 2)
+        self.assertRaises(httplib.BadStatusLine, pool.request, 'GET', '/api/v1/namespaces')
+
+    @mock.patch('scheduler.k8s.httplib.HTTPConnection')
+    def test_retry_lost_response(self, mock_conn):
+        # a GET whose response was lost on a reused connection is sent again
+        stale, fresh = mock.Mock(), mock.Mock()
+        stale.getresponse.side_effect = httplib.BadStatusLine('')
+        fresh.getresponse.return_value = mock_response(data='[]')
+        mock_conn.side_effect = [fresh]
+        pool = k8s.ConnectionPool('k8s:8080', 2)
+        pool._idle.append(stale)
+        self.assertEqual(pool.request('GET', '/api/v1/namespaces'), (200, '[]', 'OK'))
+        # a POST the server may have applied is not
+        stale = mock.Mock()
+        stale.getresponse.side_effect = httplib.BadStatusLine('')
+        mock_conn.side_effect = [mock.Mock()]
+        pool = k8s.ConnectionPool('k8s:8080', 2)
+        pool._idle.append(stale)
+        self.assertRaises(httplib.BadStatusLine, pool.request, 'POST',
+                          '/api/v1/namespaces/autotest/pods', '{}')
+        self.assertFalse(mock_conn.called)
+
+
+def pod(name, phase='Pending', node=None, version='v2', resource_version='1'):
+    return {'metadata': {'name': name, 'resourceVersion': resource_version,
+                         'labels': {'name': 'autotest', 'version': version, 'type': 'web'}},
+            'spec': {'nodeName': node} if node else {},
+            'status': {'phase': phase}}
+
+
+def chunked(*events):
+    """Encode watch events the way the API server streams them."""
+    body = ''
+    for event in events:
+        line = json.dumps(event) + '\n'
+        body += '{:x}\r\n{}\r\n'.format(len(line), line)
+    return body + '0\r\n\r\n'
+
+
+class PodWatcherTest(SimpleTestCase):
+    """Tests following a rollout through the watch API"""
+
+    def setUp(self):
+        self.pool = mock.Mock()
+        self.pool.request.return_value = (200, json.dumps({
+            'metadata': {'resourceVersion': '10'},
+            'items': [pod('autotest-v1-web-1', 'Running', 'node1', version='v1')]}), 'OK')
+        streams = [chunked(
+            {'type': 'ADDED', 'object': pod('autotest-v2-web-1', resource_version='11')},
+            {'type': 'MODIFIED', 'object': pod(
+                'autotest-v2-web-1', 'Running', 'node1', resource_version='12')},
+            {'type': 'DELETED', 'object': pod(
+                'autotest-v1-web-1', 'Running', 'node1', version='v1', resource_version='13')})]
+        self.watch = mock.Mock()
+        # once the events above have been sent, later watches end without any
+        self.watch.return_value.getresponse.side_effect = lambda: mock.Mock(
+            status=200, chunked=True,
+            fp=StringIO.StringIO(streams.pop() if streams else chunked()))
+
+    def test_rollout(self):
+        with mock.patch('scheduler.k8s.get_pool', return_value=self.pool), \
+                mock.patch('scheduler.k8s.httplib.HTTPConnection', self.watch):
+            watcher = k8s.PodWatcher('k8s:8080', 'v1', 'autotest')
+            selector = {'name': 'autotest', 'version': 'v2', 'type': 'web'}
+            pods = watcher.wait(selector, lambda pods: k8s._running(pods, 1), 5)
+            self.assertEqual([p['metadata']['name'] for p in pods], ['autotest-v2-web-1'])
+            pods = watcher.wait(dict(selector, version='v1'), lambda pods: not pods, 5)
+            self.assertEqual(pods, [])
+            # the stream is closed once nobody waits on it
+            thread = watcher._thread
+            if thread is not None:
+                thread.join(5)
+            self.assertIsNone(watcher._thread)
+        # the pods were listed once, and the stream resumed from the listing
+        self.assertEqual(self.pool.request.call_count, 1)
+        url = self.watch.return_value.request.call_args_list[0][0][1]
+        self.assertIn('watch=true', url)
+        self.assertIn('resourceVersion=10', url)
+        self.assertIn('labelSelector=name%3Dautotest', url)
+
+    def test_unschedulable(self):
+        stuck = pod('autotest-v2-web-1')
+        stuck['status']['conditions'] = [{'type': 'PodScheduled', 'reason': 'Unschedulable',
+                                          'message': 'no nodes available'}]
+        self.assertFalse(k8s._scheduled([pod('autotest-v2-web-1')], 1))
+        self.assertTrue(k8s._scheduled([pod('autotest-v2-web-1', node='node1')], 1))
+        self.assertRaises(RuntimeError, k8s._scheduled, [stuck], 1)
+
+
+def rc_pod(rc_name, phase):
+    return {'metadata': {'generateName': rc_name + '-'}, 'status': {'phase': phase}}
+
+
+class KubeStatesTest(SimpleTestCase):
+    """Tests looking up the state of several jobs with one pod listing per namespace"""
+
+    def setUp(self):
+        self.pods = {'autotest': [rc_pod('autotest-v2-web', 'Pending'),
+                                  rc_pod('autotest-v2-web', 'Running'),
+                                  rc_pod('autotest-v2-worker', 'Pending')]}
+        self.pool = mock.Mock()
+        self.pool.request.side_effect = self._request
+
+    def _request(self, method, path, body=None, headers=None):
+        namespace = path.split('/')[4]
+        if namespace not in self.pods:
+            return 404, 'namespace not found', 'Not Found'
+        return 200, json.dumps({'items': self.pods[namespace]}), 'OK'
+
+    def _client(self):
+        with self.settings(K8S_MASTER='k8s', REGISTRY_HOST='localhost', REGISTRY_PORT='5000'), \
+                mock.patch('scheduler.k8s.get_pool', return_value=self.pool):
+            return k8s.KubeHTTPClient(None, None, None, None)
+
+    def test_states(self):
+        client = self._client()
+        names = ['autotest_v2.web.1', 'autotest_v2.worker.1', 'autotest_v2.cmd.1',
+                 'gone_v1.web.1']
+        with mock.patch.object(client, 'state') as state:
+            states = client.states(names)
+        self.assertEqual([states[name] for name in names], [
+            JobState.up, JobState.created, JobState.destroyed, JobState.destroyed])
+        # a job whose pods are not running yet is not waited for
+        self.assertFalse(state.called)
+        self.assertEqual(self.pool.request.call_count, 2)
+
+    @mock.patch('scheduler.k8s.time.sleep')
+    def test_states_pod_phases(self, mock_sleep):
+        client = self._client()
+        self.pods = {'autotest': [rc_pod('autotest-v2-web', 'Failed'),
+                                  rc_pod('autotest-v2-worker', 'Succeeded'),
+                                  rc_pod('autotest-v2-cmd', 'Unknown'),
+                                  rc_pod('autotest-v2-clock', 'Failed'),
+                                  rc_pod('autotest-v2-clock', 'Pending')]}
+        names = ['autotest_v2.web.1', 'autotest_v2.worker.1', 'autotest_v2.cmd.1',
+                 'autotest_v2.clock.1']
+        states = client.states(names)
+        self.assertEqual([states[name] for name in names], [
+            JobState.crashed, JobState.down, JobState.error, JobState.created])
+        self.assertEqual(self.pool.request.call_count, 1)
+        self.assertFalse(mock_sleep.called)
@@ -0,0 +1,266 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+from datetime import timedelta
+import json
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase
+from django.utils import timezone
+import mock
+from rest_framework.authtoken.models import Token
+
+from api import workers
+from api.models import App, Operation, log_event, run_as
+
+
+@mock.patch('api.models.publish_release', lambda *args: None)
+class OperationTest(TransactionTestCase):
+    """Tests running scheduler work in the background"""
+
+    fixtures = ['tests.json']
+
+    def setUp(self):
+        self.user = User.objects.get(username='autotest')
+        self.token = Token.objects.get(user=self.user).key
+
+    def _wait_for(self, url):
+        """Poll an operation until it has finished."""
+        for _ in range(100):
+            response = self.client.get(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 200)
+            if response.data['state'] in ('succeeded', 'failed'):
+                return response.data
+            time.sleep(0.1)
+        self.fail('operation did not finish')
+
+    def test_operation_scale(self):
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js', 'worker': 'node worker.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token),
+                                    HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['type'], 'build')
+        operation = self._wait_for(response['Location'])
+        self.assertEqual(operation['state'], 'succeeded')
+        self.assertEqual(operation['result']['release'], 'v2')
+        # scale up in the background
+        url = "/v1/apps/{app_id}/scale".format(**locals())
+        body = {'web': 2, 'worker': 1}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token),
+                                    HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, 202)
+        self.assertIn(response.data['state'], ('pending', 'running', 'succeeded'))
+        operation = self._wait_for(response['Location'])
+        self.assertEqual(operation['state'], 'succeeded')
+        self.assertEqual(operation['error'], '')
+        self.assertIn('autotest scaled containers', ' '.join(operation['progress']))
+        self.assertEqual(operation['result']['containers'],
+                         {'{}.web.1'.format(app_id): 'up',
+                          '{}.web.2'.format(app_id): 'up',
+                          '{}.worker.1'.format(app_id): 'up'})
+        # operations are listed newest first
+        url = "/v1/apps/{app_id}/operations".format(**locals())
+        response = self.client.get(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([o['type'] for o in response.data['results']], ['scale', 'build'])
+
+    def test_operation_failed(self):
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        # scaling without a build fails, but only once the operation runs
+        url = "/v1/apps/{app_id}/scale".format(**locals())
+        body = {'web': 1}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token),
+                                    HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, 202)
+        operation = self._wait_for(response['Location'])
+        self.assertEqual(operation['state'], 'failed')
+        self.assertEqual(operation['error'], 'No build associated with this release')
+
+    def test_operation_busy(self):
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = "/v1/apps/{app_id}/scale".format(**locals())
+        body = {'web': 1}
+        with mock.patch.object(workers.WorkerPool, 'try_submit', side_effect=workers.PoolFull):
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token),
+                                        HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, 503)
+        url = "/v1/apps/{app_id}/operations".format(**locals())
+        response = self.client.get(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 0)
+
+    def test_operation_publish_progress(self):
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        progress = {'stage': 'push', 'layers': 2, 'done': 1, 'current': 10, 'total': 40,
+                    'message': ''}
+
+        def publish_release(source, config, target, deis_registry, published, bake_config,
+                            report):
+            report(progress)
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js'})}
+        with mock.patch('api.models.publish_release', publish_release):
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token),
+                                        HTTP_PREFER='respond-async')
+            self.assertEqual(response.status_code, 202)
+            operation = self._wait_for(response['Location'])
+        self.assertEqual(operation['state'], 'succeeded')
+        self.assertEqual(operation['publish_progress'], progress)
+
+    def test_operation_progress_per_thread(self):
+        app = App.objects.create(owner=self.user, id='autotest')
+        operation = Operation.objects.create(owner=self.user, app=app, type='scale')
+        operation._lock = threading.Lock()
+        run_as(operation, log_event, app, 'from the operation')
+        # a synchronous request on the same app does not report to the operation
+        thread = threading.Thread(target=log_event, args=(app, 'from a request'))
+        thread.start()
+        thread.join()
+        self.assertEqual(Operation.objects.get(pk=operation.pk).progress, ['from the operation'])
+
+    def test_operation_one_per_app(self):
+        app = App.objects.create(owner=self.user, id='autotest')
+        running = Operation.objects.create(owner=self.user, app=app, type='scale',
+                                           state=Operation.RUNNING)
+        operation = Operation.objects.create(owner=self.user, app=app, type='scale')
+        called = threading.Event()
+        with self.settings(OPERATION_WAIT_INTERVAL=0.01):
+            operation.submit(called.set)
+            # the operation waits for the one another process is running on the app
+            self.assertFalse(called.wait(0.2))
+            self.assertEqual(Operation.objects.get(pk=operation.pk).state, Operation.PENDING)
+            running.state = Operation.SUCCEEDED
+            running.save()
+            self.assertTrue(called.wait(5))
+        for _ in range(100):
+            if Operation.objects.get(pk=operation.pk).state == Operation.SUCCEEDED:
+                break
+            time.sleep(0.05)
+        else:
+            self.fail('operation did not finish')
+
+    def test_operation_fail_orphaned(self):
+        app = App.objects.create(owner=self.user, id='autotest')
+        for state in (Operation.PENDING, Operation.RUNNING, Operation.SUCCEEDED):
+            Operation.objects.create(owner=self.user, app=app, type='scale', state=state)
+        # operations whose lease is still renewed by a running controller are left alone
+        live = Operation.objects.create(owner=self.user, app=app, type='scale',
+                                        state=Operation.RUNNING)
+        app.operation_set.exclude(pk=live.pk).update(
+            updated=timezone.now() - timedelta(seconds=120))
+        with self.settings(OPERATION_LEASE=60):
+            self.assertEqual(Operation.fail_orphaned(), 2)
+        self.assertEqual(sorted(app.operation_set.values_list('state', flat=True)),
+                         [Operation.FAILED, Operation.FAILED, Operation.RUNNING,
+                          Operation.SUCCEEDED])
+
+    def test_operation_prune(self):
+        app = App.objects.create(owner=self.user, id='autotest')
+        for state in (Operation.RUNNING, Operation.SUCCEEDED, Operation.FAILED):
+            Operation.objects.create(owner=self.user, app=app, type='scale', state=state)
+        app.operation_set.update(updated=timezone.now() - timedelta(days=31))
+        recent = Operation.objects.create(owner=self.user, app=app, type='scale',
+                                          state=Operation.SUCCEEDED)
+        with self.settings(OPERATION_RETENTION_DAYS=30):
+            self.assertEqual(Operation.prune(), 2)
+        self.assertEqual(sorted(app.operation_set.values_list('state', flat=True)),
+                         [Operation.RUNNING, Operation.SUCCEEDED])
+        self.assertTrue(Operation.objects.filter(pk=recent.pk).exists())
+
+    def test_operation_heartbeat(self):
+        app = App.objects.create(owner=self.user, id='autotest')
+        operation = Operation.objects.create(owner=self.user, app=app, type='scale')
+        renewed = threading.Event()
+
+        def func():
+            Operation.objects.filter(pk=operation.pk).update(
+                updated=timezone.now() - timedelta(seconds=120))
+            # the lease is renewed while the operation runs
+            for _ in range(100):
+                if Operation.objects.get(pk=operation.pk).updated > \
+                        timezone.now() - timedelta(seconds=5):
+                    renewed.set()
+                    return
+                time.sleep(0.05)
+        with self.settings(OPERATION_HEARTBEAT_INTERVAL=0.01):
+            operation.perform(func)
+        self.assertTrue(renewed.is_set())
+
+    def test_operation_expired_lease(self):
+        app = App.objects.create(owner=self.user, id='autotest')
+        stale = Operation.objects.create(owner=self.user, app=app, type='scale',
+                                         state=Operation.RUNNING)
+        # the process running it stopped long ago without renewing its lease
+        Operation.objects.filter(pk=stale.pk).update(
+            updated=timezone.now() - timedelta(seconds=120))
+        operation = Operation.objects.create(owner=self.user, app=app, type='scale')
+        with self.settings(OPERATION_LEASE=60):
+            self.assertEqual(operation.perform(lambda: 'done'), 'done')
+        stale = Operation.objects.get(pk=stale.pk)
+        self.assertEqual(stale.state, Operation.FAILED)
+        self.assertEqual(stale.error, 'The controller stopped before the operation finished')
+        self.assertEqual(Operation.objects.get(pk=operation.pk).state, Operation.SUCCEEDED)
+
+    def test_operation_wait_timeout(self):
+        app = App.objects.create(owner=self.user, id='autotest')
+        Operation.objects.create(owner=self.user, app=app, type='scale', state=Operation.RUNNING)
+        operation = Operation.objects.create(owner=self.user, app=app, type='scale')
+        func = mock.Mock()
+        with self.settings(OPERATION_WAIT_INTERVAL=0.01, OPERATION_WAIT_TIMEOUT=0.1):
+            self.assertRaises(RuntimeError, operation.perform, func)
+        self.assertFalse(func.called)
+        operation = Operation.objects.get(pk=operation.pk)
+        self.assertEqual(operation.state, Operation.FAILED)
+        self.assertEqual(operation.error,
+                         'Timed out waiting for another operation on autotest to finish')
+
+    def test_operation_sync_scale_waits(self):
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        containers = App.objects.get(id=app_id).container_set.count()
+        # a synchronous scale is claimed like a background operation on the same app
+        Operation.objects.create(owner=self.user, app_id=app_id, type='scale',
+                                 state=Operation.RUNNING)
+        url = "/v1/apps/{app_id}/scale".format(**locals())
+        body = {'web': 2}
+        with self.settings(OPERATION_WAIT_INTERVAL=0.01, OPERATION_WAIT_TIMEOUT=0.1):
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(App.objects.get(id=app_id).container_set.count(), containers)
@@ -0,0 +1,95 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from guardian.shortcuts import assign_perm
+import mock
+from rest_framework.authtoken.models import Token
+
+from api.models import App, Build, Config, Container, Release
+
+
+@mock.patch('api.models.publish_release', lambda *args: None)
+class QueryCountTest(TransactionTestCase):
+    """Tests that listing resources takes the same number of queries however many there are"""
+
+    fixtures = ['tests.json']
+
+    def setUp(self):
+        self.user = User.objects.get(username='autotest')
+        self.user2 = User.objects.get(username='autotest2')
+        self.token = Token.objects.get(user=self.user).key
+
+    def _count_queries(self, url, results):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), results)
+        return len(queries)
+
+    def _create_app(self, owner):
+        app = App.objects.create(owner=owner)
+        config = Config.objects.create(owner=owner, app=app)
+        Release.objects.create(version=1, owner=owner, app=app, config=config, build=None)
+        return app
+
+    def test_list_apps(self):
+        self._create_app(self.user)
+        expected = self._count_queries('/v1/apps', 1)
+        for _ in range(5):
+            self._create_app(self.user)
+        for _ in range(5):
+            assign_perm('use_app', self.user, self._create_app(self.user2))
+        self.assertEqual(self._count_queries('/v1/apps', 11), expected)
+
+    def test_list_app_resources(self):
+        app = self._create_app(self.user)
+        build = Build.objects.create(owner=self.user, app=app, image='autotest/example')
+        config = app.config_set.latest()
+        release = Release.objects.create(version=2, owner=self.user, app=app, config=config,
+                                         build=build)
+        Container.objects.create(owner=self.user, app=app, release=release, type='web', num=1)
+        urls = {'/v1/apps/{}/containers'.format(app): 1,
+                '/v1/apps/{}/releases'.format(app): 2,
+                '/v1/apps/{}/builds'.format(app): 1}
+        expected = {url: self._count_queries(url, results) for url, results in urls.items()}
+        # add more of everything, owned by another user
+        for version in range(3, 13):
+            build = Build.objects.create(owner=self.user2, app=app, image='autotest/example')
+            release = Release.objects.create(version=version, owner=self.user2, app=app,
+                                             config=config, build=build)
+        for num in range(2, 12):
+            Container.objects.create(owner=self.user2, app=app, release=release, type='web',
+                                     num=num)
+        urls = {'/v1/apps/{}/containers'.format(app): 11,
+                '/v1/apps/{}/releases'.format(app): 12,
+                '/v1/apps/{}/builds'.format(app): 11}
+        for url, results in urls.items():
+            self.assertEqual(self._count_queries(url, results), expected[url], url)
+
+    def test_container_release(self):
+        app = self._create_app(self.user)
+        build = Build.objects.create(owner=self.user, app=app, image='autotest/example',
+                                     procfile={'web': 'node server.js'})
+        config = Config.objects.create(owner=self.user, app=app, values={'PORT': '5000'})
+        release = Release.objects.create(version=2, owner=self.user, app=app, config=config,
+                                         build=build, runtime_config=True)
+        for num in range(1, 6):
+            Container.objects.create(owner=self.user, app=app, release=release, type='web',
+                                     num=num)
+        app = App.objects.get(pk=app.pk)
+        # the release, build and config of every container are loaded along with it
+        with self.assertNumQueries(1):
+            containers = list(app._containers())
+            for c in containers:
+                self.assertEqual(c.release.env['PORT'], '5000')
+                self.assertEqual(c._get_command(), "bash -c 'node server.js'")
+                self.assertEqual(c.job_id, '{}_v2.web.{}'.format(app.id, c.num))
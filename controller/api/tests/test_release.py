@@ -13,7 +13,7 @@ from django.test import TransactionTestCase
 import mock
 from rest_framework.authtoken.models import Token
 
-from api.models import Release
+from api.models import App, Build, Release
 from . import mock_status_ok
 
 
@@ -227,6 +227,27 @@ class ReleaseTest(TransactionTestCase):
         self.assertIn('NEW_URL1', values)
         self.assertEqual('http://localhost:8080/', values['NEW_URL1'])
 
+    def test_release_image_key(self):
+        """Test that a release can reuse the image of an earlier one with the same key"""
+        body = {'id': 'test'}
+        response = self.client.post('/v1/apps', json.dumps(body),
+                                    content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app = App.objects.get(id='test')
+        release = app.release_set.latest()
+        build = Build.objects.create(owner=self.user, app=app, image='autotest/example')
+        with mock.patch('api.models.publish_release') as publish_release:
+            publish_release.return_value = 'abc123'
+            release2 = release.new(self.user, config=release.config, build=build)
+            published = publish_release.call_args[0][4]
+            self.assertIsNone(published('abc123'))
+            release3 = release2.new(self.user, config=release.config, build=build)
+            published = publish_release.call_args[0][4]
+            self.assertEqual(published('abc123'), release2.image)
+            self.assertIsNone(published('def456'))
+        self.assertEqual(Release.objects.get(uuid=release3.uuid).image_key, 'abc123')
+
     @mock.patch('requests.post', mock_status_ok)
     def test_release_str(self):
         """Test the text representation of a release."""
@@ -7,13 +7,15 @@ Run the tests with "./manage.py test api"
 from __future__ import unicode_literals
 
 import json
+import threading
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import TransactionTestCase
+from django.test import SimpleTestCase, TransactionTestCase
 import mock
 from rest_framework.authtoken.models import Token
 
+import scheduler
 from scheduler import chaos
 
 
@@ -395,3 +397,50 @@ class SchedulerTest(TransactionTestCase):
         self.assertEqual(response.status_code, 503)
         self.assertEqual(response.data, {'detail': 'exit code 1'})
         self.assertEqual(response.get('content-type'), 'application/json')
+
+    def test_client_reuse(self):
+        """Test that scheduler clients are reused per thread and per configuration"""
+        args = (settings.SCHEDULER_MODULE, settings.SCHEDULER_TARGET, settings.SCHEDULER_AUTH,
+                settings.SCHEDULER_OPTIONS, settings.SSH_PRIVATE_KEY)
+        client = scheduler.get_client(*args)
+        self.assertIsInstance(client, chaos.ChaosSchedulerClient)
+        self.assertIs(client, scheduler.get_client(*args))
+        # another thread gets its own client
+        other = []
+        t = threading.Thread(target=lambda: other.append(scheduler.get_client(*args)))
+        t.start()
+        t.join()
+        self.assertIsNot(client, other[0])
+        # a different configuration gets a different client
+        self.assertIsNot(client, scheduler.get_client('scheduler.mock', *args[1:]))
+        # an unhealthy client is reconnected instead of replaced
+        with mock.patch.object(client, 'healthy', return_value=False), \
+                mock.patch.object(client, 'reconnect') as reconnect:
+            self.assertIs(client, scheduler.get_client(*args))
+            self.assertTrue(reconnect.called)
+
+
+class DeployBatchesTest(SimpleTestCase):
+    """Tests planning rolling deploys"""
+
+    def test_one_at_a_time(self):
+        self.assertEqual(scheduler.deploy_batches(2),
+                         [(1, 2), (1, 1), (2, 1), (2, 0)])
+        self.assertEqual(scheduler.deploy_batches(2, 0, 0), scheduler.deploy_batches(2))
+        self.assertEqual(scheduler.deploy_batches(0), [])
+
+    def test_batches(self):
+        self.assertEqual(scheduler.deploy_batches(10, '25%', '25%'),
+                         [(3, 8), (5, 5), (8, 3), (10, 0)])
+        self.assertEqual(scheduler.deploy_batches(4, '100%', '0'), [(4, 4), (4, 0)])
+        self.assertEqual(scheduler.deploy_batches(4, 0, 2), [(0, 2), (2, 2), (2, 0), (4, 0)])
+        for desired, surge, unavailable in ((7, 2, 1), (100, '10%', '5%'), (5, 0, '50%')):
+            new, old = 0, desired
+            for new, old in scheduler.deploy_batches(desired, surge, unavailable):
+                self.assertLessEqual(new + old, desired + scheduler._batch_size(
+                    surge, desired, 1, round_up=True))
+            self.assertEqual((new, old), (desired, 0))
+
+    def test_invalid(self):
+        self.assertRaises(RuntimeError, scheduler.deploy_batches, 4, 'lots', 0)
+        self.assertRaises(RuntimeError, scheduler.deploy_batches, 4, -1, 0)
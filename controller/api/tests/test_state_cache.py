@@ -0,0 +1,61 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+import time
+
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+import mock
+
+from api.state_cache import StateCache
+from scheduler.states import JobState
+
+
+class StateCacheTest(SimpleTestCase):
+    """Tests serving container states from the cache"""
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.client.states.side_effect = lambda names: {n: JobState.up for n in names}
+        self.cache = StateCache(lambda: self.client)
+
+    @override_settings(STATE_CACHE_MAX_AGE=10, STATE_CACHE_INTERVAL=0)
+    def test_cache(self):
+        state, updated = self.cache.get('autotest_v2.web.1')
+        self.assertEqual(state, JobState.up)
+        self.assertLessEqual(updated, time.time())
+        # stale jobs are fetched together, fresh ones are served from the cache
+        states = self.cache.get_many(['autotest_v2.web.1', 'autotest_v2.web.2',
+                                      'autotest_v2.web.3'])
+        self.assertEqual(len(states), 3)
+        self.assertEqual(self.client.states.call_args_list, [
+            mock.call(['autotest_v2.web.1']),
+            mock.call(['autotest_v2.web.2', 'autotest_v2.web.3'])])
+        # changed jobs are asked for again
+        self.cache.update({'autotest_v2.web.1': JobState.down})
+        self.assertEqual(self.cache.get('autotest_v2.web.1')[0], JobState.down)
+        self.cache.invalidate(['autotest_v2.web.1'])
+        self.assertEqual(self.cache.get('autotest_v2.web.1')[0], JobState.up)
+        self.cache.invalidate_app('autotest')
+        self.cache.get_many(['autotest_v2.web.1', 'autotest_v2.web.2'])
+        self.assertEqual(self.client.states.call_count, 4)
+
+    @override_settings(STATE_CACHE_MAX_AGE=10, STATE_CACHE_INTERVAL=0.01, STATE_CACHE_IDLE=10)
+    def test_refresh(self):
+        self.cache.get('autotest_v2.web.1')
+        self.client.states.side_effect = lambda names: {n: JobState.crashed for n in names}
+        for _ in range(100):
+            if self.cache.get('autotest_v2.web.1')[0] == JobState.crashed:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.cache.get('autotest_v2.web.1')[0], JobState.crashed)
+        # the refresh stops once the cache is empty
+        thread = self.cache._thread
+        self.cache.invalidate(['autotest_v2.web.1'])
+        thread.join(5)
+        self.assertIsNone(self.cache._thread)
@@ -0,0 +1,36 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+from django.test import SimpleTestCase
+import mock
+
+from scheduler import swarm
+from scheduler.states import JobState
+
+
+@mock.patch('scheduler.swarm.Client')
+class SwarmStatesTest(SimpleTestCase):
+    """Tests looking up the state of several containers with a single listing"""
+
+    def test_states(self, mock_client):
+        mock_client.return_value.containers.return_value = [
+            {'Names': ['/node1/autotest_v2.web.1'], 'Status': 'Up 2 minutes'},
+            {'Names': ['/node2/autotest_v2.web.2'], 'Status': 'Exited (0) 1 minutes ago'},
+            {'Names': None, 'Status': 'Up 1 minutes'}]
+        with self.settings(SWARM_HOST='swarm', REGISTRY_HOST='localhost', REGISTRY_PORT='5000'):
+            client = swarm.SwarmClient(None, None, None, None)
+        names = ['autotest_v2.web.1', 'autotest_v2.web.2', 'autotest_v2.web.3']
+        states = client.states(names)
+        self.assertEqual([states[name] for name in names],
+                         [JobState.up, JobState.created, JobState.destroyed])
+        mock_client.return_value.containers.assert_called_once_with(all=True)
+        # the same as asking about each container on its own
+        mock_client.return_value.inspect_container.side_effect = [
+            {'State': {'Running': True}}, {'State': {'Running': False}}, Exception('No such id')]
+        self.assertEqual([client.state(name) for name in names],
+                         [JobState.up, JobState.created, JobState.destroyed])
@@ -0,0 +1,97 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from api.workers import PoolFull, WorkerPool
+
+
+class WorkerPoolTest(SimpleTestCase):
+    """Tests the bounded worker pool used for container operations"""
+
+    def test_results(self):
+        pool = WorkerPool(max_workers=4)
+
+        def fail():
+            raise RuntimeError('boom')
+
+        tasks = pool.run_all('autotest', [lambda: 1, fail, lambda: 3])
+        self.assertEqual([t.result for t in tasks], [1, None, 3])
+        self.assertIsNone(tasks[0].exception)
+        self.assertIsInstance(tasks[1].exception, RuntimeError)
+        self.assertLessEqual(pool.stats()['workers'], 4)
+
+    def test_limits(self):
+        pool = WorkerPool(max_workers=5, max_per_key=2)
+        lock = threading.Lock()
+        running = {'a': 0, 'b': 0, 'total': 0}
+        peak = {'a': 0, 'b': 0, 'total': 0}
+        release = threading.Event()
+
+        def work(key):
+            with lock:
+                for k in (key, 'total'):
+                    running[k] += 1
+                    peak[k] = max(peak[k], running[k])
+            release.wait(5)
+            with lock:
+                for k in (key, 'total'):
+                    running[k] -= 1
+
+        tasks = [pool.submit(key, work, key) for key in 'aaaaab' * 2]
+        # wait until the pool is saturated, then check nothing more got to run
+        while running['total'] < 4:
+            release.wait(0.01)
+        release.wait(0.1)
+        self.assertEqual(running, {'a': 2, 'b': 2, 'total': 4})
+        release.set()
+        for task in tasks:
+            self.assertTrue(task.wait(5))
+        self.assertEqual(peak, {'a': 2, 'b': 2, 'total': 4})
+        self.assertLessEqual(pool.stats()['workers'], 5)
+
+    def test_backpressure(self):
+        pool = WorkerPool(max_workers=1, max_queued=1)
+        release = threading.Event()
+        running = pool.submit('autotest', release.wait, 5)
+        # wait for the worker to pick up the first task so the queue is empty
+        while pool.stats()['queued']:
+            release.wait(0.01)
+        waiting = pool.submit('autotest', lambda: None)
+        self.assertRaises(PoolFull, pool.try_submit, 'autotest', lambda: None)
+        release.set()
+        self.assertTrue(running.wait(5))
+        self.assertTrue(waiting.wait(5))
+        self.assertEqual(pool.try_submit('autotest', lambda: 2).wait(5), True)
+
+    def test_burst(self):
+        pool = WorkerPool(max_workers=10)
+        self.assertTrue(pool.submit('autotest', lambda: None).wait(5))
+        while not pool.stats()['idle']:
+            threading.Event().wait(0.01)
+        # a burst larger than the idle workers gets enough workers to run all at once
+        cond = threading.Condition()
+        running = [0]
+
+        def work():
+            deadline = time.time() + 5
+            with cond:
+                running[0] += 1
+                cond.notify_all()
+                while running[0] < 10 and time.time() < deadline:
+                    cond.wait(0.1)
+                return running[0] == 10
+
+        tasks = [pool.submit('autotest', work) for _ in range(10)]
+        for task in tasks:
+            self.assertTrue(task.wait(5))
+        self.assertEqual([task.result for task in tasks], [True] * 10)
+        self.assertEqual(pool.stats()['running'], 0)
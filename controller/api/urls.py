@@ -29,6 +29,11 @@ urlpatterns = patterns(
         views.ReleaseViewSet.as_view({'post': 'rollback'})),
     url(r"^apps/(?P<id>{})/releases/?".format(settings.APP_URL_REGEX),
         views.ReleaseViewSet.as_view({'get': 'list'})),
+    # background operations
+    url(r"^apps/(?P<id>{})/operations/(?P<uuid>[-_\w]+)/?".format(settings.APP_URL_REGEX),
+        views.OperationViewSet.as_view({'get': 'retrieve'})),
+    url(r"^apps/(?P<id>{})/operations/?".format(settings.APP_URL_REGEX),
+        views.OperationViewSet.as_view({'get': 'list'})),
     # application infrastructure
     url(r"^apps/(?P<id>{})/containers/restart/?".format(settings.APP_URL_REGEX),
         views.ContainerViewSet.as_view({'post': 'restart'})),
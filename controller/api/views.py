@@ -1,9 +1,15 @@
 """
 RESTful view classes for presenting Deis API objects.
 """
+import codecs
+import itertools
+import json
+import logging
+
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from guardian.shortcuts import assign_perm, get_objects_for_user, \
     get_users_with_perms, remove_perm
@@ -14,11 +20,14 @@ from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 from rest_framework.authtoken.models import Token
 
-from api import authentication, models, permissions, serializers, viewsets
+from api import authentication, models, permissions, serializers, viewsets, workers
 
 import requests
 
 
+logger = logging.getLogger(__name__)
+
+
 class UserRegistrationViewSet(GenericViewSet,
                               mixins.CreateModelMixin):
     """ViewSet to handle registering new users. The logic is in the serializer."""
@@ -118,6 +127,37 @@ class BaseDeisViewSet(viewsets.OwnerViewSet):
         # If the scheduler oopsie'd
         except RuntimeError as e:
             return Response({'detail': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except workers.PoolFull:
+            return self.busy()
+
+    def prefers_async(self):
+        """Whether the client asked for scheduler work to happen in the background."""
+        return 'respond-async' in self.request.META.get('HTTP_PREFER', '')
+
+    def start_operation(self, app, type, func, *args):
+        """Run func(*args) in the background as a new :class:`~api.models.Operation`."""
+        operation = models.Operation.objects.create(owner=self.request.user, app=app, type=type)
+        operation.submit(func, *args)
+        return operation
+
+    def perform_operation(self, app, type, func, *args):
+        """
+        Run func(*args) as a new :class:`~api.models.Operation` while the client waits, so that
+        it does not overlap the background operations on the app, and return what it returns.
+        """
+        operation = models.Operation.objects.create(owner=self.request.user, app=app, type=type)
+        return operation.perform(func, *args)
+
+    def accepted(self, operation):
+        """Respond with the operation the client can poll to follow the work it requested."""
+        serializer = serializers.OperationSerializer(operation)
+        location = '/v1/apps/{}/operations/{}'.format(operation.app.id, operation.uuid)
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED,
+                        headers={'Location': location})
+
+    def busy(self):
+        return Response({'detail': 'Too many operations in progress, try again later'},
+                        status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
 
 class AppResourceViewSet(BaseDeisViewSet):
@@ -130,7 +170,7 @@ class AppResourceViewSet(BaseDeisViewSet):
 
     def get_queryset(self, **kwargs):
         app = self.get_app()
-        return self.model.objects.filter(app=app)
+        return self.model.objects.filter(app=app).select_related('owner', 'app')
 
     def get_object(self, **kwargs):
         return self.get_queryset(**kwargs).latest('created')
@@ -147,14 +187,25 @@ class ReleasableViewSet(AppResourceViewSet):
     and it returns some success headers regarding the new release.
 
     To use it, at minimum you'll need to provide a `release` attribute tied to your class before
-    calling post_save().
+    calling post_save(). If the release is deployed in the background instead, provide an
+    `operation` attribute and the client is answered with it.
     """
+    operation = None
+
+    def create(self, request, **kwargs):
+        response = super(ReleasableViewSet, self).create(request, **kwargs)
+        if self.operation is not None:
+            return self.accepted(self.operation)
+        return response
+
     def get_object(self):
         """Retrieve the object based on the latest release's value"""
         return getattr(self.get_app().release_set.latest(), self.model.__name__.lower())
 
     def get_success_headers(self, data, **kwargs):
         headers = super(ReleasableViewSet, self).get_success_headers(data)
+        if self.operation is not None:
+            return headers
         headers.update({'Deis-Release': self.release.version})
         headers.update({'X-Deis-Release': self.release.version})  # DEPRECATED
         return headers
@@ -166,7 +217,7 @@ class AppViewSet(BaseDeisViewSet):
     serializer_class = serializers.AppSerializer
 
     def get_queryset(self, *args, **kwargs):
-        return self.model.objects.all(*args, **kwargs)
+        return self.model.objects.all(*args, **kwargs).select_related('owner')
 
     def list(self, request, *args, **kwargs):
         """
@@ -176,7 +227,7 @@ class AppViewSet(BaseDeisViewSet):
         """
         queryset = super(AppViewSet, self).get_queryset(**kwargs) | \
             get_objects_for_user(self.request.user, 'api.use_app')
-        instance = self.filter_queryset(queryset)
+        instance = self.filter_queryset(queryset.select_related('owner'))
         page = self.paginate_queryset(instance)
         if page is not None:
             serializer = self.get_pagination_serializer(page)
@@ -194,7 +245,11 @@ class AppViewSet(BaseDeisViewSet):
             for target, count in request.data.viewitems():
                 new_structure[target] = int(count)
             models.validate_app_structure(new_structure)
-            app.scale(request.user, new_structure)
+            if self.prefers_async():
+                operation = self.start_operation(app, 'scale', app.scale, request.user,
+                                                 new_structure)
+                return self.accepted(operation)
+            self.perform_operation(app, 'scale', app.scale, request.user, new_structure)
         except (TypeError, ValueError) as e:
             return Response({'detail': 'Invalid scaling format: {}'.format(e)},
                             status=status.HTTP_400_BAD_REQUEST)
@@ -202,13 +257,20 @@ class AppViewSet(BaseDeisViewSet):
             return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except RuntimeError as e:
             return Response({'detail': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except workers.PoolFull:
+            return self.busy()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     def logs(self, request, **kwargs):
         app = self.get_object()
+        log_lines = request.query_params.get('log_lines', str(settings.LOG_LINES))
+        process_type = request.query_params.get('process_type')
+        follow = request.query_params.get('follow') in ('1', 'true')
         try:
-            return Response(app.logs(request.query_params.get('log_lines',
-                                     str(settings.LOG_LINES))),
+            if follow or request.query_params.get('stream') in ('1', 'true'):
+                return StreamingHttpResponse(app.stream_logs(log_lines, process_type, follow),
+                                             content_type='text/plain')
+            return Response(app.logs(log_lines, process_type),
                             status=status.HTTP_200_OK, content_type='text/plain')
         except requests.exceptions.RequestException:
             return Response("Error accessing logs for {}".format(app.id),
@@ -227,6 +289,13 @@ class AppViewSet(BaseDeisViewSet):
     def run(self, request, **kwargs):
         app = self.get_object()
         try:
+            if request.query_params.get('stream') in ('1', 'true'):
+                stream = app.run_stream(self.request.user, request.data['command'])
+                # wait for the command to start, so that failing to start it gets an error status
+                first = next(stream, None)
+                stream = itertools.chain([first] if first is not None else [], stream)
+                return StreamingHttpResponse(self._run_events(stream),
+                                             content_type='application/x-json-stream')
             output_and_rc = app.run(self.request.user, request.data['command'])
         except EnvironmentError as e:
             return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
@@ -235,6 +304,21 @@ class AppViewSet(BaseDeisViewSet):
         return Response(output_and_rc, status=status.HTTP_200_OK,
                         content_type='text/plain')
 
+    def _run_events(self, stream):
+        """
+        Send a one-off command's output as one JSON object per line: {"output": ...} for each
+        chunk, then {"rc": ...} once the command exits, or {"detail": ...} if it fails.
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        try:
+            for chunk in stream:
+                if isinstance(chunk, int):
+                    yield json.dumps({'rc': chunk}) + '\n'
+                else:
+                    yield json.dumps({'output': decoder.decode(chunk)}) + '\n'
+        except Exception as e:
+            yield json.dumps({'detail': str(e)}) + '\n'
+
     def update(self, request, **kwargs):
         app = self.get_object()
 
@@ -253,7 +337,12 @@ class BuildViewSet(ReleasableViewSet):
     serializer_class = serializers.BuildSerializer
 
     def post_save(self, build):
-        self.release = build.create(self.request.user)
+        if self.prefers_async():
+            self.operation = self.start_operation(build.app, 'build', build.create,
+                                                  self.request.user)
+        else:
+            self.release = self.perform_operation(build.app, 'build', build.create,
+                                                  self.request.user)
         super(BuildViewSet, self).post_save(build)
 
 
@@ -263,22 +352,33 @@ class ConfigViewSet(ReleasableViewSet):
     serializer_class = serializers.ConfigSerializer
 
     def post_save(self, config):
+        if self.prefers_async():
+            self.operation = self.start_operation(config.app, 'config', self.deploy, config)
+        else:
+            self.release = self.perform_operation(config.app, 'config', self.deploy, config)
+
+    def deploy(self, config):
         release = config.app.release_set.latest()
-        self.release = release.new(self.request.user, config=config, build=release.build)
+        new_release = release.new(self.request.user, config=config, build=release.build)
         try:
-            config.app.deploy(self.request.user, self.release)
+            config.app.deploy(self.request.user, new_release)
         except RuntimeError:
-            self.release.delete()
+            new_release.delete()
             raise
+        return new_release
 
 
 class ContainerViewSet(AppResourceViewSet):
     """A viewset for interacting with Container objects."""
     model = models.Container
     serializer_class = serializers.ContainerSerializer
+    # the state of each container to be serialized, keyed by job ID
+    states = None
 
     def get_queryset(self, **kwargs):
-        qs = super(ContainerViewSet, self).get_queryset(**kwargs)
+        # select_related() replaces the relations selected before rather than adding to them
+        qs = super(ContainerViewSet, self).get_queryset(**kwargs).select_related(
+            'owner', 'app', 'release')
         container_type = self.kwargs.get('type')
         if container_type:
             qs = qs.filter(type=container_type)
@@ -290,9 +390,48 @@ class ContainerViewSet(AppResourceViewSet):
         qs = self.get_queryset(**kwargs)
         return qs.get(num=self.kwargs['num'])
 
+    def get_serializer_context(self):
+        context = super(ContainerViewSet, self).get_serializer_context()
+        context['states'] = self.states
+        return context
+
+    def list(self, request, *args, **kwargs):
+        instance = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(instance)
+        self._fetch_states(page.object_list if page is not None else instance)
+        if page is not None:
+            serializer = self.get_pagination_serializer(page)
+        else:
+            serializer = self.get_serializer(instance, many=True)
+        return Response(serializer.data)
+
+    def retrieve(self, request, *args, **kwargs):
+        container = self.get_object()
+        self._fetch_states([container])
+        return Response(self.get_serializer(container).data)
+
+    def _fetch_states(self, containers):
+        """
+        Look up the state of every container with at most one query to the scheduler.
+
+        If the scheduler cannot be queried, the last states it reported are used instead, and
+        the containers whose state was never reported are listed as "unknown".
+        """
+        containers = list(containers)
+        if containers:
+            cache = containers[0].app._state_cache
+            names = [c.job_id for c in containers]
+            try:
+                self.states = cache.get_many(names)
+            except Exception as e:
+                logger.warning('{}: could not fetch container states: {}'.format(
+                    containers[0].app.id, e))
+                self.states = cache.peek_many(names)
+
     def restart(self, *args, **kwargs):
         try:
             containers = self.get_app().restart(**kwargs)
+            self._fetch_states(containers)
             serializer = self.get_serializer(containers, many=True)
             return Response(serializer.data, status=status.HTTP_200_OK)
         except Exception as e:
@@ -347,16 +486,32 @@ class ReleaseViewSet(AppResourceViewSet):
             version_to_rollback_to = release.version - 1
             if request.data.get('version'):
                 version_to_rollback_to = int(request.data['version'])
-            new_release = release.rollback(request.user, version_to_rollback_to)
+            if self.prefers_async():
+                operation = self.start_operation(app, 'rollback', release.rollback,
+                                                 request.user, version_to_rollback_to)
+                return self.accepted(operation)
+            new_release = self.perform_operation(app, 'rollback', release.rollback,
+                                                 request.user, version_to_rollback_to)
             response = {'version': new_release.version}
             return Response(response, status=status.HTTP_201_CREATED)
         except EnvironmentError as e:
             return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except workers.PoolFull:
+            return self.busy()
         except RuntimeError:
             new_release.delete()
             raise
 
 
+class OperationViewSet(AppResourceViewSet):
+    """A viewset for following the progress of background operations."""
+    model = models.Operation
+    serializer_class = serializers.OperationSerializer
+
+    def get_object(self, **kwargs):
+        return get_object_or_404(self.get_queryset(**kwargs), uuid=self.kwargs['uuid'])
+
+
 class BaseHookViewSet(BaseDeisViewSet):
     permission_classes = [permissions.HasBuilderAuth]
 
@@ -397,7 +552,7 @@ class BuildHookViewSet(BaseHookViewSet):
         return Response(response, status=status.HTTP_200_OK)
 
     def post_save(self, build):
-        build.create(self.user)
+        self.perform_operation(build.app, 'build', build.create, self.user)
 
 
 class ConfigHookViewSet(BaseHookViewSet):
@@ -14,7 +14,7 @@ class OwnerViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated, permissions.IsOwner]
 
     def get_queryset(self):
-        return self.model.objects.filter(owner=self.request.user)
+        return self.model.objects.filter(owner=self.request.user).select_related('owner')
 
     def perform_create(self, serializer):
         obj = serializer.save(owner=self.request.user)
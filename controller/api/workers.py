@@ -0,0 +1,188 @@
+"""
+Bounded thread pools used to fan work out from the Deis API.
+"""
+
+from __future__ import unicode_literals
+import collections
+import threading
+
+from django.conf import settings
+
+
+class PoolFull(Exception):
+    """Raised when a pool's queue is full and the caller asked not to wait."""
+    pass
+
+
+class Task(object):
+    """A callable submitted to a :class:`WorkerPool`, along with its outcome."""
+
+    def __init__(self, key, func, args):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.result = None
+        self.exception = None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as e:
+            self.exception = e
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the task to finish and return whether it did."""
+        self._done.wait(timeout)
+        return self.done()
+
+
+class WorkerPool(object):
+    """
+    A fixed number of worker threads fed by a bounded queue.
+
+    Tasks are submitted under a key, usually an application ID. At most `max_per_key` tasks
+    with the same key run at once; the rest wait their turn without holding up other keys.
+    Once `max_queued` tasks are waiting to run, submitting blocks until the workers catch up.
+
+    Tasks must not wait on other tasks submitted to the same pool.
+    """
+
+    def __init__(self, max_workers, max_per_key=None, max_queued=None):
+        self.max_workers = max_workers
+        self.max_per_key = max_per_key
+        self.max_queued = max_queued
+        self._cond = threading.Condition()
+        # tasks allowed to run, in submission order
+        self._ready = collections.deque()
+        # tasks held back by the per-key limit
+        self._deferred = collections.defaultdict(collections.deque)
+        # number of ready or running tasks per key
+        self._active = collections.defaultdict(int)
+        self._queued = 0
+        self._idle = 0
+        # workers started but not yet waiting for tasks
+        self._starting = 0
+        self._workers = []
+
+    def submit(self, key, func, *args):
+        """Queue func(*args), waiting for room in the queue if it is full."""
+        return self._submit(key, func, args, block=True)
+
+    def try_submit(self, key, func, *args):
+        """Queue func(*args), raising :class:`PoolFull` if the queue is full."""
+        return self._submit(key, func, args, block=False)
+
+    def run_all(self, key, funcs):
+        """Run each callable in funcs and wait for all of them to finish.
+
+        :return: a list of finished :class:`Task`, in the same order as funcs
+        """
+        tasks = [self.submit(key, func) for func in funcs]
+        for task in tasks:
+            task.wait()
+        return tasks
+
+    def stats(self):
+        """Report the number of workers and how many tasks are running and waiting."""
+        with self._cond:
+            return {'workers': len(self._workers),
+                    'idle': self._idle,
+                    'queued': self._queued,
+                    'running': sum(self._active.values()) - len(self._ready)}
+
+    def _submit(self, key, func, args, block):
+        with self._cond:
+            while self.max_queued and self._queued >= self.max_queued:
+                if not block:
+                    raise PoolFull('{} tasks are already waiting to run'.format(self._queued))
+                self._cond.wait()
+            task = Task(key, func, args)
+            self._queued += 1
+            if self.max_per_key and self._active[key] >= self.max_per_key:
+                self._deferred[key].append(task)
+            else:
+                self._schedule(task)
+            return task
+
+    def _schedule(self, task):
+        self._active[task.key] += 1
+        self._ready.append(task)
+        # idle workers only leave the count once they run, so a burst needs more of them
+        if (len(self._ready) > self._idle + self._starting and
+                len(self._workers) < self.max_workers):
+            self._starting += 1
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        self._cond.notify_all()
+
+    def _work(self):
+        with self._cond:
+            self._starting -= 1
+        while True:
+            with self._cond:
+                self._idle += 1
+                while not self._ready:
+                    self._cond.wait()
+                self._idle -= 1
+                task = self._ready.popleft()
+                self._queued -= 1
+                # wake up anyone waiting for room in the queue
+                self._cond.notify_all()
+            task.run()
+            with self._cond:
+                self._finish(task.key)
+            # the task counts as running until it is done
+            task._done.set()
+
+    def _finish(self, key):
+        self._active[key] -= 1
+        if self._deferred[key]:
+            self._schedule(self._deferred[key].popleft())
+        if not self._deferred[key]:
+            del self._deferred[key]
+        if not self._active[key]:
+            del self._active[key]
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name, max_workers, max_per_key=None, max_queued=None):
+    """Return the process-wide pool registered under name, creating it on first use."""
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = WorkerPool(max_workers, max_per_key, max_queued)
+        return _pools[name]
+
+
+def lifecycle_pool():
+    """Return the pool used to create, start, stop and destroy containers."""
+    return get_pool('lifecycle',
+                    settings.LIFECYCLE_WORKERS,
+                    settings.LIFECYCLE_WORKERS_PER_APP,
+                    settings.LIFECYCLE_MAX_QUEUED)
+
+
+def operations_pool():
+    """Return the pool used to run background operations, one at a time per application."""
+    return get_pool('operations',
+                    settings.OPERATION_WORKERS,
+                    1,
+                    settings.OPERATION_MAX_QUEUED)
+
+
+def healthcheck_pool():
+    """Return the pool used to probe containers during health checks."""
+    return get_pool('healthcheck', settings.HEALTHCHECK_WORKERS)
+
+
+def etcd_pool():
+    """Return the pool used to write to etcd concurrently."""
+    return get_pool('etcd', settings.ETCD_WORKERS)
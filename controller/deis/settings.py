@@ -285,6 +285,7 @@ TEST_RUNNER = 'api.tests.SilentDjangoTestSuiteRunner'
 
 # etcd settings
 ETCD_HOST, ETCD_PORT = os.environ.get('ETCD', '127.0.0.1:4001').split(',')[0].split(':')
+ETCD_WORKERS = 10  # concurrent writes to etcd
 
 # default deis settings
 LOG_LINES = 1000
@@ -302,6 +303,37 @@ SCHEDULER_MODULE = 'scheduler.mock'
 SCHEDULER_TARGET = ''  # path to scheduler endpoint (e.g. /var/run/fleet.sock)
 SCHEDULER_AUTH = ''
 SCHEDULER_OPTIONS = {}
+K8S_MAX_CONNECTIONS = 20  # keep-alive connections to the kubernetes API server
+
+# limits on concurrent container lifecycle operations (create, start, stop, destroy)
+LIFECYCLE_WORKERS = 50  # total worker threads, and so database connections
+LIFECYCLE_WORKERS_PER_APP = 20
+LIFECYCLE_MAX_QUEUED = 5000  # further operations wait for room in the queue
+
+# limits on background operations (scale, deploy, rollback) requested with "Prefer: respond-async"
+OPERATION_WORKERS = 10
+OPERATION_MAX_QUEUED = 100  # further requests are rejected with a 503
+OPERATION_WAIT_INTERVAL = 1  # seconds between checks for the running operation on an app to end
+OPERATION_WAIT_TIMEOUT = 1200  # seconds to wait for it before failing the new operation
+OPERATION_HEARTBEAT_INTERVAL = 15  # seconds between renewals of a running operation's lease
+OPERATION_LEASE = 60  # seconds without a renewal after which an unfinished operation has failed
+OPERATION_RETENTION_DAYS = 30  # days finished operations are kept before they are pruned
+
+# health checks of containers configured with HEALTHCHECK_URL
+HEALTHCHECK_WORKERS = 20  # containers probed at once, and size of the connection pool
+HEALTHCHECK_POLL_INTERVAL = 0.5  # seconds between checks for services registered in etcd
+HEALTHCHECK_REGISTRATION_TIMEOUT = 20  # seconds to wait for every service to be registered
+
+# cache of container states, refreshed from the scheduler in the background
+STATE_CACHE_MAX_AGE = 10  # seconds a state is served from the cache
+STATE_CACHE_INTERVAL = 5  # seconds between refreshes of every cached state
+STATE_CACHE_IDLE = 600  # seconds after which states nobody has asked for are dropped
+
+# SSH connections to the hosts "deis run" commands are run on, one per host
+SSH_MAX_SESSIONS = 10  # commands run at once over a connection, as allowed by sshd by default
+SSH_SESSION_TIMEOUT = 60  # seconds a command waits for one of them before it fails
+SSH_KEEPALIVE = 30  # seconds between keepalives sent over a connection
+SSH_IDLE_TIMEOUT = 300  # seconds after which an unused connection is closed
 
 # security keys and auth tokens
 SSH_PRIVATE_KEY = ''  # used for SSH connections to facilitate "deis run"
@@ -312,10 +344,23 @@ BUILDER_KEY = os.environ.get('DEIS_BUILDER_KEY', 'CHANGEME_sapm$s%upvsw5l_zuy_&2
 REGISTRY_URL = 'http://localhost:5000'
 REGISTRY_HOST = 'localhost'
 REGISTRY_PORT = 5000
+# publish releases of images in deis-registry through its API rather than with Docker
+REGISTRY_API = True
+DOCKER_BUILD_SLOTS = 4  # images built at once by every controller process together
+# images of the releases of each app which are kept by "manage.py gc_images"
+IMAGE_GC_RELEASES = 10
+# seconds between collections of old release images by the controller, or 0 to leave them be
+IMAGE_GC_INTERVAL = 0
+# pass config to containers when they are created, rather than building it into a new image
+# for every release
+RUNTIME_CONFIG = False
 
 # logger settings
 LOGGER_HOST = 'localhost'
 LOGGER_PORT = 8088
+LOGGER_CONNECTIONS = 10  # connections to deis-logger kept open
+LOG_FOLLOW_INTERVAL = 1  # seconds between reads of new log lines when following logs
+LOG_FOLLOW_TIMEOUT = 30  # seconds after which a followed log stream ends, freeing its worker
 
 # check if we can register users with `deis register`
 REGISTRATION_ENABLED = True
@@ -2,28 +2,61 @@
 """Support the Deis workflow by manipulating and publishing Docker images."""
 
 from __future__ import unicode_literals
+import collections
+import contextlib
+import errno
+import fcntl
+import hashlib
 import io
+import json
 import logging
+import os
+import re
+import threading
+import time
 
 from django.conf import settings
 from rest_framework.exceptions import PermissionDenied
 from simpleflock import SimpleFlock
 import docker
 
+from registry.registryclient import RegistryClient, RegistryError
+
 logger = logging.getLogger(__name__)
 
+# seconds to wait for a lock before giving up on publishing a release
+LOCK_TIMEOUT = 1200
+# seconds between reports of the progress of a pull, build or push
+PROGRESS_INTERVAL = 2
+# seconds between log lines summing up how long publishes wait for each stage
+STATS_INTERVAL = 300
+
 
 class DockerClient(object):
     """Use the Docker API to pull, tag, build, and push images to deis-registry."""
 
-    FLOCKFILE = '/tmp/controller-pull'
-
     def __init__(self):
         self.client = docker.Client(version='auto')
         self.registry = settings.REGISTRY_HOST + ':' + str(settings.REGISTRY_PORT)
+        self.registry_client = RegistryClient()
+
+    def publish_release(self, source, config, target, deis_registry, published=None,
+                        bake_config=True, progress=None):
+        """
+        Update a source Docker image with environment config and publish it to deis-registry.
 
-    def publish_release(self, source, config, target, deis_registry):
-        """Update a source Docker image with environment config and publish it to deis-registry."""
+        If published returns an image already published from the same source image and config
+        for the key of this one, that image is tagged as the target in deis-registry rather than
+        built again. The key of a source image in deis-registry is found without pulling it.
+        Without bake_config, the source image is published unchanged, since the config is
+        passed to containers when they are created.
+
+        An image in deis-registry is published through the registry's API where possible, and
+        with the local Docker daemon otherwise. The progress of each request to the registry,
+        or of each pull, build and push, is passed to progress as it is made.
+
+        :return: the key of the published image, as passed to published
+        """
         # get the source repository name and tag
         src_name, src_tag = docker.utils.parse_repository_tag(source)
         # get the target repository name and tag
@@ -31,6 +64,30 @@ class DockerClient(object):
         # strip any "http://host.domain:port" prefix from the target repository name,
         # since we always publish to the Deis registry
         name = strip_prefix(name)
+        config.update({'DEIS_APP': name, 'DEIS_RELEASE': tag})
+
+        if deis_registry and settings.REGISTRY_API:
+            try:
+                return self.publish_in_registry(src_name, src_tag, config, name, tag, published,
+                                                bake_config, progress)
+            except RegistryError as e:
+                logger.warning("Could not publish {}:{} through the registry API, using Docker "
+                               "instead: {}".format(name, tag, e))
+
+        key = None
+        if deis_registry and published:
+            # look the source image up in deis-registry, so that an image published from it
+            # before is reused without pulling it
+            try:
+                source_id = self.registry_client.get_tag(src_name, src_tag)
+            except RegistryError as e:
+                logger.warning("Could not look up {}:{} in deis-registry: {}".format(
+                    src_name, src_tag, e))
+                source_id = None
+            if source_id is not None:
+                key = image_key(source_id, config if bake_config else {})
+                if self._reuse(published(key), name, tag, progress):
+                    return key
 
         # pull the source image from the registry
         # NOTE: this relies on an implementation detail of deis-builder, that
@@ -39,20 +96,77 @@ class DockerClient(object):
             repo = "{}/{}".format(self.registry, src_name)
         else:
             repo = src_name
-        self.pull(repo, src_tag)
+        self.pull(repo, src_tag, progress)
 
         # tag the image locally without the repository URL
         image = "{}:{}".format(repo, src_tag)
         self.tag(image, src_name, tag=src_tag)
 
-        # build a Docker image that adds a "last-mile" layer of environment
-        config.update({'DEIS_APP': name, 'DEIS_RELEASE': tag})
-        self.build(source, config, name, tag)
+        if key is None:
+            key = image_key(self.client.inspect_image(image)['Id'],
+                            config if bake_config else {})
+            if published and self._reuse(published(key), name, tag, progress):
+                return key
+
+        if bake_config:
+            # build a Docker image that adds a "last-mile" layer of environment
+            self.build(source, config, name, tag, progress)
+        else:
+            self.tag(image, "{}/{}".format(self.registry, name), tag)
 
         # push the image to deis-registry
-        self.push("{}/{}".format(self.registry, name), tag)
+        self.push("{}/{}".format(self.registry, name), tag, progress)
+        return key
+
+    def publish_in_registry(self, src_name, src_tag, config, name, tag, published=None,
+                            bake_config=True, progress=None):
+        """
+        Publish an image in deis-registry as a release without going through Docker, by tagging
+        an image in the registry or uploading the config layer to it.
+
+        :return: the key of the published image, as passed to published
+        """
+        check_blacklist(src_name)
+        check_blacklist(name)
+        report_stage(progress, 'get_tag', "Looking up {}:{}".format(src_name, src_tag))
+        source_id = self.registry_client.get_tag(src_name, src_tag)
+        if source_id is None:
+            raise RegistryError("{}:{} is not in deis-registry".format(src_name, src_tag))
+        key = image_key(source_id, config if bake_config else {})
+        if published and self._reuse(published(key), name, tag, progress):
+            return key
+        if bake_config:
+            report_stage(progress, 'add_config',
+                         "Adding config to {}:{}".format(src_name, src_tag))
+            image_id = self.registry_client.add_config(source_id, config)
+        else:
+            image_id = source_id
+        report_stage(progress, 'set_tag', "Tagging {} as {}:{}".format(image_id, name, tag))
+        self.registry_client.set_tag(name, tag, image_id)
+        return key
 
-    def build(self, source, config, repo, tag):
+    def retag(self, image, repo, tag, progress=None):
+        """
+        Publish an image already in deis-registry under another tag, by updating the tag in
+        the registry without pulling or pushing the image.
+        """
+        check_blacklist(repo)
+        report_stage(progress, 'set_tag', "Tagging {} as {}:{}".format(image, repo, tag))
+        self.registry_client.retag(image, repo, tag)
+
+    def _reuse(self, cached, repo, tag, progress=None):
+        """Publish an image published before as a release, and return whether it could be."""
+        if cached is None:
+            return False
+        try:
+            self.retag(cached, repo, tag, progress)
+            return True
+        except RegistryError as e:
+            logger.warning("Could not reuse Docker image {}, publishing {}:{} instead: {}"
+                           .format(cached, repo, tag, e))
+            return False
+
+    def build(self, source, config, repo, tag, progress=None):
         """Add a "last-mile" layer of environment config to a Docker image for deis-registry."""
         check_blacklist(repo)
         env = ' '.join("{}='{}'".format(
@@ -61,23 +175,40 @@ class DockerClient(object):
         f = io.BytesIO(dockerfile.encode('utf-8'))
         target_repo = "{}/{}:{}".format(self.registry, repo, tag)
         logger.info("Building Docker image {}".format(target_repo))
-        with SimpleFlock(self.FLOCKFILE, timeout=1200):
+        with waiting('build', repository_lock("{}/{}".format(self.registry, repo)), BuildSlot()):
             stream = self.client.build(fileobj=f, tag=target_repo, stream=True, rm=True)
-            log_output(stream)
+            follow(stream, 'build', progress)
 
-    def pull(self, repo, tag):
+    def pull(self, repo, tag, progress=None):
         """Pull a Docker image into the local storage graph."""
         check_blacklist(repo)
         logger.info("Pulling Docker image {}:{}".format(repo, tag))
-        with SimpleFlock(self.FLOCKFILE, timeout=1200):
+        with waiting('pull', repository_lock(repo)):
             stream = self.client.pull(repo, tag=tag, stream=True, insecure_registry=True)
-            log_output(stream)
+            follow(stream, 'pull', progress)
 
-    def push(self, repo, tag):
+    def push(self, repo, tag, progress=None):
         """Push a local Docker image to a registry."""
         logger.info("Pushing Docker image {}:{}".format(repo, tag))
         stream = self.client.push(repo, tag=tag, stream=True, insecure_registry=True)
-        log_output(stream)
+        follow(stream, 'push', progress)
+
+    def local_tags(self):
+        """Return the tags of every image in the local storage graph, keyed by repository."""
+        tags = collections.defaultdict(set)
+        for image in self.client.images():
+            for repo_tag in image.get('RepoTags') or []:
+                repo, tag = docker.utils.parse_repository_tag(repo_tag)
+                tags[repo].add(tag)
+        return tags
+
+    def remove(self, repo, tag):
+        """Untag a local Docker image, removing it once no other tag refers to it."""
+        logger.info("Removing Docker image {}:{}".format(repo, tag))
+        try:
+            self.client.remove_image("{}:{}".format(repo, tag))
+        except docker.errors.NotFound:
+            pass
 
     def tag(self, image, repo, tag):
         """Tag a local Docker image with a new name and tag."""
@@ -87,6 +218,17 @@ class DockerClient(object):
             raise docker.errors.DockerException("tagging failed")
 
 
+def image_key(source_id, config):
+    """
+    Return the key of the image published from a source image and config.
+
+    DEIS_RELEASE is left out, as it is the only value which differs between the releases an
+    image is published for.
+    """
+    values = {k: v for k, v in config.items() if k != 'DEIS_RELEASE'}
+    return hashlib.sha256(json.dumps([source_id, values], sort_keys=True)).hexdigest()
+
+
 def check_blacklist(repo):
     """Check a Docker repository name for collision with deis/* components."""
     blacklisted = [  # NOTE: keep this list up to date!
@@ -99,13 +241,236 @@ def check_blacklist(repo):
         raise PermissionDenied("Repository name {} is not allowed".format(repo))
 
 
-def log_output(stream):
-    """Log a stream at DEBUG level, and raise DockerException if it contains "error"."""
+def repository_lock(repo):
+    """
+    Return a lock on a Docker repository, shared by every controller process.
+
+    Docker does not cope with the same repository being pulled or built into more than once at
+    a time, while different repositories are safe to work on concurrently.
+    """
+    name = re.sub(r'[^-\w.]', '_', repo)
+    return SimpleFlock('/tmp/controller-pull-{}'.format(name), timeout=LOCK_TIMEOUT)
+
+
+class BuildSlot(object):
+    """
+    One of DOCKER_BUILD_SLOTS file locks, shared by every controller process, which caps how
+    many images are built on the Docker host at once.
+    """
+
+    PATH = '/tmp/controller-build.{}'
+
+    def __init__(self, timeout=LOCK_TIMEOUT):
+        self.timeout = timeout
+        self._fd = None
+
+    def __enter__(self):
+        deadline = time.time() + self.timeout
+        while True:
+            for slot in xrange(settings.DOCKER_BUILD_SLOTS):
+                fd = os.open(self.PATH.format(slot), os.O_CREAT)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    self._fd = fd
+                    return self
+                except IOError as e:
+                    os.close(fd)
+                    if e.errno != errno.EAGAIN:
+                        raise
+            if time.time() > deadline:
+                raise IOError(errno.EAGAIN, 'Timed out waiting for a build slot')
+            time.sleep(0.1)
+
+    def __exit__(self, *args):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+
+class StageStats(object):
+    """How many publishes of this controller process wait for a stage, and for how long."""
+
+    def __init__(self):
+        self.waiting = 0
+        self.running = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+
+_stats = collections.defaultdict(StageStats)
+_stats_lock = threading.Lock()
+# when the stats were last logged
+_stats_logged = time.time()
+
+
+def stats():
+    """
+    Report, for each stage of publishing a release in this process, how many publishes are
+    waiting for their locks and running, and the total and longest time they waited.
+    """
+    with _stats_lock:
+        return {stage: dict(vars(s)) for stage, s in _stats.items()}
+
+
+def log_stats():
+    """Log the stats of each stage of publishing a release in this process."""
+    logger.info("Publish stats: {}".format('; '.join(
+        "{}: {waiting} waiting, {running} running, waited {wait_time:.1f}s in {waits} "
+        "waits, at most {max_wait:.1f}s".format(stage, **s)
+        for stage, s in sorted(stats().items()))))
+
+
+@contextlib.contextmanager
+def waiting(stage, *locks):
+    """Hold each of the given locks in turn while a stage runs, recording how long it waited."""
+    global _stats_logged
+    with _stats_lock:
+        s = _stats[stage]
+        s.waiting += 1
+    start = time.time()
+    held = []
+    try:
+        for lock in locks:
+            lock.__enter__()
+            held.append(lock)
+    finally:
+        if len(held) < len(locks):
+            # a lock could not be taken, so give up the ones which were
+            with _stats_lock:
+                s.waiting -= 1
+            for lock in reversed(held):
+                lock.__exit__(None, None, None)
+    waited = time.time() - start
+    with _stats_lock:
+        s.waiting -= 1
+        s.running += 1
+        s.waits += 1
+        s.wait_time += waited
+        s.max_wait = max(s.max_wait, waited)
+        queued = s.waiting
+    if waited >= 1:
+        logger.info("Waited {:.1f}s to {}, {} more waiting".format(waited, stage, queued))
+    try:
+        yield
+    finally:
+        with _stats_lock:
+            s.running -= 1
+            now = time.time()
+            due = now - _stats_logged >= STATS_INTERVAL
+            if due:
+                _stats_logged = now
+        for lock in reversed(held):
+            lock.__exit__(None, None, None)
+        # sum the stats up every STATS_INTERVAL seconds while releases are being published
+        if due:
+            log_stats()
+
+
+class Progress(object):
+    """
+    Follow the progress Docker reports while it pulls, builds or pushes an image.
+
+    Docker streams one JSON message per line, many of them progress updates for a single
+    layer. Each message is decoded once, layer progress is added up rather than logged, and
+    the overall progress is passed to callback at most every PROGRESS_INTERVAL seconds.
+    """
+
+    # statuses of a layer which has been pulled or pushed
+    DONE = ('Already exists', 'Pull complete', 'Layer already exists', 'Image already exists',
+            'Pushed')
+
+    def __init__(self, stage, callback=None):
+        self.stage = stage
+        self.callback = callback
+        # the status, and bytes done out of the total, of each layer
+        self.layers = collections.OrderedDict()
+        # the last message which was not about a single layer, such as a build step
+        self.message = ''
+        self._buffer = b''
+        self._reported = 0
+
+    def feed(self, chunk):
+        """Handle each complete message in a chunk of the stream."""
+        lines = (self._buffer + chunk).split(b'\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            self._handle(line)
+        if self.callback and time.time() - self._reported >= PROGRESS_INTERVAL:
+            self.report()
+
+    def close(self):
+        """Handle what is left of the stream once it has ended, and report the final progress."""
+        self._handle(self._buffer)
+        self._buffer = b''
+        if self.callback:
+            self.report()
+
+    def report(self):
+        self._reported = time.time()
+        self.callback(self.summary())
+
+    def summary(self):
+        """Return the overall progress: how many layers are done, and how many bytes."""
+        return {
+            'stage': self.stage,
+            'layers': len(self.layers),
+            'done': sum(1 for status, _, _ in self.layers.values() if status in self.DONE),
+            'current': sum(current for _, current, _ in self.layers.values()),
+            'total': sum(total for _, _, total in self.layers.values()),
+            'message': self.message,
+        }
+
+    def _handle(self, line):
+        line = line.strip()
+        if not line:
+            return
+        try:
+            message = json.loads(line)
+        except ValueError:
+            logger.warning("Could not decode Docker {} progress: {}".format(self.stage, line))
+            return
+        if 'error' in message:
+            raise docker.errors.DockerException(message['error'])
+        status, layer = message.get('status'), message.get('id')
+        # only the messages about a single layer report its progress, if only as {}
+        if status and layer and 'progressDetail' in message:
+            detail = message['progressDetail'] or {}
+            _, current, total = self.layers.get(layer, (None, 0, 0))
+            if detail.get('total'):
+                current, total = detail.get('current', 0), detail['total']
+            elif status in self.DONE:
+                current = total
+            self.layers[layer] = (status, current, total)
+            return
+        text = (message.get('stream') or status or '').strip()
+        if text:
+            self.message = text
+            logger.debug(text)
+
+
+def report_stage(progress, stage, message):
+    """
+    Pass a stage which does not go through Docker, such as a request to deis-registry, to
+    progress in the same form as the progress of a pull, build or push.
+    """
+    if progress:
+        p = Progress(stage, progress)
+        p.message = message
+        p.report()
+
+
+def follow(stream, stage, progress=None):
+    """
+    Follow a Docker progress stream to its end, raising DockerException if it reports an error.
+
+    :return: the :class:`Progress` of the stream
+    """
+    p = Progress(stage, progress)
     for chunk in stream:
-        logger.debug(chunk)
-        # error handling requires looking at the response body
-        if '"error"' in chunk.lower():
-            raise docker.errors.DockerException(chunk)
+        p.feed(chunk)
+    p.close()
+    return p
 
 
 def strip_prefix(name):
@@ -114,7 +479,9 @@ def strip_prefix(name):
     return '/'.join(p for p in paths if p and '.' not in p and ':' not in p)
 
 
-def publish_release(source, config, target, deis_registry):
+def publish_release(source, config, target, deis_registry, published=None, bake_config=True,
+                    progress=None):
 
     client = DockerClient()
-    return client.publish_release(source, config, target, deis_registry)
+    return client.publish_release(source, config, target, deis_registry, published,
+                                  bake_config, progress)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Publish and remove Docker images through the HTTP API of deis-registry, without Docker."""
+
+from __future__ import unicode_literals
+import datetime
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+import docker
+import requests
+
+logger = logging.getLogger(__name__)
+
+# one connection pool shared by every request to deis-registry in this process
+session = requests.Session()
+
+# the layer of an image which only changes its config: a tar archive without any entries
+EMPTY_LAYER = b'\0' * 1024
+# seconds to wait for deis-registry to answer a request
+TIMEOUT = 60
+
+
+class RegistryError(Exception):
+    """deis-registry could not be reached or refused a request."""
+
+
+class RegistryClient(object):
+    """
+    Use version 1 of the Docker registry API to tag images and add config to them in
+    deis-registry.
+
+    Images are never pulled, built or pushed, so publishing a release this way only moves a
+    few small documents, however large the image and wherever the controller runs.
+    """
+
+    def __init__(self, url=None):
+        self.url = (url or settings.REGISTRY_URL).rstrip('/')
+
+    def get_tag(self, repo, tag):
+        """Return the ID of the image a tag of a repository points to, or None."""
+        r = self._request('GET', '/v1/repositories/{}/tags/{}'.format(repo, tag), ok=(200, 404))
+        return r.json() if r.status_code == 200 else None
+
+    def set_tag(self, repo, tag, image_id):
+        """Point a tag of a repository at an image which is in the registry."""
+        logger.info("Tagging image {} as {}:{} in deis-registry".format(image_id, repo, tag))
+        # list the image in the repository's index first, as "docker push" does
+        self._request('PUT', '/v1/repositories/{}/'.format(repo), json.dumps([{'id': image_id}]),
+                      ok=(200, 201, 204))
+        self._request('PUT', '/v1/repositories/{}/tags/{}'.format(repo, tag),
+                      json.dumps(image_id))
+
+    def get_tags(self, repo):
+        """Return the ID of the image each tag of a repository points to, keyed by tag."""
+        r = self._request('GET', '/v1/repositories/{}/tags'.format(repo), ok=(200, 404))
+        return r.json() if r.status_code == 200 else {}
+
+    def delete_tag(self, repo, tag):
+        """Delete a tag of a repository, leaving the image it points to in the registry."""
+        logger.info("Deleting tag {}:{} from deis-registry".format(repo, tag))
+        self._request('DELETE', '/v1/repositories/{}/tags/{}'.format(repo, tag), ok=(200, 404))
+
+    def retag(self, image, repo, tag):
+        """Publish an image already in deis-registry under another tag."""
+        src_name, src_tag = docker.utils.parse_repository_tag(image)
+        image_id = self.get_tag(src_name, src_tag)
+        if image_id is None:
+            raise RegistryError("{} is not in deis-registry".format(image))
+        self.set_tag(repo, tag, image_id)
+
+    def get_image(self, image_id):
+        """Return the metadata of an image in the registry, or None."""
+        r = self._request('GET', '/v1/images/{}/json'.format(image_id), ok=(200, 404))
+        return r.json() if r.status_code == 200 else None
+
+    def add_config(self, parent_id, config):
+        """
+        Add an image to the registry which sets config as environment variables on top of
+        another, as the "last-mile" layer built by :meth:`DockerClient.build` does.
+
+        The ID of the new image is derived from its parent and config, so that it is only
+        uploaded once however often it is asked for.
+
+        :return: the ID of the new image
+        """
+        image_id = hashlib.sha256(json.dumps([parent_id, config], sort_keys=True)).hexdigest()
+        if self.get_image(image_id) is not None:
+            return image_id
+        parent = self.get_image(parent_id)
+        if parent is None:
+            raise RegistryError("image {} is not in deis-registry".format(parent_id))
+        parent_config = parent.get('config') or {}
+        env = [e for e in parent_config.get('Env') or [] if e.split('=', 1)[0] not in config]
+        env.extend('{}={}'.format(k, v) for k, v in sorted(config.items()))
+        metadata = {
+            'id': image_id,
+            'parent': parent_id,
+            'created': datetime.datetime.utcnow().isoformat() + 'Z',
+            'container_config': dict(parent_config, Env=env, Cmd=[
+                '/bin/sh', '-c', '#(nop) ENV {}'.format(' '.join(sorted(config)))]),
+            'config': dict(parent_config, Env=env),
+            'architecture': parent.get('architecture', 'amd64'),
+            'os': parent.get('os', 'linux'),
+            'Size': 0,
+        }
+        data = json.dumps(metadata).encode('utf-8')
+        logger.info("Adding config to image {} in deis-registry as {}".format(parent_id, image_id))
+        path = '/v1/images/{}'.format(image_id)
+        self._request('PUT', path + '/json', data)
+        r = self._request('PUT', path + '/layer', EMPTY_LAYER)
+        # the registry compares the checksum with the one it computed for the layer, which it
+        # hands back in a session cookie
+        checksum = 'sha256:' + hashlib.sha256(data + b'\n' + EMPTY_LAYER).hexdigest()
+        self._request('PUT', path + '/checksum', cookies=r.cookies,
+                      headers={'X-Docker-Checksum-Payload': checksum})
+        return image_id
+
+    def _request(self, method, path, data=None, ok=(200,), **kwargs):
+        url = self.url + path
+        try:
+            r = session.request(method, url, data=data, timeout=TIMEOUT, **kwargs)
+        except requests.exceptions.RequestException as e:
+            raise RegistryError("{} {} failed: {}".format(method, url, e))
+        if r.status_code not in ok:
+            raise RegistryError("{} {} returned a {} status code: {}".format(
+                method, url, r.status_code, r.text[:200]))
+        return r
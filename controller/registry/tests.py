@@ -4,6 +4,10 @@ Unit tests for the Deis registry app.
 Run the tests with "./manage.py test registry"
 """
 
+import hashlib
+import json
+import threading
+import time
 import unittest
 try:
     from unittest import mock
@@ -11,9 +15,12 @@ except ImportError:
     import mock
 
 from django.conf import settings
+from django.test.utils import override_settings
+import docker
 from rest_framework.exceptions import PermissionDenied
-from registry.dockerclient import DockerClient
-from registry.dockerclient import strip_prefix
+from registry.dockerclient import BuildSlot, DockerClient
+from registry.dockerclient import Progress, follow, stats, strip_prefix, waiting
+from registry.registryclient import EMPTY_LAYER, RegistryClient
 
 
 @mock.patch('docker.Client')
@@ -22,9 +29,11 @@ class DockerClientTest(unittest.TestCase):
 
     def setUp(self):
         settings.REGISTRY_HOST, settings.REGISTRY_PORT = 'localhost', 5000
+        settings.REGISTRY_URL, settings.REGISTRY_API = 'http://localhost:5000', False
 
     def test_publish_release(self, mock_client):
         self.client = DockerClient()
+        self.client.client.inspect_image.return_value = {'Id': 'f2a8020'}
         self.client.publish_release('ozzy/embryo:git-f2a8020',
                                     {'POWERED_BY': 'Deis'}, 'ozzy/embryo:v4', True)
         self.assertTrue(self.client.client.pull.called)
@@ -45,6 +54,110 @@ class DockerClientTest(unittest.TestCase):
             self.client.publish_release(
                 'localhost:5000/deis/controller:v1.11.1', {}, 'deis/controller:v1.11.1', True)
 
+    @mock.patch('registry.registryclient.session')
+    def test_publish_release_cached(self, mock_session, mock_client):
+        registry = FakeRegistry()
+        mock_session.request.side_effect = registry.request
+        registry.add_image('ozzy/embryo:git-f2a8020', 'f2a8020')
+        self.client = DockerClient()
+        published = {}
+        key = self.client.publish_release('ozzy/embryo:git-f2a8020', {'POWERED_BY': 'Deis'},
+                                          'ozzy/embryo:v4', True, published.get)
+        self.assertTrue(self.client.client.pull.called)
+        self.assertTrue(self.client.client.build.called)
+        # the same source image and config reuse the image of the earlier release, which is
+        # only tagged again in deis-registry
+        published[key] = 'ozzy/embryo:v4'
+        registry.add_image('ozzy/embryo:v4', 'b' * 64)
+        self.client.client.reset_mock()
+        reports = []
+        self.assertEqual(self.client.publish_release(
+            'ozzy/embryo:git-f2a8020', {'POWERED_BY': 'Deis'}, 'ozzy/embryo:v5', True,
+            published.get, progress=reports.append), key)
+        self.assertEqual(registry.tags['ozzy/embryo:v5'], 'b' * 64)
+        self.assertEqual([r['stage'] for r in reports], ['set_tag'])
+        self.assertFalse(self.client.client.pull.called)
+        self.assertFalse(self.client.client.build.called)
+        self.assertFalse(self.client.client.push.called)
+        # a change to the config or to the source image does not
+        self.assertNotEqual(self.client.publish_release(
+            'ozzy/embryo:git-f2a8020', {'POWERED_BY': 'Ozzy'}, 'ozzy/embryo:v6', True,
+            published.get), key)
+        registry.add_image('ozzy/embryo:git-f2a8020', 'f3a8020')
+        self.assertNotEqual(self.client.publish_release(
+            'ozzy/embryo:git-f2a8020', {'POWERED_BY': 'Deis'}, 'ozzy/embryo:v7', True,
+            published.get), key)
+        self.assertEqual(self.client.client.build.call_count, 2)
+        # a source image which is not in deis-registry is pulled to find its key
+        self.client.client.inspect_image.return_value = {'Id': 'f2a8020'}
+        self.client.client.reset_mock()
+        self.assertEqual(self.client.publish_release(
+            'ozzy/embryo:git-f4a8020', {'POWERED_BY': 'Deis'}, 'ozzy/embryo:v8', True,
+            published.get), key)
+        self.assertTrue(self.client.client.pull.called)
+        self.assertFalse(self.client.client.build.called)
+        self.assertEqual(registry.tags['ozzy/embryo:v8'], 'b' * 64)
+
+    def test_publish_release_runtime_config(self, mock_client):
+        self.client = DockerClient()
+        self.client.client.inspect_image.return_value = {'Id': 'f2a8020'}
+        key = self.client.publish_release('ozzy/embryo:git-f2a8020', {'POWERED_BY': 'Deis'},
+                                          'ozzy/embryo:v4', True, bake_config=False)
+        # the source image is published as it is
+        self.assertFalse(self.client.client.build.called)
+        self.client.client.tag.assert_called_with(
+            'localhost:5000/ozzy/embryo:git-f2a8020', 'localhost:5000/ozzy/embryo', tag='v4',
+            force=True)
+        self.client.client.push.assert_called_with(
+            'localhost:5000/ozzy/embryo', tag='v4', insecure_registry=True, stream=True)
+        # and so can be reused whatever the config
+        self.assertEqual(self.client.publish_release(
+            'ozzy/embryo:git-f2a8020', {'POWERED_BY': 'Ozzy'}, 'ozzy/embryo:v5', True,
+            bake_config=False), key)
+
+    @mock.patch('registry.registryclient.session')
+    def test_publish_in_registry(self, mock_session, mock_client):
+        registry = FakeRegistry()
+        mock_session.request.side_effect = registry.request
+        registry.add_image('ozzy/embryo:git-f2a8020', 'a' * 64)
+        self.client = DockerClient()
+        published = {}
+        with override_settings(REGISTRY_API=True):
+            reports = []
+            key = self.client.publish_release('ozzy/embryo:git-f2a8020', {'POWERED_BY': 'Deis'},
+                                              'ozzy/embryo:v4', True, published.get,
+                                              progress=reports.append)
+            image_id = registry.tags['ozzy/embryo:v4']
+            self.assertEqual(registry.images[image_id]['parent'], 'a' * 64)
+            # each request to the registry is reported as a stage
+            self.assertEqual([r['stage'] for r in reports], ['get_tag', 'add_config', 'set_tag'])
+            self.assertEqual(reports[-1], {
+                'stage': 'set_tag', 'layers': 0, 'done': 0, 'current': 0, 'total': 0,
+                'message': 'Tagging {} as ozzy/embryo:v4'.format(image_id)})
+            # an image published before is tagged again
+            published[key] = 'ozzy/embryo:v4'
+            self.client.publish_release('ozzy/embryo:git-f2a8020', {'POWERED_BY': 'Deis'},
+                                        'ozzy/embryo:v5', True, published.get)
+            self.assertEqual(registry.tags['ozzy/embryo:v5'], image_id)
+            # without baking config the source image is tagged as it is
+            self.client.publish_release('ozzy/embryo:git-f2a8020', {'POWERED_BY': 'Deis'},
+                                        'ozzy/embryo:v6', True, bake_config=False)
+            self.assertEqual(registry.tags['ozzy/embryo:v6'], 'a' * 64)
+            self.assertFalse(self.client.client.pull.called)
+            self.assertFalse(self.client.client.build.called)
+            self.assertFalse(self.client.client.push.called)
+            # Docker is used whenever the registry API fails
+            self.client.client.inspect_image.return_value = {'Id': 'f2a8020'}
+            self.client.publish_release('ozzy/embryo:git-f3a8020', {'POWERED_BY': 'Deis'},
+                                        'ozzy/embryo:v7', True)
+            self.assertTrue(self.client.client.pull.called)
+            self.assertTrue(self.client.client.build.called)
+            self.assertTrue(self.client.client.push.called)
+            # Test that blacklisted image names can't be published
+            with self.assertRaises(PermissionDenied):
+                self.client.publish_release(
+                    'ozzy/embryo:git-f2a8020', {}, 'deis/controller:v1.11.1', True)
+
     def test_build(self, mock_client):
         # test that self.client.build was called with proper arguments
         self.client = DockerClient()
@@ -76,6 +189,59 @@ class DockerClientTest(unittest.TestCase):
         with self.assertRaises(PermissionDenied):
             self.client.pull('localhost:5000/deis/controller', 'v1.11.1')
 
+    def test_pull_locks(self, mock_client):
+        """Test that only pulls of the same repository wait for each other."""
+        self.client = DockerClient()
+        started, finish = threading.Event(), threading.Event()
+
+        def pull(repo, **kwargs):
+            if repo == 'ozzy/embryo':
+                started.set()
+                finish.wait(5)
+            return []
+        self.client.client.pull.side_effect = pull
+        first = threading.Thread(target=self.client.pull, args=('ozzy/embryo', 'v4'))
+        first.start()
+        started.wait(5)
+        # another repository is pulled straight away
+        self.client.pull('ozzy/nucleus', 'v4')
+        second = threading.Thread(target=self.client.pull, args=('ozzy/embryo', 'v5'))
+        second.start()
+        for _ in range(50):
+            if stats()['pull']['waiting']:
+                break
+            time.sleep(0.1)
+        self.assertEqual(stats()['pull']['waiting'], 1)
+        self.assertEqual(stats()['pull']['running'], 1)
+        finish.set()
+        first.join()
+        second.join()
+        self.assertEqual(self.client.client.pull.call_count, 3)
+        self.assertEqual(stats()['pull']['waiting'], 0)
+        self.assertEqual(stats()['pull']['running'], 0)
+
+    def test_log_stats(self, mock_client):
+        """Test that the stats are logged every STATS_INTERVAL seconds while publishing."""
+        with mock.patch('registry.dockerclient.logger') as mock_logger, \
+                mock.patch('registry.dockerclient.STATS_INTERVAL', 0):
+            with waiting('tag', threading.Lock()):
+                pass
+        message = mock_logger.info.call_args[0][0]
+        self.assertTrue(message.startswith('Publish stats: '))
+        self.assertIn('tag: 0 waiting, 0 running, waited ', message)
+        with mock.patch('registry.dockerclient.logger') as mock_logger, \
+                mock.patch('registry.dockerclient.STATS_INTERVAL', 300):
+            with waiting('tag', threading.Lock()):
+                pass
+        self.assertFalse(mock_logger.info.called)
+
+    def test_build_slots(self, mock_client):
+        with override_settings(DOCKER_BUILD_SLOTS=2):
+            with BuildSlot(), BuildSlot():
+                self.assertRaises(IOError, BuildSlot(timeout=0).__enter__)
+            with BuildSlot(timeout=0):
+                pass
+
     def test_push(self, mock_client):
         self.client = DockerClient()
         self.client.push('ozzy/embryo', 'v4')
@@ -95,8 +261,109 @@ class DockerClientTest(unittest.TestCase):
         with self.assertRaises(PermissionDenied):
             self.client.tag('localhost:5000/deis/controller:v1.11.1', 'deis/controller', 'v1.11.1')
 
+    def test_follow(self, mock_client):
+        stream = [
+            b'{"status":"Pulling from ozzy/embryo","id":"v4"}\r\n',
+            b'{"status":"Pulling fs layer","progressDetail":{},"id":"a"}\r\n{"status":"Down',
+            b'loading","progressDetail":{"current":10,"total":40},"id":"a"}\r\n',
+            b'{"status":"Already exists","progressDetail":{},"id":"b"}\r\n',
+            b'{"status":"Downloading","progressDetail":{"current":20,"total":40},"id":"a"}\r\n',
+        ]
+        reports = []
+        p = follow(stream, 'pull', reports.append)
+        self.assertEqual(p.summary(), {'stage': 'pull', 'layers': 2, 'done': 1, 'current': 20,
+                                       'total': 40, 'message': 'Pulling from ozzy/embryo'})
+        # progress is reported at most every PROGRESS_INTERVAL seconds, and once at the end
+        self.assertEqual(len(reports), 2)
+        self.assertEqual(reports[-1], p.summary())
+        stream.append(b'{"status":"Pull complete","progressDetail":{},"id":"a"}')
+        self.assertEqual(follow(stream, 'pull').summary()['done'], 2)
+        # an error is raised as soon as it is reported
+        stream = [b'{"stream":"Step 0 : FROM ozzy/embryo"}\n',
+                  b'{"errorDetail":{"message":"not found"},"error":"not found"}\n',
+                  b'{"stream":"Step 1 : ENV POWERED_BY Deis"}\n']
+        p = Progress('build')
+        with self.assertRaises(docker.errors.DockerException):
+            for chunk in stream:
+                p.feed(chunk)
+        self.assertEqual(p.message, 'Step 0 : FROM ozzy/embryo')
+
     def test_strip_prefix(self, mock_client):
         self.assertEqual(strip_prefix('quay.io/boris/riotsugar'), 'boris/riotsugar')
         self.assertEqual(strip_prefix('127.0.0.1:5000/boris/galaxians'), 'boris/galaxians')
         self.assertEqual(strip_prefix('boris/jacksonhead'), 'boris/jacksonhead')
         self.assertEqual(strip_prefix(':8888/boris/pink'), 'boris/pink')
+
+
+class FakeRegistry(object):
+    """Answer requests the way deis-registry would, keeping its tags and images in memory."""
+
+    def __init__(self):
+        self.tags = {}
+        self.images = {}
+        self.layers = {}
+        self.uploads = 0
+
+    def add_image(self, name, image_id, **config):
+        self.tags[name] = image_id
+        self.images[image_id] = {'id': image_id, 'config': config}
+
+    def request(self, method, url, data=None, headers=None, **kwargs):
+        path = url.split('localhost:5000/v1/', 1)[1].rstrip('/').split('/')
+        if path[0] == 'repositories':
+            name = '/'.join(path[1:-2]) + ':' + path[-1]
+            if path[-2] != 'tags':
+                return mock.Mock(status_code=200)
+            if method == 'PUT':
+                self.tags[name] = json.loads(data)
+            elif name not in self.tags:
+                return mock.Mock(status_code=404)
+            return mock.Mock(status_code=200, json=lambda: self.tags[name])
+        image_id, resource = path[1], path[2]
+        if method == 'GET':
+            if image_id not in self.images:
+                return mock.Mock(status_code=404)
+            return mock.Mock(status_code=200, json=lambda: self.images[image_id])
+        if resource == 'json':
+            self.uploads += 1
+            self.layers[image_id] = data
+            self.images[image_id] = json.loads(data)
+        elif resource == 'layer':
+            self.layers[image_id] += b'\n' + data
+        elif resource == 'checksum':
+            checksum = 'sha256:' + hashlib.sha256(self.layers[image_id]).hexdigest()
+            if headers['X-Docker-Checksum-Payload'] != checksum:
+                return mock.Mock(status_code=400, text='Checksum mismatch')
+        return mock.Mock(status_code=200)
+
+
+@mock.patch('registry.registryclient.session')
+class RegistryClientTest(unittest.TestCase):
+    """Test that the client makes appropriate Docker registry API calls."""
+
+    def setUp(self):
+        self.registry = FakeRegistry()
+        self.client = RegistryClient('http://localhost:5000')
+
+    def test_retag(self, mock_session):
+        mock_session.request.side_effect = self.registry.request
+        self.registry.add_image('ozzy/embryo:v4', 'a' * 64)
+        self.client.retag('ozzy/embryo:v4', 'ozzy/embryo', 'v5')
+        self.assertEqual(self.registry.tags['ozzy/embryo:v5'], 'a' * 64)
+        self.assertIsNone(self.client.get_tag('ozzy/embryo', 'v6'))
+
+    def test_add_config(self, mock_session):
+        mock_session.request.side_effect = self.registry.request
+        self.registry.add_image('ozzy/embryo:git-f2a8020', 'a' * 64,
+                                Env=['PATH=/bin', 'POWERED_BY=Ozzy'], Cmd=['/start'])
+        image_id = self.client.add_config('a' * 64, {'POWERED_BY': 'Deis', 'DEIS_APP': 'embryo'})
+        image = self.registry.images[image_id]
+        self.assertEqual(image['parent'], 'a' * 64)
+        self.assertEqual(image['config']['Env'],
+                         ['PATH=/bin', 'DEIS_APP=embryo', 'POWERED_BY=Deis'])
+        self.assertEqual(image['config']['Cmd'], ['/start'])
+        self.assertTrue(self.registry.layers[image_id].endswith(EMPTY_LAYER))
+        # the same config is only uploaded once
+        self.assertEqual(self.client.add_config(
+            'a' * 64, {'POWERED_BY': 'Deis', 'DEIS_APP': 'embryo'}), image_id)
+        self.assertEqual(self.registry.uploads, 1)
@@ -1,7 +1,15 @@
+import importlib
+import json
+import math
+import threading
+
 
 class AbstractSchedulerClient(object):
     """
     A generic interface to a scheduler backend.
+
+    Containers are created and commands run with the variables in the ``env`` keyword
+    argument, if any, added to the environment of their image.
     """
 
     def __init__(self, target, auth, options, pkey):
@@ -18,10 +26,20 @@ class AbstractSchedulerClient(object):
         """Destroy a container."""
         raise NotImplementedError
 
-    def run(self, name, image, entrypoint, command):
+    def run(self, name, image, entrypoint, command, **kwargs):
         """Run a one-off command."""
         raise NotImplementedError
 
+    def run_stream(self, name, image, entrypoint, command, **kwargs):
+        """
+        Run a one-off command, yielding its output as it is written and then its exit code.
+
+        Schedulers which cannot follow the output of a command yield all of it once it exits.
+        """
+        rc, output = self.run(name, image, entrypoint, command, **kwargs)
+        yield output
+        yield rc
+
     def start(self, name):
         """Start a container."""
         raise NotImplementedError
@@ -30,6 +48,107 @@ class AbstractSchedulerClient(object):
         """Display the given job's running state."""
         raise NotImplementedError
 
+    def states(self, names):
+        """Display the running state of several jobs, keyed by job name."""
+        return {name: self.state(name) for name in names}
+
     def stop(self, name):
         """Stop a container."""
         raise NotImplementedError
+
+    def healthy(self):
+        """Check that the connection to the scheduler can be reused."""
+        return True
+
+    def reconnect(self):
+        """Drop the connection to the scheduler and establish a new one."""
+        pass
+
+
+class SchedulerClientPool(object):
+    """
+    Warm scheduler clients for a single scheduler configuration.
+
+    Scheduler clients hold one connection to their backend which is not safe to share
+    between threads, so every thread is handed its own client and keeps it for later calls.
+    """
+
+    def __init__(self, module, target, auth, options, pkey):
+        self.module = importlib.import_module(module)
+        self.target = target
+        self.auth = auth
+        self.options = options
+        self.pkey = pkey
+        self._local = threading.local()
+
+    def get(self):
+        """Return the calling thread's client, reconnecting it if it has gone stale."""
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self.module.SchedulerClient(self.target, self.auth, self.options, self.pkey)
+            self._local.client = client
+        elif not client.healthy():
+            client.reconnect()
+        return client
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_client(module, target, auth, options, pkey):
+    """Return a pooled client for the given scheduler module and connection settings."""
+    key = (module, target, auth, json.dumps(options, sort_keys=True, default=str), pkey)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = SchedulerClientPool(module, target, auth, options, pkey)
+    return pool.get()
+
+
+def collect_output(stream):
+    """Gather the chunks of output yielded by run_stream() into (exit code, output)."""
+    chunks = list(stream)
+    return chunks[-1], b''.join(chunks[:-1])
+
+
+def _batch_size(value, desired, default, round_up=False):
+    """Parse a number of containers, which may be given as a percentage of desired."""
+    if value is None or value == '':
+        value = default
+    value = str(value).strip()
+    try:
+        if value.endswith('%'):
+            size = desired * float(value[:-1]) / 100
+            return int(math.ceil(size) if round_up else math.floor(size))
+        return int(value)
+    except ValueError:
+        raise RuntimeError('invalid number of containers: {}'.format(value))
+
+
+def deploy_batches(desired, max_surge=None, max_unavailable=None, default_surge=1):
+    """
+    Plan a rolling deploy which replaces the desired number of old containers with new ones.
+
+    At most max_surge containers above the desired number may exist at once, and at most
+    max_unavailable of them may be missing, counting only the new containers of previous
+    batches as running. Both may be given as a percentage of desired; max_surge defaults
+    to default_surge.
+
+    :return: the number of (new, old) containers to scale to for each batch, in order
+    """
+    surge = _batch_size(max_surge, desired, default_surge, round_up=True)
+    unavailable = _batch_size(max_unavailable, desired, 0)
+    if surge < 0 or unavailable < 0:
+        raise RuntimeError('the number of containers in a batch cannot be negative')
+    if not surge and not unavailable:
+        surge = 1
+    batches = []
+    new, old = 0, desired
+    while new < desired or old > 0:
+        new, old = (min(desired, desired + surge - old),
+                    max(0, min(old, desired - unavailable - new)))
+        batches.append((new, old))
+    return batches
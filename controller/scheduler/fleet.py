@@ -1,22 +1,47 @@
 import base64
+import contextlib
 import copy
 import cStringIO
 import httplib
 import json
+import logging
 import paramiko
 import re
+import select
 import socket
+import threading
 import time
 
 from django.conf import settings
 
-from . import AbstractSchedulerClient
+from . import AbstractSchedulerClient, collect_output
 from .states import JobState
 
 
+logger = logging.getLogger(__name__)
+
 MATCH = re.compile(
     '(?P<app>[a-z0-9-]+)_?(?P<version>v[0-9]+)?\.?(?P<c_type>[a-z-_]+)?.(?P<c_num>[0-9]+)')
 RETRIES = 3
+SYSTEMD_ACTIVE_STATE_MAP = {
+    'active': 'up',
+    'reloading': 'down',
+    'inactive': 'created',
+    'failed': 'crashed',
+    'activating': 'down',
+    'deactivating': 'down',
+}
+# seconds between polls of fleet's unit states while threads are waiting on them
+STATE_POLL_INTERVAL = 0.5
+# seconds a one-off command may go without starting or writing output; this matches the
+# timeout on the router and in the app unit files
+RUN_TIMEOUT = 1200
+# seconds the clocks of the controller and the hosts may be apart
+RUN_CLOCK_SKEW = 60
+# bytes read at a time from a one-off command's output
+RUN_CHUNK_SIZE = 8192
+# seconds between checks for a free session on a host's SSH connection
+SESSION_POLL_INTERVAL = 0.1
 
 
 class UHTTPConnection(httplib.HTTPConnection):
@@ -42,11 +67,37 @@ class FleetHTTPClient(AbstractSchedulerClient):
 
     # connection helpers
 
-    def _request_unit(self, method, name, body=None):
+    def healthy(self):
+        """Check that fleet has not closed the socket or left unread data on it."""
+        sock = self.conn.sock
+        if sock is None:
+            # not connected yet; httplib will connect on the next request
+            return True
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (select.error, socket.error):
+            return False
+        return not readable
+
+    def reconnect(self):
+        self.conn.close()
+        self.conn = UHTTPConnection(self.target)
+
+    def _request(self, method, url, body=None):
+        """Send a request over the shared connection, reconnecting once if it went stale."""
         headers = {'Content-Type': 'application/json'}
-        self.conn.request(method, '/v1-alpha/units/{name}.service'.format(**locals()),
-                                  headers=headers, body=json.dumps(body))
-        return self.conn.getresponse()
+        for attempt in xrange(2):
+            try:
+                self.conn.request(method, url, headers=headers, body=body)
+                return self.conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                if attempt:
+                    raise
+                self.reconnect()
+
+    def _request_unit(self, method, name, body=None):
+        return self._request(method, '/v1-alpha/units/{name}.service'.format(**locals()),
+                             body=json.dumps(body))
 
     def _get_unit(self, name):
         for attempt in xrange(RETRIES):
@@ -77,10 +128,7 @@ class FleetHTTPClient(AbstractSchedulerClient):
                     raise
 
     def _delete_unit(self, name):
-        headers = {'Content-Type': 'application/json'}
-        self.conn.request('DELETE', '/v1-alpha/units/{name}.service'.format(**locals()),
-                          headers=headers)
-        resp = self.conn.getresponse()
+        resp = self._request('DELETE', '/v1-alpha/units/{name}.service'.format(**locals()))
         data = resp.read()
         if resp.status not in (404, 204):
             errmsg = "Failed to delete unit: {} {} - {}".format(
@@ -89,12 +137,10 @@ class FleetHTTPClient(AbstractSchedulerClient):
         return data
 
     def _get_state(self, name=None):
-        headers = {'Content-Type': 'application/json'}
         url = '/v1-alpha/state'
         if name:
             url += '?unitName={name}.service'.format(**locals())
-        self.conn.request('GET', url, headers=headers)
-        resp = self.conn.getresponse()
+        resp = self._request('GET', url)
         data = resp.read()
         if resp.status not in (200,):
             errmsg = "Failed to retrieve state: {} {} - {}".format(
@@ -102,11 +148,26 @@ class FleetHTTPClient(AbstractSchedulerClient):
             raise RuntimeError(errmsg)
         return json.loads(data)
 
+    def _get_states(self):
+        """Retrieve the state of every unit in the cluster, keyed by unit name."""
+        states = {}
+        url = '/v1-alpha/state'
+        while True:
+            resp = self._request('GET', url)
+            data = resp.read()
+            if resp.status not in (200,):
+                errmsg = "Failed to retrieve state: {} {} - {}".format(
+                    resp.status, resp.reason, data)
+                raise RuntimeError(errmsg)
+            page = json.loads(data)
+            for state in page.get('states', []):
+                states[state['name']] = state
+            if not page.get('nextPageToken'):
+                return states
+            url = '/v1-alpha/state?nextPageToken={}'.format(page['nextPageToken'])
+
     def _get_machines(self):
-        headers = {'Content-Type': 'application/json'}
-        url = '/v1-alpha/machines'
-        self.conn.request('GET', url, headers=headers)
-        resp = self.conn.getresponse()
+        resp = self._request('GET', '/v1-alpha/machines')
         data = resp.read()
         if resp.status not in (200,):
             errmsg = "Failed to retrieve machines: {} {} - {}".format(
@@ -138,6 +199,9 @@ class FleetHTTPClient(AbstractSchedulerClient):
             l.update({'cpu': ''})
         # set unit hostname
         l.update({'hostname': self._get_hostname(name)})
+        # pass environment variables through the unit, since they can hold anything
+        env = kwargs.get('env') or {}
+        l.update({'env': ' '.join('-e {}'.format(k) for k in sorted(env))})
         # should a special entrypoint be used
         entrypoint = kwargs.get('entrypoint')
         if entrypoint:
@@ -148,6 +212,9 @@ class FleetHTTPClient(AbstractSchedulerClient):
         # construct unit from template
         for f in unit:
             f['value'] = f['value'].format(**l)
+        for k, v in sorted(env.items()):
+            unit.append({"section": "Service", "name": "Environment",
+                         "value": _unit_env(k, v)})
         # prepare tags only if one was provided
         tags = kwargs.get('tags', {})
         unit_tags = tags.viewitems()
@@ -180,13 +247,11 @@ class FleetHTTPClient(AbstractSchedulerClient):
 
     def _wait_for_container_state(self, name):
         # wait for container to get scheduled
-        for _ in xrange(30):
-            states = self._get_state(name)
-            if states and len(states.get('states', [])) == 1:
-                return states.get('states')[0]
-            time.sleep(1)
-        else:
+        unit = '{}.service'.format(name)
+        states = get_state_watcher(self.target).wait(lambda states: unit in states, 30)
+        if states is None:
             raise RuntimeError('container timeout while retrieving state')
+        return states[unit]
 
     def _wait_for_container_running(self, name):
         # we bump to 20 minutes here to match the timeout on the router and in the app unit files
@@ -196,20 +261,21 @@ class FleetHTTPClient(AbstractSchedulerClient):
             raise RuntimeError('container failed to start')
 
     def _wait_for_job_state(self, name, state):
+        unit = '{}.service'.format(name)
+
+        def _reached(states):
+            try:
+                return unit in states and self._job_state(states[unit]) == state
+            except KeyError:
+                return False
+
         # we bump to 20 minutes here to match the timeout on the router and in the app unit files
-        for _ in xrange(1200):
-            if self.state(name) == state:
-                return
-            time.sleep(1)
-        else:
+        if get_state_watcher(self.target).wait(_reached, 1200) is None:
             raise RuntimeError('timeout waiting for job state: {}'.format(state))
 
     def _wait_for_destroy(self, name):
-        for _ in xrange(30):
-            if not self._get_state(name):
-                break
-            time.sleep(1)
-        else:
+        unit = '{}.service'.format(name)
+        if get_state_watcher(self.target).wait(lambda states: unit not in states, 30) is None:
             raise RuntimeError('timeout on container destroy')
 
     def stop(self, name):
@@ -235,16 +301,28 @@ class FleetHTTPClient(AbstractSchedulerClient):
                 if attempt == (RETRIES - 1):  # account for 0 indexing
                     raise
 
-    def run(self, name, image, entrypoint, command):  # noqa
+    def run(self, name, image, entrypoint, command, **kwargs):
         """Run a one-off command."""
+        return collect_output(self.run_stream(name, image, entrypoint, command, **kwargs))
+
+    def run_stream(self, name, image, entrypoint, command, **kwargs):
+        """
+        Run a one-off command, yielding its output as it is written and then its exit code.
+
+        The output is followed with docker logs over SSH on the host the container was
+        scheduled on. Docker reports when the container starts and what it exits with, so
+        nothing is polled once the container is scheduled.
+        """
         self._create_container(name, image, command, copy.deepcopy(RUN_TEMPLATE),
-                               entrypoint=entrypoint)
+                               entrypoint=entrypoint, env=kwargs.get('env'))
+        # events are replayed from here, so the container cannot start unnoticed
+        since = int(time.time()) - RUN_CLOCK_SKEW
         # launch the container
         self._put_unit(name, {'desiredState': 'launched'})
-        # wait for the container to get scheduled
-        state = self._wait_for_container_state(name)
 
         try:
+            # wait for the container to get scheduled
+            state = self._wait_for_container_state(name)
             machineID = state.get('machineID')
 
             # find the machine
@@ -260,105 +338,60 @@ class FleetHTTPClient(AbstractSchedulerClient):
             if not primaryIP:
                 raise RuntimeError('could not find host')
 
-            # prepare ssh key
-            file_obj = cStringIO.StringIO(base64.b64decode(self.pkey))
-            pkey = paramiko.RSAKey(file_obj=file_obj)
-
-            # grab output via docker logs over SSH
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(primaryIP, username="core", pkey=pkey)
-            # share a transport
-            tran = ssh.get_transport()
-
-            def _do_ssh(cmd):
-                with tran.open_session() as chan:
-                    chan.exec_command(cmd)
-                    while not chan.exit_status_ready():
-                        time.sleep(1)
-                    out = chan.makefile()
-                    output = out.read()
-                    rc = chan.recv_exit_status()
-                    return rc, output
-
-            # wait for container to launch
-            # we loop indefinitely here, as we have no idea how long the docker pull will take
-            while True:
-                rc, _ = _do_ssh('docker inspect {name}'.format(**locals()))
-                if rc == 0:
-                    break
-                time.sleep(1)
-            else:
-                raise RuntimeError('failed to create container')
-
+            ssh = get_ssh_pool(self.pkey)
             # wait for container to start
-            for _ in xrange(2):
-                _rc, _output = _do_ssh('docker inspect {name}'.format(**locals()))
-                if _rc != 0:
-                    raise RuntimeError('failed to inspect container')
-                _container = json.loads(_output)
-                started_at = _container[0]["State"]["StartedAt"]
-                if not started_at.startswith('0001'):
-                    break
-                time.sleep(1)
-            else:
-                raise RuntimeError('container failed to start')
-
-            # wait for container to complete
-            for _ in xrange(1200):
-                _rc, _output = _do_ssh('docker inspect {name}'.format(**locals()))
-                if _rc != 0:
-                    raise RuntimeError('failed to inspect container')
-                _container = json.loads(_output)
-                finished_at = _container[0]["State"]["FinishedAt"]
-                if not finished_at.startswith('0001'):
-                    break
-                time.sleep(1)
-            else:
-                raise RuntimeError('container timed out')
-
-            # gather container output
-            _rc, output = _do_ssh('docker logs {name}'.format(**locals()))
-            if _rc != 0:
-                raise RuntimeError('could not attach to container')
+            # there is no telling how long the docker pull will take
+            cmd = "docker events --since={} --filter 'container={}' --filter event=start"
+            with ssh.session(primaryIP) as chan:
+                chan.settimeout(RUN_TIMEOUT)
+                chan.exec_command(cmd.format(since, name))
+                if not _recv(chan, 'container failed to start'):
+                    raise RuntimeError('container failed to start')
+
+            # stream container output until it exits
+            with ssh.session(primaryIP) as chan:
+                chan.settimeout(RUN_TIMEOUT)
+                chan.set_combine_stderr(True)
+                chan.exec_command('docker logs -f {}'.format(name))
+                while True:
+                    output = _recv(chan, 'container timed out')
+                    if not output:
+                        break
+                    yield output
+                if chan.recv_exit_status() != 0:
+                    raise RuntimeError('could not attach to container')
 
             # determine container exit code
-            _rc, _output = _do_ssh('docker inspect {name}'.format(**locals()))
-            if _rc != 0:
-                raise RuntimeError('could not determine exit code')
-            container = json.loads(_output)
-            rc = container[0]["State"]["ExitCode"]
+            with ssh.session(primaryIP) as chan:
+                chan.settimeout(RUN_TIMEOUT)
+                chan.exec_command('docker wait {}'.format(name))
+                output = chan.makefile().read()
+                if chan.recv_exit_status() != 0:
+                    raise RuntimeError('could not determine exit code')
+            yield int(output)
 
         finally:
             # cleanup
             self._destroy_container(name)
             self._wait_for_destroy(name)
 
-        # return rc and output
-        return rc, output
+    def _job_state(self, state):
+        """Map a fleet unit state onto a JobState."""
+        activeState = state['systemdActiveState']
+        # FIXME (bacongobbler): when fleet loads a job, sometimes it'll automatically start and
+        # stop the container, which in our case will return as 'failed', even though
+        # the container is perfectly fine.
+        if activeState == 'failed' and state['systemdLoadState'] == 'loaded':
+            return JobState.created
+        return getattr(JobState, SYSTEMD_ACTIVE_STATE_MAP[activeState])
 
     def state(self, name):
         """Display the given job's running state."""
-        systemdActiveStateMap = {
-            'active': 'up',
-            'reloading': 'down',
-            'inactive': 'created',
-            'failed': 'crashed',
-            'activating': 'down',
-            'deactivating': 'down',
-        }
         try:
             # NOTE (bacongobbler): this call to ._get_unit() acts as a pre-emptive check to
             # determine if the job no longer exists (will raise a RuntimeError on 404)
             self._get_unit(name)
-            state = self._wait_for_container_state(name)
-            activeState = state['systemdActiveState']
-            # FIXME (bacongobbler): when fleet loads a job, sometimes it'll automatically start and
-            # stop the container, which in our case will return as 'failed', even though
-            # the container is perfectly fine.
-            if activeState == 'failed' and state['systemdLoadState'] == 'loaded':
-                return JobState.created
-            return getattr(JobState, systemdActiveStateMap[activeState])
+            return self._job_state(self._wait_for_container_state(name))
         except KeyError:
             # failed retrieving a proper response from the fleet API
             return JobState.error
@@ -367,14 +400,261 @@ class FleetHTTPClient(AbstractSchedulerClient):
             # which means it does not exist
             return JobState.destroyed
 
+    def states(self, names):
+        """Display the running state of several jobs with a single query to fleet."""
+        unit_states = self._get_states()
+        states = {}
+        for name in names:
+            state = unit_states.get('{}.service'.format(name))
+            if state is None:
+                # fleet no longer knows the unit, as once it has been destroyed
+                states[name] = JobState.destroyed
+                continue
+            try:
+                states[name] = self._job_state(state)
+            except KeyError:
+                states[name] = JobState.error
+        return states
+
 SchedulerClient = FleetHTTPClient
 
 
+class StateWatcher(object):
+    """
+    Poll fleet's unit states on behalf of every thread waiting for a unit to change state.
+
+    Waiting threads share one poll of /v1-alpha/state per tick and are woken up through a
+    condition variable when a new snapshot arrives, instead of each polling fleet on its own.
+    The poll loop only runs while there is someone waiting.
+    """
+
+    def __init__(self, target, interval=STATE_POLL_INTERVAL):
+        self.client = FleetHTTPClient(target, None, None, None)
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.states = {}
+        # number of polls begun, and the number of the poll the states come from
+        self.started = 0
+        self.generation = 0
+        self.waiters = 0
+        self.polling = False
+
+    def wait(self, predicate, timeout):
+        """
+        Wait until predicate(states) is true for a snapshot taken after this call started.
+
+        A poll which was already in flight when the call started may have read the states
+        before whatever the caller is waiting for, so only polls begun later are looked at.
+
+        :return: the unit states that satisfied the predicate, keyed by unit name, or None if
+                 the timeout expired first
+        """
+        deadline = time.time() + timeout
+        with self.cond:
+            seen = self.started
+            self.waiters += 1
+            try:
+                if not self.polling:
+                    self.polling = True
+                    poller = threading.Thread(target=self._poll)
+                    poller.daemon = True
+                    poller.start()
+                while True:
+                    if self.generation > seen:
+                        seen = self.generation
+                        if predicate(self.states):
+                            return self.states
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self.cond.wait(remaining)
+            finally:
+                self.waiters -= 1
+
+    def _poll(self):
+        while True:
+            with self.cond:
+                self.started += 1
+                poll = self.started
+            try:
+                states = self.client._get_states()
+            except Exception as e:
+                logger.warning('failed to retrieve unit states from fleet: {}'.format(e))
+                self.client.reconnect()
+                states = None
+            with self.cond:
+                if states is not None:
+                    self.states = states
+                    self.generation = poll
+                    self.cond.notify_all()
+                if not self.waiters:
+                    self.polling = False
+                    return
+            time.sleep(self.interval)
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def get_state_watcher(target):
+    """Return the state watcher shared by every client of the fleet API at target."""
+    with _watchers_lock:
+        if target not in _watchers:
+            _watchers[target] = StateWatcher(target)
+        return _watchers[target]
+
+
+class SSHConnection(object):
+    """A single SSH connection to a host, shared by every command run there."""
+
+    def __init__(self, host, pkey):
+        self.host = host
+        self.pkey = pkey
+        # caps the commands run over the connection at once
+        self.sessions = threading.BoundedSemaphore(settings.SSH_MAX_SESSIONS)
+        # number of threads using the connection, and when it was last used
+        self.active = 0
+        self.used = time.time()
+        self._client = None
+        self._lock = threading.Lock()
+
+    def open_session(self):
+        """Open a channel to run a command, connecting again if the connection was lost."""
+        with self._lock:
+            try:
+                return self._connect().open_session()
+            except (paramiko.SSHException, socket.error):
+                # the host may have dropped the connection while it was unused
+                self._close()
+                return self._connect().open_session()
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _connect(self):
+        if self._client is None or not self._client.get_transport().is_active():
+            self._close()
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect(self.host, username='core', pkey=self.pkey)
+            client.get_transport().set_keepalive(settings.SSH_KEEPALIVE)
+            self._client = client
+        return self._client.get_transport()
+
+    def _close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+class SSHPool(object):
+    """
+    SSH connections to the hosts one-off commands are run on, for a single private key.
+
+    Each host gets one connection which carries up to SSH_MAX_SESSIONS commands at once, while
+    further commands wait up to SSH_SESSION_TIMEOUT seconds for their turn. A background
+    thread closes connections which have not been used in SSH_IDLE_TIMEOUT seconds, and exits
+    once none are left.
+    """
+
+    def __init__(self, pkey):
+        # the key is parsed once rather than for every command
+        self.pkey = paramiko.RSAKey(file_obj=cStringIO.StringIO(base64.b64decode(pkey)))
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @contextlib.contextmanager
+    def session(self, host):
+        """Open a channel to run a command on host, and close it when done."""
+        conn = self._acquire(host)
+        try:
+            self._wait_for_session(conn)
+            try:
+                chan = conn.open_session()
+                try:
+                    yield chan
+                finally:
+                    chan.close()
+            finally:
+                conn.sessions.release()
+        finally:
+            with self._lock:
+                conn.active -= 1
+                conn.used = time.time()
+
+    def _wait_for_session(self, conn):
+        """Take one of a connection's sessions, giving up after SSH_SESSION_TIMEOUT seconds."""
+        deadline = time.time() + settings.SSH_SESSION_TIMEOUT
+        while not conn.sessions.acquire(False):
+            if time.time() >= deadline:
+                raise RuntimeError('too many commands running on host')
+            time.sleep(SESSION_POLL_INTERVAL)
+
+    def _acquire(self, host):
+        with self._lock:
+            conn = self._connections.get(host)
+            if conn is None:
+                conn = self._connections[host] = SSHConnection(host, self.pkey)
+            conn.active += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            return conn
+
+    def _run(self):
+        while True:
+            time.sleep(settings.SSH_IDLE_TIMEOUT)
+            now = time.time()
+            with self._lock:
+                for host, conn in self._connections.items():
+                    if not conn.active and now - conn.used > settings.SSH_IDLE_TIMEOUT:
+                        del self._connections[host]
+                        conn.close()
+                if not self._connections:
+                    self._thread = None
+                    return
+
+
+_ssh_pools = {}
+_ssh_pools_lock = threading.Lock()
+
+
+def get_ssh_pool(pkey):
+    """Return the SSH connections shared by every fleet client using the given private key."""
+    pool = _ssh_pools.get(pkey)
+    if pool is None:
+        with _ssh_pools_lock:
+            pool = _ssh_pools.get(pkey)
+            if pool is None:
+                pool = _ssh_pools[pkey] = SSHPool(pkey)
+    return pool
+
+
+def _unit_env(key, value):
+    """Quote an environment variable for an Environment= line of a unit file."""
+    value = u'{}={}'.format(key, value)
+    for char, escaped in (('\\', '\\\\'), ('"', '\\"'), ('\n', '\\n'), ('%', '%%')):
+        value = value.replace(char, escaped)
+    return u'"{}"'.format(value)
+
+
+def _recv(chan, error):
+    """Read the next chunk a command writes over SSH, or '' once it has exited."""
+    try:
+        return chan.recv(RUN_CHUNK_SIZE)
+    except socket.timeout:
+        raise RuntimeError(error)
+
+
 CONTAINER_TEMPLATE = [
     {"section": "Unit", "name": "Description", "value": "{name}"},
     {"section": "Service", "name": "ExecStartPre", "value": '''/bin/sh -c "IMAGE=$(etcdctl get /deis/registry/host 2>&1):$(etcdctl get /deis/registry/port 2>&1)/{image}; docker pull $IMAGE"'''},  # noqa
     {"section": "Service", "name": "ExecStartPre", "value": '''/bin/sh -c "docker inspect {name} >/dev/null 2>&1 && docker rm -f {name} || true"'''},  # noqa
-    {"section": "Service", "name": "ExecStart", "value": '''/bin/sh -c "IMAGE=$(etcdctl get /deis/registry/host 2>&1):$(etcdctl get /deis/registry/port 2>&1)/{image}; docker run --name {name} --rm {memory} {cpu} {hostname} -P $IMAGE {command}"'''},  # noqa
+    {"section": "Service", "name": "ExecStart", "value": '''/bin/sh -c "IMAGE=$(etcdctl get /deis/registry/host 2>&1):$(etcdctl get /deis/registry/port 2>&1)/{image}; docker run --name {name} --rm {memory} {cpu} {hostname} {env} -P $IMAGE {command}"'''},  # noqa
     {"section": "Service", "name": "ExecStop", "value": '''/usr/bin/docker stop {name}'''},
     {"section": "Service", "name": "TimeoutStartSec", "value": "20m"},
     {"section": "Service", "name": "TimeoutStopSec", "value": "10"},
@@ -387,6 +667,6 @@ RUN_TEMPLATE = [
     {"section": "Unit", "name": "Description", "value": "{name} admin command"},
     {"section": "Service", "name": "ExecStartPre", "value": '''/bin/sh -c "IMAGE=$(etcdctl get /deis/registry/host 2>&1):$(etcdctl get /deis/registry/port 2>&1)/{image}; docker pull $IMAGE"'''},  # noqa
     {"section": "Service", "name": "ExecStartPre", "value": '''/bin/sh -c "docker inspect {name} >/dev/null 2>&1 && docker rm -f {name} || true"'''},  # noqa
-    {"section": "Service", "name": "ExecStart", "value": '''/bin/sh -c "IMAGE=$(etcdctl get /deis/registry/host 2>&1):$(etcdctl get /deis/registry/port 2>&1)/{image}; docker run --name {name} --entrypoint={entrypoint} -a stdout -a stderr $IMAGE {command}"'''},  # noqa
+    {"section": "Service", "name": "ExecStart", "value": '''/bin/sh -c "IMAGE=$(etcdctl get /deis/registry/host 2>&1):$(etcdctl get /deis/registry/port 2>&1)/{image}; docker run --name {name} --entrypoint={entrypoint} {env} -a stdout -a stderr $IMAGE {command}"'''},  # noqa
     {"section": "Service", "name": "TimeoutStartSec", "value": "20m"},
 ]
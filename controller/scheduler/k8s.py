@@ -1,15 +1,19 @@
 import copy
 import httplib
 import json
+import logging
 import random
 import re
+import socket
 import string
+import threading
 import time
+import urllib
 
 from django.conf import settings
 from docker import Client
 from .states import JobState
-from . import AbstractSchedulerClient
+from . import AbstractSchedulerClient, deploy_batches
 
 
 POD_TEMPLATE = '''{
@@ -93,11 +97,283 @@ POD_DELETE = '''{
 }'''
 
 
+logger = logging.getLogger(__name__)
+
 RETRIES = 3
+# requests which can safely be sent again if their response was lost
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+# seconds the API server keeps a watch open before it has to be resumed
+WATCH_TIMEOUT = 60
 MATCH = re.compile(
     r'(?P<app>[a-z0-9-]+)_?(?P<version>v[0-9]+)?\.?(?P<c_type>[a-z-_]+)')
 
 
+class ConnectionPool(object):
+    """
+    Keep-alive HTTP connections to a single API server, shared by every client in the process.
+
+    At most `maxsize` requests are in flight at once and callers beyond that wait for a
+    connection to be handed back. Idle connections are reused most recent first.
+    """
+
+    def __init__(self, host, maxsize):
+        self.host = host
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxsize)
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Send a request and read the whole response.
+
+        The API server drops keep-alive connections which sit idle, so a request which could
+        not be sent over a reused connection is sent once more over a new one. So is one whose
+        response could not be read, but only if it is idempotent: the server may have applied
+        it already.
+
+        :return: the response's (status, data, reason)
+        """
+        with self._slots:
+            for attempt in xrange(2):
+                conn, reused = self._get(fresh=attempt > 0)
+                sent = False
+                try:
+                    conn.request(method, url, body=body, headers=headers or {})
+                    sent = True
+                    resp = conn.getresponse()
+                    data = resp.read()
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    if not reused or (sent and method not in IDEMPOTENT_METHODS):
+                        raise
+                    continue
+                if resp.will_close:
+                    conn.close()
+                else:
+                    self._put(conn)
+                return resp.status, data, resp.reason
+
+    def _get(self, fresh=False):
+        """Return an idle connection, or a new one, and whether it has been used before."""
+        with self._lock:
+            if fresh:
+                # a reset usually means every idle connection has gone stale
+                for conn in self._idle:
+                    conn.close()
+                del self._idle[:]
+            elif self._idle:
+                return self._idle.pop(), True
+        return httplib.HTTPConnection(self.host), False
+
+    def _put(self, conn):
+        with self._lock:
+            self._idle.append(conn)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host):
+    """Return the connection pool for an API server, given as host:port."""
+    pool = _pools.get(host)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(host)
+            if pool is None:
+                pool = _pools[host] = ConnectionPool(host, settings.K8S_MAX_CONNECTIONS)
+    return pool
+
+
+def _read_events(resp):
+    """Yield each JSON object of a watch stream as soon as it arrives."""
+    buf = ''
+    while True:
+        if resp.chunked:
+            # HTTPResponse.read() would block until the stream ends, so follow the chunks here
+            line = resp.fp.readline()
+            if not line.strip() or int(line.split(';', 1)[0], 16) == 0:
+                return
+            size = int(line.split(';', 1)[0], 16)
+            data = resp.fp.read(size)
+            resp.fp.read(2)
+        else:
+            data = resp.fp.readline()
+            if not data:
+                return
+        buf += data
+        while '\n' in buf:
+            line, buf = buf.split('\n', 1)
+            if line.strip():
+                yield json.loads(line)
+
+
+class PodWatcher(object):
+    """
+    The pods of an application's namespace, kept up to date through the watch API.
+
+    One watch stream is shared by every rollout of the namespace. The pods are listed once,
+    then each event from the stream is applied and wakes the threads waiting on the pods.
+    When the stream ends it is resumed from the last resourceVersion seen; if that is no
+    longer possible the pods are listed again. The stream is closed once nobody waits on it.
+    """
+
+    def __init__(self, host, apiversion, namespace):
+        self.host = host
+        self.url = '/api/{}/namespaces/{}/pods'.format(apiversion, namespace)
+        # every pod created by the scheduler is labelled with the application name
+        self.label_selector = 'name={}'.format(namespace)
+        self.pods = {}
+        self.resource_version = None
+        self._cond = threading.Condition()
+        self._waiters = 0
+        self._thread = None
+
+    def wait(self, selector, done, timeout):
+        """
+        Wait until done(pods) is true for the pods whose labels match selector.
+
+        :return: the matching pods, once done or when timeout seconds have passed
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            self._waiters += 1
+            try:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run)
+                    self._thread.daemon = True
+                    self._thread.start()
+                while True:
+                    pods = self._select(selector)
+                    if self.resource_version is not None and done(pods):
+                        return pods
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return pods
+                    self._cond.wait(remaining)
+            finally:
+                self._waiters -= 1
+
+    def _select(self, selector):
+        return [pod for pod in self.pods.values()
+                if all(pod['metadata'].get('labels', {}).get(k) == v
+                       for k, v in selector.items())]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._waiters:
+                    # nothing keeps the pods up to date from here on
+                    self.resource_version = None
+                    self._thread = None
+                    return
+            try:
+                if self.resource_version is None:
+                    self._list()
+                self._watch()
+            except Exception as e:
+                logger.info('watch of {} interrupted: {}'.format(self.url, e))
+                with self._cond:
+                    self.resource_version = None
+                time.sleep(1)
+
+    def _list(self):
+        url = '{}?{}'.format(self.url, urllib.urlencode({'labelSelector': self.label_selector}))
+        status, data, reason = get_pool(self.host).request('GET', url)
+        if not 200 <= status <= 299:
+            errmsg = "Failed to get Pods: {} {} - {}".format(status, reason, data)
+            raise RuntimeError(errmsg)
+        parsed_json = json.loads(data)
+        with self._cond:
+            self.pods = {pod['metadata']['name']: pod for pod in parsed_json['items']}
+            self.resource_version = parsed_json['metadata']['resourceVersion']
+            self._cond.notify_all()
+
+    def _watch(self):
+        url = '{}?{}'.format(self.url, urllib.urlencode({
+            'labelSelector': self.label_selector, 'watch': 'true',
+            'resourceVersion': self.resource_version, 'timeoutSeconds': WATCH_TIMEOUT}))
+        conn = httplib.HTTPConnection(self.host, timeout=WATCH_TIMEOUT + 10)
+        try:
+            conn.request('GET', url)
+            resp = conn.getresponse()
+            if not 200 <= resp.status <= 299:
+                errmsg = "Failed to watch Pods: {} {} - {}".format(
+                    resp.status, resp.reason, resp.read())
+                raise RuntimeError(errmsg)
+            for event in _read_events(resp):
+                self._apply(event)
+        finally:
+            conn.close()
+
+    def _apply(self, event):
+        pod = event['object']
+        if event['type'] == 'ERROR':
+            # usually "410 Gone": the resourceVersion is too old to resume from
+            raise RuntimeError(pod.get('message', 'watch error'))
+        with self._cond:
+            if event['type'] == 'DELETED':
+                self.pods.pop(pod['metadata']['name'], None)
+            else:
+                self.pods[pod['metadata']['name']] = pod
+            self.resource_version = pod['metadata']['resourceVersion']
+            self._cond.notify_all()
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def get_watcher(host, apiversion, namespace):
+    """Return the pod watcher for a namespace of an API server, given as host:port."""
+    key = (host, apiversion, namespace)
+    watcher = _watchers.get(key)
+    if watcher is None:
+        with _watchers_lock:
+            watcher = _watchers.get(key)
+            if watcher is None:
+                watcher = _watchers[key] = PodWatcher(host, apiversion, namespace)
+    return watcher
+
+
+def _scheduled(pods, num):
+    """Check that num pods are placed on nodes, raising if the scheduler cannot place one."""
+    for pod in pods:
+        for condition in pod['status'].get('conditions', []):
+            if condition['type'] == 'PodScheduled' and condition.get('reason') == 'Unschedulable':
+                raise RuntimeError(condition.get('message', 'Unschedulable'))
+    return len(pods) == num and all(pod['spec'].get('nodeName') for pod in pods)
+
+
+def _running(pods, num):
+    return len([pod for pod in pods if pod['status'].get('phase') == 'Running']) == num
+
+
+# the state of a job whose pods are all in a phase, from the most to the least alive
+POD_PHASE_STATES = (('Running', JobState.up), ('Pending', JobState.created),
+                    ('Succeeded', JobState.down), ('Failed', JobState.crashed))
+
+
+def _job_state(phases):
+    """
+    Map the phases of a job's pods to the state of the job, without waiting for pending pods
+    to run as state() does.
+    """
+    if not phases:
+        return JobState.destroyed
+    for phase, state in POD_PHASE_STATES:
+        if phase in phases:
+            return state
+    return JobState.error
+
+
+def _set_env(container, kwargs):
+    """Add the environment variables passed to the scheduler to a container spec."""
+    env = kwargs.get('env')
+    if env:
+        container['env'] = [{'name': k, 'value': v} for k, v in sorted(env.items())]
+
+
 class KubeHTTPClient(AbstractSchedulerClient):
 
     def __init__(self, target, auth, options, pkey):
@@ -106,17 +382,20 @@ class KubeHTTPClient(AbstractSchedulerClient):
         self.port = "8080"
         self.registry = settings.REGISTRY_HOST+":"+settings.REGISTRY_PORT
         self.apiversion = "v1"
-        self.conn = httplib.HTTPConnection(self.target+":"+self.port)
+        self.pool = get_pool(self.target+":"+self.port)
+
+    def _request(self, method, path, body=None):
+        """Send a request to the API server over a pooled connection, returning
+        (status, data, reason).
+        """
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        return self.pool.request(method, '/api/'+self.apiversion+path, body, headers)
+
+    def _watcher(self, namespace):
+        return get_watcher(self.target+":"+self.port, self.apiversion, namespace)
 
     def _get_old_rc(self, name, app_type):
-        con_app = httplib.HTTPConnection(self.target+":"+self.port)
-        con_app.request('GET', '/api/'+self.apiversion +
-                        '/namespaces/'+name+'/replicationcontrollers')
-        resp = con_app.getresponse()
-        data = resp.read()
-        reason = resp.reason
-        status = resp.status
-        con_app.close()
+        status, data, reason = self._request('GET', '/namespaces/'+name+'/replicationcontrollers')
         if not 200 <= status <= 299:
             errmsg = "Failed to get Replication Controllers: {} {} - {}".format(
                 status, reason, data)
@@ -136,23 +415,13 @@ class KubeHTTPClient(AbstractSchedulerClient):
             return 0
 
     def _get_rc_status(self, name, namespace):
-        conn_rc = httplib.HTTPConnection(self.target+":"+self.port)
-        conn_rc.request('GET', '/api/'+self.apiversion+'/' +
-                        'namespaces/'+namespace+'/replicationcontrollers/'+name)
-        resp = conn_rc.getresponse()
-        status = resp.status
-        conn_rc.close()
+        status, data, reason = self._request(
+            'GET', '/namespaces/'+namespace+'/replicationcontrollers/'+name)
         return status
 
     def _get_rc_(self, name, namespace):
-        conn_rc_resver = httplib.HTTPConnection(self.target+":"+self.port)
-        conn_rc_resver.request('GET', '/api/'+self.apiversion+'/' +
-                               'namespaces/'+namespace+'/replicationcontrollers/'+name)
-        resp = conn_rc_resver.getresponse()
-        data = resp.read()
-        reason = resp.reason
-        status = resp.status
-        conn_rc_resver.close()
+        status, data, reason = self._request(
+            'GET', '/namespaces/'+namespace+'/replicationcontrollers/'+name)
         if not 200 <= status <= 299:
             errmsg = "Failed to get Replication Controller:{} {} {} - {}".format(
                 name, status, reason, data)
@@ -169,74 +438,71 @@ class KubeHTTPClient(AbstractSchedulerClient):
         old_rc_name = old_rc["metadata"]["name"]
         new_rc_name = new_rc["metadata"]["name"]
         try:
-            count = 1
-            while desired >= count:
-                new_rc = self._scale_app(new_rc_name, count, app_name)
-                old_rc = self._scale_app(old_rc_name, desired-count, app_name)
-                count += 1
+            new, old = 0, desired
+            for new_target, old_target in deploy_batches(
+                    desired, kwargs.get('max_surge'), kwargs.get('max_unavailable')):
+                self._scale_batch(app_name, new_rc_name, new, new_target,
+                                  old_rc_name, old, old_target)
+                new, old = new_target, old_target
         except Exception as e:
-            self._scale_app(new_rc["metadata"]["name"], 0, app_name)
-            self._delete_rc(new_rc["metadata"]["name"], app_name)
-            self._scale_app(old_rc["metadata"]["name"], desired, app_name)
+            self._scale_app(new_rc_name, 0, app_name)
+            self._delete_rc(new_rc_name, app_name)
+            self._scale_app(old_rc_name, desired, app_name)
             err = '{} (deploy): {}'.format(name, e)
             raise RuntimeError(err)
         self._delete_rc(old_rc_name, app_name)
 
+    def _scale_batch(self, namespace, new_rc_name, new, new_target, old_rc_name, old, old_target):
+        """
+        Scale the new replication controller up and the old one down at the same time, then
+        check that every pod of the new one is running before the next batch goes ahead.
+        """
+        errors = []
+
+        def scale_down():
+            try:
+                self._scale_app(old_rc_name, old_target, namespace)
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=scale_down)
+        if old_target != old:
+            thread.start()
+        try:
+            ready = new_target == new or self._scale_app(new_rc_name, new_target, namespace)
+        finally:
+            if old_target != old:
+                thread.join()
+        if errors:
+            raise errors[0]
+        if not ready:
+            raise RuntimeError('{} did not get {} pods running'.format(new_rc_name, new_target))
+
     def _get_events(self, namespace):
-        con_get = httplib.HTTPConnection(self.target+":"+self.port)
-        con_get.request('GET', '/api/'+self.apiversion+'/namespaces/'+namespace+'/events')
-        resp = con_get.getresponse()
-        reason = resp.reason
-        status = resp.status
-        data = resp.read()
-        con_get.close()
+        status, data, reason = self._request('GET', '/namespaces/'+namespace+'/events')
         if not 200 <= status <= 299:
             errmsg = "Failed to get events: {} {} - {}".format(
                 status, reason, data)
             raise RuntimeError(errmsg)
         return (status, data, reason)
 
-    def _get_schedule_status(self, name, num, namespace):
-        pods = []
-        for _ in xrange(120):
-            count = 0
-            pods = []
-            status, data, reason = self._get_pods(namespace)
-            parsed_json = json.loads(data)
-            for pod in parsed_json['items']:
-                if pod['metadata']['generateName'] == name+'-':
-                    count += 1
-                    pods.append(pod['metadata']['name'])
-            if count == num:
-                break
-            time.sleep(1)
-        for _ in xrange(120):
-            count = 0
-            status, data, reason = self._get_events(namespace)
-            parsed_json = json.loads(data)
-            for event in parsed_json['items']:
-                if(event['involvedObject']['name'] in pods and
-                   event['source']['component'] == 'scheduler'):
-                    if event['reason'] == 'scheduled':
-                        count += 1
-                    else:
-                        raise RuntimeError(event['message'])
-            if count == num:
-                break
-            time.sleep(1)
+    def _get_schedule_status(self, selector, num, namespace):
+        pods = self._watcher(namespace).wait(selector, lambda pods: _scheduled(pods, num), 240)
+        if _scheduled(pods, num):
+            return
+        # the scheduler only reports some failures as events
+        names = [pod['metadata']['name'] for pod in pods]
+        status, data, reason = self._get_events(namespace)
+        for event in json.loads(data)['items']:
+            if(event['involvedObject']['name'] in names and
+               event['source']['component'] == 'scheduler' and event['reason'] != 'scheduled'):
+                raise RuntimeError(event['message'])
 
     def _scale_rc(self, rc, namespace):
         name = rc['metadata']['name']
         num = rc["spec"]["replicas"]
-        headers = {'Content-Type': 'application/json'}
-        conn_scalepod = httplib.HTTPConnection(self.target+":"+self.port)
-        conn_scalepod.request('PUT', '/api/'+self.apiversion+'/namespaces/'+namespace+'/' +
-                              'replicationcontrollers/'+name, headers=headers, body=json.dumps(rc))
-        resp = conn_scalepod.getresponse()
-        data = resp.read()
-        reason = resp.reason
-        status = resp.status
-        conn_scalepod.close()
+        status, data, reason = self._request(
+            'PUT', '/namespaces/'+namespace+'/replicationcontrollers/'+name, json.dumps(rc))
         if not 200 <= status <= 299:
             errmsg = "Failed to scale Replication Controller:{} {} {} - {}".format(
                 name, status, reason, data)
@@ -247,23 +513,16 @@ class KubeHTTPClient(AbstractSchedulerClient):
             if js_template["metadata"]["resourceVersion"] != resource_ver:
                 break
             time.sleep(1)
-        self._get_schedule_status(name, num, namespace)
-        for _ in xrange(120):
-            count = 0
-            status, data, reason = self._get_pods(namespace)
-            parsed_json = json.loads(data)
-            for pod in parsed_json['items']:
-                if(pod['metadata']['generateName'] == name+'-' and
-                   pod['status']['phase'] == 'Running'):
-                    count += 1
-            if count == num:
-                break
-            time.sleep(1)
+        selector = rc['spec']['selector']
+        self._get_schedule_status(selector, num, namespace)
+        pods = self._watcher(namespace).wait(selector, lambda pods: _running(pods, num), 120)
+        return _running(pods, num)
 
     def _scale_app(self, name, num, namespace):
+        """Scale a replication controller, returning whether all of its pods are running."""
         js_template = self._get_rc_(name, namespace)
         js_template["spec"]["replicas"] = num
-        self._scale_rc(js_template, namespace)
+        return self._scale_rc(js_template, namespace)
 
     def scale(self, name, image, command, **kwargs):
         app_name = kwargs.get('aname', {})
@@ -307,6 +566,7 @@ class KubeHTTPClient(AbstractSchedulerClient):
         js_template = json.loads(template)
         containers = js_template["spec"]["template"]["spec"]["containers"]
         containers[0]['args'] = args
+        _set_env(containers[0], kwargs)
         loc = locals().copy()
         loc.update(re.match(MATCH, container_fullname).groupdict())
         mem = kwargs.get('memory', {}).get(loc['c_type'])
@@ -321,15 +581,8 @@ class KubeHTTPClient(AbstractSchedulerClient):
         if cpu:
             cpu = float(cpu)/1024
             containers[0]["resources"]["limits"]["cpu"] = cpu
-        headers = {'Content-Type': 'application/json'}
-        conn_rc = httplib.HTTPConnection(self.target+":"+self.port)
-        conn_rc.request('POST', '/api/'+self.apiversion+'/namespaces/'+app_name+'/' +
-                        'replicationcontrollers', headers=headers, body=json.dumps(js_template))
-        resp = conn_rc.getresponse()
-        data = resp.read()
-        reason = resp.reason
-        status = resp.status
-        conn_rc.close()
+        status, data, reason = self._request(
+            'POST', '/namespaces/'+app_name+'/replicationcontrollers', json.dumps(js_template))
         if not 200 <= status <= 299:
             errmsg = "Failed to create Replication Controller:{} {} {} - {}".format(
                 name, status, reason, data)
@@ -349,13 +602,13 @@ class KubeHTTPClient(AbstractSchedulerClient):
 
     def create(self, name, image, command, **kwargs):
         """Create a container."""
-        self._create_rc(name, image, command, **kwargs)
+        rc = self._create_rc(name, image, command, **kwargs)
         app_type = name.split(".")[1]
         name = name.replace(".", "-")
         name = name.replace("_", "-")
         app_name = kwargs.get('aname', {})
         try:
-            self._create_service(name, app_name, app_type)
+            self._create_service(name, app_name, app_type, rc['spec']['selector'])
         except Exception as e:
             self._scale_app(name, 0, app_name)
             self._delete_rc(name, app_name)
@@ -363,35 +616,21 @@ class KubeHTTPClient(AbstractSchedulerClient):
             raise RuntimeError(err)
 
     def _get_service(self, name, namespace):
-        con_get = httplib.HTTPConnection(self.target+":"+self.port)
-        con_get.request('GET', '/api/'+self.apiversion+'/namespaces/'+namespace+'/services/'+name)
-        resp = con_get.getresponse()
-        reason = resp.reason
-        status = resp.status
-        data = resp.read()
-        con_get.close()
+        status, data, reason = self._request('GET', '/namespaces/'+namespace+'/services/'+name)
         if not 200 <= status <= 299:
             errmsg = "Failed to get Service: {} {} - {}".format(
                 status, reason, data)
             raise RuntimeError(errmsg)
         return (status, data, reason)
 
-    def _create_service(self, name, app_name, app_type):
+    def _create_service(self, name, app_name, app_type, selector):
         random.seed(app_name)
         app_id = random.randint(1, 100000)
         appname = "app-"+str(app_id)
-        actual_pod = {}
-        for _ in xrange(300):
-            status, data, reason = self._get_pods(app_name)
-            parsed_json = json.loads(data)
-            for pod in parsed_json['items']:
-                if('generateName' in pod['metadata'] and
-                   pod['metadata']['generateName'] == name+'-'):
-                    actual_pod = pod
-                    break
-            if actual_pod and actual_pod['status']['phase'] == 'Running':
-                break
-            time.sleep(1)
+        pods = self._watcher(app_name).wait(
+            selector, lambda pods: any(_running([pod], 1) for pod in pods), 300)
+        pods.sort(key=lambda pod: not _running([pod], 1))
+        actual_pod = pods[0] if pods else {}
         container_id = actual_pod['status']['containerStatuses'][0]['containerID'].split("//")[1]
         ip = actual_pod['status']['hostIP']
         docker_cli = Client("tcp://{}:2375".format(ip), timeout=1200, version='1.17')
@@ -404,15 +643,8 @@ class KubeHTTPClient(AbstractSchedulerClient):
         l['type'] = app_type
         l["name"] = appname
         template = string.Template(SERVICE_TEMPLATE).substitute(l)
-        headers = {'Content-Type': 'application/json'}
-        conn_serv = httplib.HTTPConnection(self.target+":"+self.port)
-        conn_serv.request('POST', '/api/'+self.apiversion+'/namespaces/'+app_name+'/services',
-                          headers=headers, body=copy.deepcopy(template))
-        resp = conn_serv.getresponse()
-        data = resp.read()
-        reason = resp.reason
-        status = resp.status
-        conn_serv.close()
+        status, data, reason = self._request(
+            'POST', '/namespaces/'+app_name+'/services', copy.deepcopy(template))
         if status == 409:
             status, data, reason = self._get_service(appname, app_name)
             srv = json.loads(data)
@@ -420,15 +652,8 @@ class KubeHTTPClient(AbstractSchedulerClient):
                 return
             srv['spec']['selector']['type'] = app_type
             srv['spec']['ports'][0]['targetPort'] = port
-            headers = {'Content-Type': 'application/json'}
-            conn_scalepod = httplib.HTTPConnection(self.target+":"+self.port)
-            conn_scalepod.request('PUT', '/api/'+self.apiversion+'/namespaces/'+app_name+'/' +
-                                  'services/'+appname, headers=headers, body=json.dumps(srv))
-            resp = conn_scalepod.getresponse()
-            data = resp.read()
-            reason = resp.reason
-            status = resp.status
-            conn_scalepod.close()
+            status, data, reason = self._request(
+                'PUT', '/namespaces/'+app_name+'/services/'+appname, json.dumps(srv))
             if not 200 <= status <= 299:
                 errmsg = "Failed to update the Service:{} {} {} - {}".format(
                     name, status, reason, data)
@@ -447,15 +672,8 @@ class KubeHTTPClient(AbstractSchedulerClient):
         pass
 
     def _delete_rc(self, name, namespace):
-        headers = {'Content-Type': 'application/json'}
-        con_dest = httplib.HTTPConnection(self.target+":"+self.port)
-        con_dest.request('DELETE', '/api/'+self.apiversion+'/namespaces/'+namespace+'/' +
-                         'replicationcontrollers/'+name, headers=headers, body=POD_DELETE)
-        resp = con_dest.getresponse()
-        reason = resp.reason
-        status = resp.status
-        data = resp.read()
-        con_dest.close()
+        status, data, reason = self._request(
+            'DELETE', '/namespaces/'+namespace+'/replicationcontrollers/'+name, POD_DELETE)
         if not 200 <= status <= 299:
             errmsg = "Failed to delete Replication Controller:{} {} {} - {}".format(
                 name, status, reason, data)
@@ -468,15 +686,8 @@ class KubeHTTPClient(AbstractSchedulerClient):
         name = name[0]+'-'+name[1]
         name = name.replace("_", "-")
 
-        headers = {'Content-Type': 'application/json'}
-        con_dest = httplib.HTTPConnection(self.target+":"+self.port)
-        con_dest.request('DELETE', '/api/'+self.apiversion+'/namespaces/'+appname+'/' +
-                         'replicationcontrollers/'+name, headers=headers, body=POD_DELETE)
-        resp = con_dest.getresponse()
-        reason = resp.reason
-        status = resp.status
-        data = resp.read()
-        con_dest.close()
+        status, data, reason = self._request(
+            'DELETE', '/namespaces/'+appname+'/replicationcontrollers/'+name, POD_DELETE)
         if status == 404:
             return
         if not 200 <= status <= 299:
@@ -487,14 +698,8 @@ class KubeHTTPClient(AbstractSchedulerClient):
         random.seed(appname)
         app_id = random.randint(1, 100000)
         app_name = "app-"+str(app_id)
-        con_serv = httplib.HTTPConnection(self.target+":"+self.port)
-        con_serv.request('DELETE', '/api/'+self.apiversion +
-                         '/namespaces/'+appname+'/services/'+app_name)
-        resp = con_serv.getresponse()
-        reason = resp.reason
-        status = resp.status
-        data = resp.read()
-        con_serv.close()
+        status, data, reason = self._request(
+            'DELETE', '/namespaces/'+appname+'/services/'+app_name)
         if status != 404 and not 200 <= status <= 299:
             errmsg = "Failed to delete service:{} {} {} - {}".format(
                 name, status, reason, data)
@@ -505,36 +710,17 @@ class KubeHTTPClient(AbstractSchedulerClient):
         for pod in parsed_json['items']:
             if 'generateName' in pod['metadata'] and pod['metadata']['generateName'] == name+'-':
                 self._delete_pod(pod['metadata']['name'], appname)
-        con_ns = httplib.HTTPConnection(self.target+":"+self.port)
-        con_ns.request('DELETE', '/api/'+self.apiversion+'/namespaces/'+appname)
-        resp = con_ns.getresponse()
-        reason = resp.reason
-        status = resp.status
-        data = resp.read()
-        con_ns.close()
+        status, data, reason = self._request('DELETE', '/namespaces/'+appname)
         if not 200 <= status <= 299:
             errmsg = "Failed to delete namespace:{} {} {} - {}".format(
                 appname, status, reason, data)
             raise RuntimeError(errmsg)
 
     def _get_pod(self, name, namespace):
-        conn_pod = httplib.HTTPConnection(self.target+":"+self.port)
-        conn_pod.request('GET', '/api/'+self.apiversion+'/namespaces/'+namespace+'/pods/'+name)
-        resp = conn_pod.getresponse()
-        status = resp.status
-        data = resp.read()
-        reason = resp.reason
-        conn_pod.close()
-        return (status, data, reason)
+        return self._request('GET', '/namespaces/'+namespace+'/pods/'+name)
 
     def _get_pods(self, namespace):
-        con_get = httplib.HTTPConnection(self.target+":"+self.port)
-        con_get.request('GET', '/api/'+self.apiversion+'/namespaces/'+namespace+'/pods')
-        resp = con_get.getresponse()
-        reason = resp.reason
-        status = resp.status
-        data = resp.read()
-        con_get.close()
+        status, data, reason = self._request('GET', '/namespaces/'+namespace+'/pods')
         if not 200 <= status <= 299:
             errmsg = "Failed to get Pods: {} {} - {}".format(
                 status, reason, data)
@@ -542,15 +728,8 @@ class KubeHTTPClient(AbstractSchedulerClient):
         return (status, data, reason)
 
     def _delete_pod(self, name, namespace):
-        headers = {'Content-Type': 'application/json'}
-        con_dest_pod = httplib.HTTPConnection(self.target+":"+self.port)
-        con_dest_pod.request('DELETE', '/api/'+self.apiversion+'/namespaces/' +
-                             namespace+'/pods/'+name, headers=headers, body=POD_DELETE)
-        resp = con_dest_pod.getresponse()
-        reason = resp.reason
-        status = resp.status
-        data = resp.read()
-        con_dest_pod.close()
+        status, data, reason = self._request(
+            'DELETE', '/namespaces/'+namespace+'/pods/'+name, POD_DELETE)
         if not 200 <= status <= 299:
             errmsg = "Failed to delete Pod: {} {} - {}".format(
                 status, reason, data)
@@ -567,14 +746,7 @@ class KubeHTTPClient(AbstractSchedulerClient):
             raise RuntimeError(errmsg)
 
     def _pod_log(self, name, namespace):
-        conn_log = httplib.HTTPConnection(self.target+":"+self.port)
-        conn_log.request('GET', '/api/'+self.apiversion+'/namespaces/' +
-                         namespace+'/pods/'+name+'/log')
-        resp = conn_log.getresponse()
-        status = resp.status
-        data = resp.read()
-        reason = resp.reason
-        conn_log.close()
+        status, data, reason = self._request('GET', '/namespaces/'+namespace+'/pods/'+name+'/log')
         if not 200 <= status <= 299:
             errmsg = "Failed to get the log: {} {} - {}".format(
                 status, reason, data)
@@ -594,7 +766,7 @@ class KubeHTTPClient(AbstractSchedulerClient):
                 log_data += data
         return log_data
 
-    def run(self, name, image, entrypoint, command):
+    def run(self, name, image, entrypoint, command, **kwargs):
         """Run a one-off command."""
         appname = name.split("_")[0]
         name = name.replace(".", "-")
@@ -612,16 +784,10 @@ class KubeHTTPClient(AbstractSchedulerClient):
         js_template = json.loads(template)
         js_template['spec']['containers'][0]['command'] = [entrypoint]
         js_template['spec']['containers'][0]['args'] = args
+        _set_env(js_template['spec']['containers'][0], kwargs)
 
-        con_dest = httplib.HTTPConnection(self.target+":"+self.port)
-        headers = {'Content-Type': 'application/json'}
-        con_dest.request('POST', '/api/'+self.apiversion+'/namespaces/'+appname+'/pods',
-                         headers=headers, body=json.dumps(js_template))
-        resp = con_dest.getresponse()
-        data = resp.read()
-        status = resp.status
-        reason = resp.reason
-        con_dest.close()
+        status, data, reason = self._request(
+            'POST', '/namespaces/'+appname+'/pods', json.dumps(js_template))
         if not 200 <= status <= 299:
             errmsg = "Failed to create a Pod: {} {} - {}".format(
                 status, reason, data)
@@ -683,4 +849,27 @@ class KubeHTTPClient(AbstractSchedulerClient):
         except RuntimeError:
             return JobState.destroyed
 
+    def states(self, names):
+        """Display the running state of several jobs with one pod listing per namespace."""
+        by_namespace = {}
+        for name in names:
+            by_namespace.setdefault(name.split("_")[0], []).append(name)
+        states = {}
+        for namespace, job_names in by_namespace.items():
+            try:
+                status, data, reason = self._get_pods(namespace)
+                pods = json.loads(data)['items']
+            except RuntimeError:
+                # the namespace is gone along with every pod in it
+                pods = []
+            for name in job_names:
+                rc_name = name.split(".")
+                rc_name = rc_name[0]+'-'+rc_name[1]
+                rc_name = rc_name.replace("_", "-")
+                phases = [pod['status']['phase'] for pod in pods
+                          if pod['metadata'].get('generateName') == rc_name+'-']
+                states[name] = _job_state(phases)
+        return states
+
+
 SchedulerClient = KubeHTTPClient
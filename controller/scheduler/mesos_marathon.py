@@ -1,3 +1,4 @@
+import pipes
 import re
 import time
 
@@ -50,7 +51,9 @@ class MarathonHTTPClient(AbstractSchedulerClient):
         cpu = kwargs.get('cpu', {}).get(l['c_type'])
         if cpu:
             c = cpu
-        cmd = "docker run --name {name} -P {image} {command}".format(**locals())
+        env = ''.join('-e {} '.format(pipes.quote(u'{}={}'.format(k, v).encode('utf-8')))
+                      for k, v in sorted((kwargs.get('env') or {}).items()))
+        cmd = "docker run --name {name} {env}-P {image} {command}".format(**locals())
         self.client.create_app(app_id, MarathonApp(cmd=cmd, mem=m, cpus=c, instances=0))
         for _ in xrange(POLL_ATTEMPTS):
             if self.client.get_app(self._app_id(name)).tasks_running == 0:
@@ -96,9 +99,9 @@ class MarathonHTTPClient(AbstractSchedulerClient):
         if docker_cli.inspect_container(name)['State']:
             docker_cli.remove_container(name, force=True)
 
-    def run(self, name, image, entrypoint, command):  # noqa
+    def run(self, name, image, entrypoint, command, **kwargs):  # noqa
         """Run a one-off command."""
-        return self.fleet.run(name, image, entrypoint, command)
+        return self.fleet.run(name, image, entrypoint, command, **kwargs)
 
     def state(self, name):
         """Display the given job's running state."""
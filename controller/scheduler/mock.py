@@ -13,12 +13,13 @@ class MockSchedulerClient(AbstractSchedulerClient):
     def create(self, name, image, command, **kwargs):
         """Create a new container."""
         jobs.setdefault(name, {})['state'] = JobState.created
+        jobs[name]['env'] = kwargs.get('env', {})
 
     def destroy(self, name):
         """Destroy a container."""
         jobs.setdefault(name, {})['state'] = JobState.destroyed
 
-    def run(self, name, image, entrypoint, command):
+    def run(self, name, image, entrypoint, command, **kwargs):
         """Run a one-off command."""
         # dump input into a json object for testing purposes
         return 0, json.dumps({
@@ -26,6 +27,7 @@ class MockSchedulerClient(AbstractSchedulerClient):
             'image': image,
             'entrypoint': entrypoint,
             'command': command,
+            'env': kwargs.get('env', {}),
         })
 
     def start(self, name):
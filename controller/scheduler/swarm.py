@@ -4,7 +4,7 @@ import time
 from django.conf import settings
 from docker import Client
 
-from . import AbstractSchedulerClient
+from . import AbstractSchedulerClient, collect_output
 from .states import JobState
 
 
@@ -38,7 +38,7 @@ class SwarmClient(AbstractSchedulerClient):
                                          command=command.encode('utf-8'),
                                          mem_limit=mem,
                                          cpu_shares=cpu,
-                                         environment=[affinity],
+                                         environment=[affinity] + _env(kwargs),
                                          host_config={'PublishAllPorts': True})
 
     def start(self, name):
@@ -54,28 +54,27 @@ class SwarmClient(AbstractSchedulerClient):
         self.stop(name)
         self.docker_cli.remove_container(name)
 
-    def run(self, name, image, entrypoint, command):
+    def run(self, name, image, entrypoint, command, **kwargs):
         """Run a one-off command."""
+        return collect_output(self.run_stream(name, image, entrypoint, command, **kwargs))
+
+    def run_stream(self, name, image, entrypoint, command, **kwargs):
+        """
+        Run a one-off command, yielding its output as it is written and then its exit code.
+        """
         cimage = self.registry + '/' + image
         # use affinity for nodes that already have the image
         affinity = "affinity:image==~{}".format(cimage)
         self.docker_cli.create_container(image=cimage, name=name,
                                          command=command.encode('utf-8'),
-                                         environment=[affinity],
+                                         environment=[affinity] + _env(kwargs),
                                          entrypoint=[entrypoint])
         time.sleep(2)
         self.start(name)
-        rc = 0
-        while (True):
-            if self._get_container_state(name) == JobState.created:
-                break
-            time.sleep(1)
-        try:
-            output = self.docker_cli.logs(name)
-            return rc, output
-        except:
-            rc = 1
-            return rc, output
+        # replay what was written before attaching, then follow the output until it exits
+        for output in self.docker_cli.attach(name, stream=True, logs=True):
+            yield output
+        yield self.docker_cli.wait(name)
 
     def _get_container_state(self, name):
         try:
@@ -98,6 +97,24 @@ class SwarmClient(AbstractSchedulerClient):
         except RuntimeError:
             return JobState.destroyed
 
+    def states(self, names):
+        """Display the running state of several jobs with a single container listing."""
+        running = {}
+        for container in self.docker_cli.containers(all=True):
+            for container_name in container.get('Names') or []:
+                # swarm prefixes container names with the node they run on
+                container_name = container_name.rsplit('/', 1)[-1]
+                running[container_name] = container.get('Status', '').startswith('Up')
+        states = {}
+        for name in names:
+            if name not in running:
+                states[name] = JobState.destroyed
+            elif running[name]:
+                states[name] = JobState.up
+            else:
+                states[name] = JobState.created
+        return states
+
     def _get_hostname(self, application_name):
         hostname = settings.UNIT_HOSTNAME
         if hostname == 'default':
@@ -121,4 +138,10 @@ class SwarmClient(AbstractSchedulerClient):
         dictports = self.docker_cli.inspect_image(image)['ContainerConfig']['ExposedPorts']
         return [int(port.split('/')[0]) for port in dictports]
 
+
+def _env(kwargs):
+    """Format the environment variables passed to the scheduler for the Docker API."""
+    return [u'{}={}'.format(k, v) for k, v in sorted((kwargs.get('env') or {}).items())]
+
+
 SchedulerClient = SwarmClient
@@ -10,6 +10,22 @@ try:
 except:
     SCHEDULER_OPTIONS = {}
 
+{{ if exists "/deis/controller/lifecycleWorkers" }}
+LIFECYCLE_WORKERS = int('{{ getv "/deis/controller/lifecycleWorkers" }}')
+{{ end }}
+{{ if exists "/deis/controller/lifecycleWorkersPerApp" }}
+LIFECYCLE_WORKERS_PER_APP = int('{{ getv "/deis/controller/lifecycleWorkersPerApp" }}')
+{{ end }}
+{{ if exists "/deis/controller/imageGCInterval" }}
+IMAGE_GC_INTERVAL = int('{{ getv "/deis/controller/imageGCInterval" }}')
+{{ end }}
+{{ if exists "/deis/controller/imageGCReleases" }}
+IMAGE_GC_RELEASES = int('{{ getv "/deis/controller/imageGCReleases" }}')
+{{ end }}
+{{ if exists "/deis/controller/runtimeConfig" }}
+RUNTIME_CONFIG = '{{ getv "/deis/controller/runtimeConfig" }}' in ['true', 'True', 'TRUE', '1']
+{{ end }}
+
 # scheduler swarm manager host
 
 SWARM_HOST = '{{ if exists "/deis/scheduler/swarm/host" }}{{ getv "/deis/scheduler/swarm/host" }}{{ else }}127.0.0.1{{ end }}'